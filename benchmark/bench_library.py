@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+bench_library module:
+Benchmarks clean_movie and clean_tv on generated synthetic libraries.
+
+The libraries hold sparse files, so main files, samples and extras get
+their real sizes without using disk space. Archives are real stored RAR
+volumes with sparse data, only the extracted members use disk space. Each
+run is done in its own process to measure its peak memory. Runs report wall
+time, cpu time, peak memory, the os module calls of the cleaning, like
+stat, scandir and rename, and the os.path calls that stat a path, like
+isdir and getsize. They can be compared with a saved baseline as a
+regression gate:
+
+    bench_library.py --titles 1000 10000 --save baseline.json
+    bench_library.py --titles 1000 10000 --baseline baseline.json
+"""
+import json
+import sys
+import zlib
+from argparse import ArgumentParser, SUPPRESS
+from os import makedirs, path
+from random import Random
+from resource import getrusage, RUSAGE_SELF
+from shutil import rmtree
+from struct import pack
+from subprocess import run, DEVNULL
+from tempfile import mkdtemp
+from time import monotonic
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..",
+                             "media-cleaner"))
+
+import mediaindex
+import mediamove
+import mediatools
+from mediaargs import Flag
+from mediametrics import LibraryMetrics
+from mediatools import clean_movie, clean_tv
+
+# Sizes of the generated files in bytes.
+_MB = 1000000
+_MAIN_SIZES = (700 * _MB, 1400 * _MB, 4500 * _MB, 9000 * _MB)
+_EPISODE_SIZES = (250 * _MB, 400 * _MB, 1200 * _MB)
+_SAMPLE_SIZE = 30 * _MB
+_EXTRAS_SIZE = 80 * _MB
+_VOLUME_SIZE = 2 * _MB
+
+# Words, tags and release groups the names are made of.
+_WORDS = ["the", "last", "dark", "city", "night", "river", "king", "lost",
+          "star", "house", "blood", "road", "winter", "ghost", "iron",
+          "silent", "black", "summer", "island", "wolf", "empire", "fire",
+          "secret", "story", "man", "of", "and", "war", "moon", "garden"]
+_RESOLUTIONS = ["480p", "720p", "1080p", "2160p"]
+_SOURCES = ["BluRay", "WEB-DL", "WEBRip", "HDTV", "DVDRip", "BDRip"]
+_CODECS = ["x264", "x265", "H.264", "HEVC", "XviD"]
+_GROUPS = ["GRP", "SPARKS", "NTb", "FLUX", "ROVERS", "DIMENSION", "YIFY"]
+_SEPARATORS = [".", " ", "_"]
+_JUNK = ["{group}.nfo", "RARBG.txt", "Torrent Downloaded From.txt",
+         "cover.jpg", "{name}.sfv"]
+
+# The RAR 4 signature, block types and flags of the generated archives.
+_RAR_SIGNATURE = b"Rar!\x1a\x07\x00"
+_RAR_MAIN, _RAR_FILE, _RAR_END = 0x73, 0x74, 0x7b
+_RAR_MAIN_VOLUME, _RAR_MAIN_NEW_NUMBERING, _RAR_MAIN_FIRST_VOLUME = \
+    0x0001, 0x0010, 0x0100
+_RAR_FILE_SPLIT_BEFORE, _RAR_FILE_SPLIT_AFTER = 0x0001, 0x0002
+_RAR_END_NEXT_VOLUME = 0x0001
+_RAR_SKIP_IF_UNKNOWN, _RAR_LONG_BLOCK = 0x4000, 0x8000
+# The unix host, version 2.0 and stored method of the file headers.
+_RAR_HOST_UNIX, _RAR_VERSION, _RAR_STORED = 3, 20, 0x30
+# A DOS timestamp, 2020-01-01 00:00.
+_RAR_TIME = (40 << 25) | (1 << 21) | (1 << 16)
+
+# CRC32 of zero bytes by length, the archived data is all zeros.
+_zero_crcs = {}
+
+# The cleaning function of each library.
+_LIBRARIES = {"movie": clean_movie, "tv": clean_tv}
+
+# The modes each library is cleaned in.
+_MODES = ["safemode", "live"]
+
+
+##########################################################
+################## Library generation ####################
+
+def _make_file(file_path, size=0):
+    """ Creates a sparse file of a size. """
+    makedirs(path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as file_:
+        file_.truncate(size)
+
+
+def _get_zero_crc(size):
+    """ Returns the CRC32 of size zero bytes. """
+    if size not in _zero_crcs:
+        crc, chunk = 0, bytes(_MB)
+        for offset in range(0, size, _MB):
+            crc = zlib.crc32(chunk[:min(_MB, size - offset)], crc)
+        _zero_crcs[size] = crc
+    return _zero_crcs[size]
+
+
+def _make_rar_block(type_, flags, body=b""):
+    """ Returns a RAR 4 block header, data of long blocks follows it. """
+    header = pack("<BHH", type_, flags, 7 + len(body)) + body
+    return pack("<H", zlib.crc32(header) & 0xffff) + header
+
+
+def _make_rar_volumes(title_dir, name, member_name, volumes):
+    """ Creates a stored RAR archive of name.partN.rar volumes holding one
+        member of zeros split over the volumes. The data is left as holes so
+        the volumes are sparse.
+    """
+    member = member_name.encode("utf-8")
+    for volume in range(volumes):
+        main_flags = _RAR_MAIN_VOLUME | _RAR_MAIN_NEW_NUMBERING
+        file_flags = _RAR_LONG_BLOCK
+        if volume == 0:
+            main_flags |= _RAR_MAIN_FIRST_VOLUME
+        else:
+            file_flags |= _RAR_FILE_SPLIT_BEFORE
+        if volume < volumes - 1:
+            file_flags |= _RAR_FILE_SPLIT_AFTER
+            # Split parts hold the CRC of their data, the last the CRC of all.
+            crc = _get_zero_crc(_VOLUME_SIZE)
+        else:
+            crc = _get_zero_crc(_VOLUME_SIZE * volumes)
+
+        volume_path = path.join(title_dir, "{}.part{}.rar".format(
+            name, volume + 1))
+        makedirs(title_dir, exist_ok=True)
+        with open(volume_path, 'wb') as file_:
+            file_.write(_RAR_SIGNATURE)
+            file_.write(_make_rar_block(_RAR_MAIN, main_flags, bytes(6)))
+            file_.write(_make_rar_block(
+                _RAR_FILE, file_flags,
+                pack("<IIBIIBBHI", _VOLUME_SIZE, _VOLUME_SIZE * volumes,
+                     _RAR_HOST_UNIX, crc, _RAR_TIME, _RAR_VERSION,
+                     _RAR_STORED, len(member), 0o100644) + member))
+            file_.seek(_VOLUME_SIZE, 1)
+            file_.write(_make_rar_block(
+                _RAR_END, _RAR_SKIP_IF_UNKNOWN |
+                (_RAR_END_NEXT_VOLUME if volume < volumes - 1 else 0)))
+
+
+def _make_title(random):
+    """ Returns a random title of one to four words. """
+    return " ".join(random.choice(_WORDS)
+                    for _ in range(random.randint(1, 4))).title()
+
+
+def _make_release(random, title, marker):
+    """ Returns a messy release name with the marker after the title. """
+    sep = random.choice(_SEPARATORS)
+    parts = title.split(" ") + [marker, random.choice(_RESOLUTIONS)]
+    if random.random() < 0.1:
+        parts.append(random.choice(["PROPER", "REPACK"]))
+    parts += [random.choice(_SOURCES), random.choice(_CODECS)]
+    name = sep.join(parts) + "-" + random.choice(_GROUPS)
+    return name.lower() if random.random() < 0.1 else name
+
+
+def _add_extras(random, title_dir, name):
+    """ Adds samples, extras, subtitles, archives and junk to a title. """
+    if random.random() < 0.5:
+        _make_file(path.join(title_dir, "Sample", name + "-sample.mkv"),
+                   _SAMPLE_SIZE)
+    if random.random() < 0.2:
+        _make_file(path.join(title_dir, name + ".Extra.Featurette.mkv"),
+                   _EXTRAS_SIZE)
+    if random.random() < 0.5:
+        _make_file(path.join(title_dir, name + ".en.srt"), 50000)
+    if random.random() < 0.1:
+        _make_file(path.join(title_dir, "Soundtrack",
+                             "track{:02}.mp3".format(random.randint(1, 20))),
+                   5 * _MB)
+    if random.random() < 0.05:
+        _make_rar_volumes(title_dir, name, name + ".Extra.Interview.mkv",
+                          random.randint(2, 5))
+    for junk in random.sample(_JUNK, random.randint(0, 3)):
+        _make_file(path.join(title_dir, junk.format(
+            group=random.choice(_GROUPS), name=name)), 100)
+
+
+def generate_movies(root_dir, titles, seed=0):
+    """ Generates a movie library with a number of titles. """
+    random = Random(seed)
+    for _ in range(titles):
+        title = _make_title(random)
+        year = str(random.randint(1950, 2025))
+        name = _make_release(random, title, random.choice(
+            [year, "(" + year + ")", "[" + year + "]"]))
+        file_name = name + random.choice([".mkv", ".mkv", ".mp4", ".avi"])
+
+        if random.random() < 0.1:
+            # A lone movie file in the root.
+            _make_file(path.join(root_dir, file_name),
+                       random.choice(_MAIN_SIZES))
+            continue
+
+        title_dir = path.join(root_dir, name if random.random() < 0.9 else
+                              "{} ({})".format(title, year))
+        _make_file(path.join(title_dir, file_name), random.choice(_MAIN_SIZES))
+        if random.random() < 0.1:
+            # A duplicate release of the same movie.
+            _make_file(path.join(title_dir, _make_release(
+                random, title, year) + ".mkv"), random.choice(_MAIN_SIZES))
+        _add_extras(random, title_dir, name)
+
+
+def generate_tv(root_dir, titles, seed=0):
+    """ Generates a tv-series library with a number of titles, each title
+        is an episode, a season or a sorted series.
+    """
+    random = Random(seed)
+    for _ in range(titles):
+        title = _make_title(random)
+        season = random.randint(1, 12)
+        kind = random.random()
+        if kind < 0.6:
+            # A single episode release.
+            episode = random.randint(1, 24)
+            name = _make_release(random, title, "S{:02}E{:02}".format(
+                season, episode))
+            title_dir = path.join(root_dir, name)
+            _make_file(path.join(title_dir, name + ".mkv"),
+                       random.choice(_EPISODE_SIZES))
+            _add_extras(random, title_dir, name)
+        elif kind < 0.9:
+            # A season pack.
+            name = _make_release(random, title, "S{:02}".format(season))
+            title_dir = path.join(root_dir, name)
+            for episode in range(1, random.randint(6, 24)):
+                _make_file(path.join(title_dir, name.replace(
+                    "S{:02}".format(season),
+                    "S{:02}E{:02}".format(season, episode)) + ".mkv"),
+                    random.choice(_EPISODE_SIZES))
+            _add_extras(random, title_dir, name)
+        else:
+            # A sorted series with an unsorted and a duplicate episode.
+            series_dir = path.join(root_dir, title)
+            season_dir = path.join(series_dir, "Season {}".format(season))
+            for episode in range(1, random.randint(3, 12)):
+                marker = "S{:02}E{:02}".format(season, episode)
+                _make_file(path.join(season_dir, "{} {}".format(title, marker),
+                                     "{}.{}.720p.mkv".format(
+                                         title.replace(" ", "."), marker)),
+                           random.choice(_EPISODE_SIZES))
+            marker = "S{:02}E{:02}".format(season, 30)
+            name = _make_release(random, title, marker)
+            _make_file(path.join(season_dir, name + ".mkv"),
+                       random.choice(_EPISODE_SIZES))
+            _make_file(path.join(season_dir, name + ".480p.mkv"),
+                       _EPISODE_SIZES[0])
+
+
+_GENERATORS = {"movie": generate_movies, "tv": generate_tv}
+
+
+##########################################################
+###################### Measuring #########################
+
+# The modules whose os calls are counted.
+_COUNTED_MODULES = (mediatools, mediamove, mediaindex)
+
+# The os.path functions that stat a path, counted in every module.
+_PATH_STAT_CALLS = ("exists", "lexists", "isdir", "isfile", "islink",
+                    "getsize", "getmtime")
+
+
+def _count_os_calls(counts):
+    """ Counts the calls of the os functions imported by the cleaning
+        modules by name in counts. The stat calls of scandir entries are
+        made by the entries and aren't counted.
+    """
+    for module in _COUNTED_MODULES:
+        for name, func in list(vars(module).items()):
+            if callable(func) and getattr(func, "__module__", None) in \
+                    ("posix", "os"):
+                setattr(module, name, _make_counted(func, name, counts))
+
+
+def _count_path_calls(counts):
+    """ Counts the calls of the os.path functions that stat a path by name
+        in counts.
+    """
+    for name in _PATH_STAT_CALLS:
+        setattr(path, name, _make_counted(getattr(path, name), name, counts))
+
+
+def _make_counted(func, name, counts):
+    """ Returns func counting its calls in counts. """
+
+    def counted(*args, **kwargs):
+        """ Counts the call and calls func. """
+        counts[name] = counts.get(name, 0) + 1
+        return func(*args, **kwargs)
+
+    return counted
+
+
+def measure_run(library, mode, root_dir, jobs=1):
+    """ Cleans a library in this process, returns the measurements. """
+    flags = {flag: False for flag in Flag}
+    flags[Flag.QUIET] = True
+    flags[Flag.SAFEMODE] = mode == "safemode"
+    metrics = LibraryMetrics(library)
+    os_calls = {}
+    _count_os_calls(os_calls)
+    path_calls = {}
+    _count_path_calls(path_calls)
+
+    usage = getrusage(RUSAGE_SELF)
+    started = monotonic()
+    _LIBRARIES[library](flags, root_dir, jobs=jobs, metrics=metrics)
+    wall = monotonic() - started
+    end_usage = getrusage(RUSAGE_SELF)
+
+    return {"wall": wall,
+            "user": end_usage.ru_utime - usage.ru_utime,
+            "system": end_usage.ru_stime - usage.ru_stime,
+            # Linux reports the peak resident set size in KiB.
+            "peak_rss": end_usage.ru_maxrss * 1024,
+            "os_calls": os_calls,
+            "path_calls": path_calls,
+            "phases": dict(metrics.phases),
+            "operations": sum(metrics.operations.values())}
+
+
+def _run_case(library, mode, root_dir, jobs):
+    """ Measures a run in a new process so peak memory is its own. """
+    result_path = path.join(path.dirname(root_dir), "result.json")
+    run([sys.executable, path.abspath(__file__), "--run", library, mode,
+         root_dir, result_path, "--jobs", str(jobs)],
+        stdout=DEVNULL, check=True)
+    with open(result_path) as result_file:
+        return json.load(result_file)
+
+
+def run_benchmark(work_dir, scales, jobs=1, repeat=1, seed=0):
+    """ Runs every library and mode at every scale, returns the results by
+        case name. Live runs get a new library each time, the best wall
+        time of the repeats is kept.
+    """
+    results = {}
+    for titles in scales:
+        for library in sorted(_LIBRARIES):
+            for mode in _MODES:
+                case = "{}/{}/{}".format(library, mode, titles)
+                best = None
+                for _ in range(repeat):
+                    root_dir = path.join(work_dir, library, "library")
+                    if best is None or mode == "live":
+                        rmtree(root_dir, ignore_errors=True)
+                        _GENERATORS[library](root_dir, titles, seed)
+                    result = _run_case(library, mode, root_dir, jobs)
+                    if best is None or result["wall"] < best["wall"]:
+                        best = result
+                results[case] = best
+                _print_result(case, best)
+    return results
+
+
+def _print_result(case, result):
+    """ Prints the measurements of a case as a table row. """
+    print("{:<22} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.1f} {:>9} {:>8}".format(
+        case, result["wall"], result["user"], result["system"],
+        result["peak_rss"] / 1048576.0, sum(result["os_calls"].values()),
+        result["operations"]))
+    print(" " * 4 + ", ".join("{} {:.3f}s".format(phase, seconds)
+                              for phase, seconds in result["phases"].items()))
+    print(" " * 4 + ", ".join("{} {}".format(name, count) for name, count in
+                              sorted(result["os_calls"].items())))
+    print(" " * 4 + ", ".join("path.{} {}".format(name, count)
+                              for name, count in
+                              sorted(result["path_calls"].items())))
+    sys.stdout.flush()
+
+
+def compare_results(results, baseline, tolerance):
+    """ Prints the cases slower or making more os calls or os.path stats
+        than the baseline by more than tolerance, returns True if there are
+        any. Baselines saved before os.path stats were counted only gate
+        the other measurements.
+    """
+    regressed = False
+    for case, result in sorted(results.items()):
+        if case not in baseline:
+            continue
+        measurements = [
+            ("wall time", result["wall"], baseline[case]["wall"]),
+            ("os calls", sum(result["os_calls"].values()),
+             sum(baseline[case]["os_calls"].values()))]
+        if "path_calls" in baseline[case]:
+            measurements.append(
+                ("os.path stats", sum(result["path_calls"].values()),
+                 sum(baseline[case]["path_calls"].values())))
+        for name, value, base_value in measurements:
+            ratio = value / max(base_value, 1e-9)
+            if ratio > 1 + tolerance:
+                print("Regression: {} {} {:.6g} -> {:.6g} ({:+.0%})".format(
+                    case, name, base_value, value, ratio - 1))
+                regressed = True
+    return regressed
+
+
+##########################################################
+###################### Entry point #######################
+
+def main():
+    """ Parses arguments and runs the benchmark. """
+    parser = ArgumentParser(description='Benchmarks cleaning of synthetic '
+                                        'media libraries.')
+    parser.add_argument('--titles', type=int, nargs='+', default=[1000],
+                        help='the numbers of titles per library to run')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of titles to clean concurrently')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of each case, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the generated libraries')
+    parser.add_argument('--dir', help='directory to generate the libraries '
+                                      'in, defaults to a temporary one')
+    parser.add_argument('--save', help='save the results to this file')
+    parser.add_argument('--baseline',
+                        help='fail on cases slower than in these results')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown from the baseline, '
+                             'defaults to 0.2')
+    parser.add_argument('--run', nargs=4, help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        # A single measured run in a child process.
+        library, mode, root_dir, result_path = args.run
+        with open(result_path, 'w') as result_file:
+            json.dump(measure_run(library, mode, root_dir, args.jobs),
+                      result_file)
+        return 0
+
+    work_dir = args.dir or mkdtemp(prefix="media-cleaner-bench-")
+    print("{:<22} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8}".format(
+        "case", "wall s", "user s", "system s", "rss MiB", "os calls",
+        "ops"))
+    try:
+        results = run_benchmark(work_dir, args.titles, args.jobs, args.repeat,
+                                args.seed)
+    finally:
+        if args.dir is None:
+            rmtree(work_dir, ignore_errors=True)
+
+    if args.save is not None:
+        with open(args.save, 'w') as save_file:
+            json.dump(results, save_file, indent=2, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            if compare_results(results, json.load(baseline_file),
+                               args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
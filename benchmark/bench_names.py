@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+bench_names module:
+Benchmarks the release name parsing and cleaning functions over a corpus of
+release names and checks their outputs.
+
+The corpus (names.jsonl) holds anonymized scene and P2P style names with
+the expected output of each function. Each function is timed over the
+whole corpus with the release name cache cleared first, so the parsing is
+measured and not the cache. Any output differing from the corpus fails the
+run, after an intended change the expected outputs are updated with
+--update:
+
+    bench_names.py
+    bench_names.py --update
+"""
+import json
+import sys
+from argparse import ArgumentParser
+from os import path
+from random import Random
+from time import perf_counter
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..",
+                             "media-cleaner"))
+
+from mediatools import _parse_release_name, _get_clean_tv_main_file_name, \
+    _get_tv_file_name_year_match, _get_movie_name_year_match, \
+    _get_clean_movie_main_file_name, _get_suffix, _CLASSIFIER
+
+# The bundled corpus.
+CORPUS_PATH = path.join(path.dirname(path.abspath(__file__)), "names.jsonl")
+
+
+def _parse_markers(record):
+    """ Returns the season and episode numbers of a name. """
+    release = _parse_release_name(record["name"])
+    return [release.season, release.episode]
+
+
+def _is_subtitle(record):
+    """ Checks if a name has a default subtitle suffix. """
+    return _get_suffix(record["name"]) in _CLASSIFIER.subtitle_suffixes
+
+
+def _clean_tv_main_file_name(record):
+    """ Returns the cleaned tv-series file name. """
+    return _get_clean_tv_main_file_name(record["name"], record["series"],
+                                        _is_subtitle(record))
+
+
+def _tv_name_year_match(record):
+    """ Returns the tv-series name and year. """
+    match_ = _get_tv_file_name_year_match(record["name"])
+    return list(match_) if match_ is not None else None
+
+
+def _movie_name_year_match(record):
+    """ Returns the movie name and year. """
+    match_ = _get_movie_name_year_match(record["name"])
+    return list(match_) if match_ is not None else None
+
+
+def _clean_movie_main_file_name(record):
+    """ Returns the cleaned movie file name. """
+    return _get_clean_movie_main_file_name(record["name"], record["movie"],
+                                           _is_subtitle(record))
+
+
+# The benchmarked functions by name with the kinds of names they are
+# used for, outputs are stored under the same name in the corpus.
+_FUNCTIONS = [("parse_markers", _parse_markers, ("tv", "movie")),
+              ("tv_main_file_name", _clean_tv_main_file_name, ("tv",)),
+              ("tv_name_year", _tv_name_year_match, ("tv",)),
+              ("movie_name_year", _movie_name_year_match, ("movie",)),
+              ("movie_main_file_name", _clean_movie_main_file_name,
+               ("movie",))]
+
+
+##########################################################
+################### Corpus generation ####################
+
+# Anonymized words, tags and release groups the names are made of.
+_WORDS = ["alpha", "bravo", "cedar", "delta", "ember", "falcon", "granite",
+          "harbor", "indigo", "juniper", "kestrel", "lantern", "meadow",
+          "nova", "orchid", "pioneer", "quartz", "raven", "summit", "tundra",
+          "umber", "velvet", "willow", "xenon", "yonder", "zephyr", "the",
+          "of", "and", "a", "in", "2", "ii"]
+_RESOLUTIONS = ["480p", "576p", "720p", "1080p", "1080i", "2160p", "4K"]
+_SOURCES = ["BluRay", "WEB-DL", "WEBRip", "HDTV", "DVDRip", "BDRip", "HDRip",
+            "AMZN.WEB-DL", "NF.WEBRip", "PDTV", "DVDSCR"]
+_CODECS = ["x264", "x265", "H.264", "H264", "HEVC", "XviD", "DivX", "AVC"]
+_AUDIO = ["DD5.1", "AAC2.0", "DTS", "AC3", "TrueHD.7.1", "FLAC", "DDP5.1"]
+_TAGS = ["PROPER", "REPACK", "RERIP", "REAL", "INTERNAL", "LIMITED",
+         "EXTENDED", "UNRATED", "DIRECTORS.CUT", "REMASTERED"]
+_GROUPS = ["GRP", "RLS", "TEAM", "CREW", "NX", "QRS", "VZA", "KLM"]
+_VIDEO_SUFFIXES = ["mkv", "mkv", "mkv", "mp4", "avi"]
+_SUBTITLE_SUFFIXES = ["srt", "sub", "smi"]
+
+
+def _make_title(random):
+    """ Returns a random title of one to four words. """
+    return " ".join(random.choice(_WORDS)
+                    for _ in range(random.randint(1, 4))).title()
+
+
+def _make_tags(random):
+    """ Returns the quality tags following a marker. """
+    tags = []
+    if random.random() < 0.1:
+        tags.append(random.choice(_TAGS))
+    if random.random() < 0.9:
+        tags.append(random.choice(_RESOLUTIONS))
+    tags.append(random.choice(_SOURCES))
+    if random.random() < 0.4:
+        tags.append(random.choice(_AUDIO))
+    tags.append(random.choice(_CODECS))
+    return tags
+
+
+def _make_suffix(random):
+    """ Returns a video or, sometimes, a subtitle suffix. """
+    if random.random() < 0.15:
+        return random.choice(["", "en.", "eng.", "swe."]) + \
+            random.choice(_SUBTITLE_SUFFIXES)
+    return random.choice(_VIDEO_SUFFIXES)
+
+
+def _make_tv_name(random):
+    """ Returns a tv-series release name and its series name. """
+    title = _make_title(random)
+    year = str(random.randint(1990, 2025)) if random.random() < 0.2 else None
+    season, episode = random.randint(1, 30), random.randint(1, 120)
+    style = random.random()
+    sep = random.choice([".", ".", " ", "_", "-"])
+    words = title.split(" ") + ([year] if year is not None else [])
+    if style < 0.6:
+        marker = "S{:02}E{:02}".format(season, episode)
+        if random.random() < 0.1:
+            marker += "E{:02}".format(episode + 1)
+    elif style < 0.75:
+        marker = "{}x{:02}".format(season, episode)
+    elif style < 0.85:
+        marker = "Season {} Episode {}".format(season, episode)
+    else:
+        marker = "s{}e{}".format(season, episode)
+    parts = words + [marker]
+    if random.random() < 0.2:
+        parts += _make_title(random).split(" ")
+    name = sep.join(parts + _make_tags(random))
+    if random.random() < 0.8:
+        name += "-" + random.choice(_GROUPS)
+    if random.random() < 0.1:
+        name = name.lower()
+    return name + "." + _make_suffix(random), title
+
+
+def _make_movie_name(random):
+    """ Returns a movie release name and its cleaned directory name. """
+    title = _make_title(random)
+    year = str(random.randint(1920, 2025))
+    style = random.random()
+    sep = random.choice([".", ".", " ", "_"])
+    if style < 0.6:
+        marker = year
+    elif style < 0.8:
+        marker = "(" + year + ")"
+    else:
+        marker = "[" + year + "]"
+    parts = title.split(" ") + [marker] + _make_tags(random)
+    name = sep.join(parts)
+    if random.random() < 0.8:
+        name += "-" + random.choice(_GROUPS)
+    if random.random() < 0.1:
+        name = name.lower()
+    movie_dir = "{} ({})".format(title, year) if random.random() < 0.9 \
+        else title
+    return name + "." + _make_suffix(random), movie_dir
+
+
+def generate_corpus(count, seed=0):
+    """ Generates a corpus of tv-series and movie release names, the
+        expected outputs are added by update_expected.
+    """
+    random = Random(seed)
+    corpus = []
+    for _ in range(count):
+        if random.random() < 0.5:
+            name, series = _make_tv_name(random)
+            corpus.append({"kind": "tv", "name": name, "series": series})
+        else:
+            name, movie_dir = _make_movie_name(random)
+            corpus.append({"kind": "movie", "name": name, "movie": movie_dir})
+    return corpus
+
+
+def update_expected(corpus):
+    """ Stores the current output of each function as the expected. """
+    for record in corpus:
+        record["expected"] = {name: func(record)
+                              for name, func, kinds in _FUNCTIONS
+                              if record["kind"] in kinds}
+
+
+def load_corpus(corpus_path=CORPUS_PATH):
+    """ Loads a corpus, a record per line. """
+    with open(corpus_path) as corpus_file:
+        return [json.loads(line) for line in corpus_file if line.strip()]
+
+
+def save_corpus(corpus, corpus_path=CORPUS_PATH):
+    """ Saves a corpus, a record per line. """
+    with open(corpus_path, 'w') as corpus_file:
+        for record in corpus:
+            corpus_file.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+##########################################################
+###################### Measuring #########################
+
+def check_corpus(corpus):
+    """ Returns the (name, function, expected, actual) of each output that
+        differs from the corpus.
+    """
+    mismatches = []
+    for record in corpus:
+        for name, func, kinds in _FUNCTIONS:
+            if record["kind"] not in kinds:
+                continue
+            actual = func(record)
+            if actual != record["expected"][name]:
+                mismatches.append((record["name"], name,
+                                   record["expected"][name], actual))
+    return mismatches
+
+
+def time_function(func, records, repeat=5):
+    """ Returns the fastest seconds of calling func with every record, the
+        release name cache is cleared before each pass.
+    """
+    best = None
+    for _ in range(repeat):
+        _parse_release_name.cache_clear()
+        started = perf_counter()
+        for record in records:
+            func(record)
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _call_all(record):
+    """ Calls every function used for a record. """
+    for _, func, kinds in _FUNCTIONS:
+        if record["kind"] in kinds:
+            func(record)
+
+
+def run_benchmark(corpus, repeat=5):
+    """ Prints the names per second and cost per name of each function and
+        of all functions together.
+    """
+    print("{:<22} {:>8} {:>12} {:>12}".format("function", "names",
+                                              "names/s", "us/name"))
+    for name, func, kinds in _FUNCTIONS:
+        records = [record for record in corpus if record["kind"] in kinds]
+        _print_timing(name, len(records), time_function(func, records,
+                                                        repeat))
+    _print_timing("all", len(corpus), time_function(_call_all, corpus,
+                                                     repeat))
+
+
+def _print_timing(name, count, seconds):
+    """ Prints the timing of a function as a table row. """
+    print("{:<22} {:>8} {:>12.0f} {:>12.2f}".format(
+        name, count, count / seconds, seconds / count * 1e6))
+
+
+##########################################################
+###################### Entry point #######################
+
+def main():
+    """ Parses arguments, checks the corpus and runs the benchmark. """
+    parser = ArgumentParser(description='Benchmarks release name parsing '
+                                        'over a corpus of names.')
+    parser.add_argument('--corpus', default=CORPUS_PATH,
+                        help='the corpus file, defaults to the bundled one')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed passes of each function, the fastest is '
+                             'kept')
+    parser.add_argument('--update', action='store_true',
+                        help='store the current outputs as expected')
+    parser.add_argument('--generate', type=int, metavar='COUNT',
+                        help='generate a new corpus of COUNT names')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the generated corpus')
+    args = parser.parse_args()
+
+    if args.generate is not None:
+        corpus = generate_corpus(args.generate, args.seed)
+    else:
+        corpus = load_corpus(args.corpus)
+    if args.generate is not None or args.update:
+        update_expected(corpus)
+        save_corpus(corpus, args.corpus)
+        print("Stored the expected outputs of {} names".format(len(corpus)))
+        return 0
+
+    mismatches = check_corpus(corpus)
+    for name, function, expected, actual in mismatches[:20]:
+        print("Mismatch: {} {}\n  expected: {}\n  actual:   {}".format(
+            function, name, expected, actual))
+    if mismatches:
+        print("{} outputs differ from the corpus".format(len(mismatches)))
+        return 1
+
+    run_benchmark(corpus, args.repeat)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
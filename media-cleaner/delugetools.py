@@ -3,15 +3,163 @@ delugetools module:
 Contains various functions for communication with a deluge daemon.
 """
 
+import ssl
+import zlib
+from collections import namedtuple
+from os import environ, path
+from socket import create_connection
+from struct import pack, unpack, calcsize
 from subprocess import Popen, PIPE
+from time import monotonic
 
+# The local deluged RPC address.
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = 58846
 
-def has_active_torrents():
+# Seconds to wait for deluged before falling back to deluge-console.
+DAEMON_TIMEOUT = 2
+
+# Seconds a torrent state snapshot is shared between checks.
+SNAPSHOT_TTL = 10
+
+# The torrent status fields of a snapshot.
+_SNAPSHOT_FIELDS = ["state", "is_finished", "save_path", "name", "files"]
+
+# Clients by (host, port), kept connected between status checks.
+_clients = {}
+
+# Torrent state snapshots by (host, port).
+_snapshots = {}
+
+
+class TorrentSnapshot(namedtuple('TorrentSnapshot',
+                                 ['taken', 'torrents', 'has_active'])):
+    """ The torrent state of deluged at one point in time.
+        torrents is a dict of torrent id -> status, None if the state is only
+        known from deluge-console.
+    """
+    __slots__ = ()
+
+    @property
+    def active_paths(self):
+        """ The content paths of the active torrents, None if torrents are
+            active but the paths are unknown.
+            Only finished and paused torrents are inactive, the files of
+            downloading or seeding torrents are in use. The paths are the top
+            level file or directory of each torrent in its save path.
+        """
+        return self._get_paths(lambda torrent: not (
+            torrent["is_finished"] and torrent["state"] == "Paused"))
+
+    @property
+    def incomplete_paths(self):
+        """ The content paths of the unfinished torrents, None if torrents
+            are active but the paths are unknown.
+            Unlike active_paths seeding torrents are left out, their files
+            are complete and only read.
+        """
+        return self._get_paths(lambda torrent: not torrent["is_finished"])
+
+    def _get_paths(self, is_included):
+        """ Returns the content paths of the included torrents. """
+        if self.torrents is None:
+            return None if self.has_active else set()
+
+        paths = set()
+        for torrent in self.torrents.values():
+            if not is_included(torrent):
+                continue
+            # Torrents without metadata have no files yet.
+            paths.add(path.join(torrent["save_path"], torrent["name"]))
+            for file_ in torrent["files"]:
+                paths.add(path.join(torrent["save_path"],
+                                    file_["path"].split("/", 1)[0]))
+        return paths
+
+
+def get_torrent_snapshot(host=DAEMON_HOST, port=DAEMON_PORT, auth_path=None,
+                         ttl=SNAPSHOT_TTL):
+    """ Get a snapshot of the torrent state on the local deluged server.
+    Snapshots are shared between checks for ttl seconds.
+    The daemon is queried over RPC, deluge-console is only used if the
+    daemon can't be reached.
+
+    :param host: the deluged host
+    :param port: the deluged RPC port
+    :param auth_path: the deluge auth file, found automatically if None
+    :param ttl: the max age in seconds of a shared snapshot
+    :return: the torrent state
+    :rtype: TorrentSnapshot
+    """
+    snapshot = _snapshots.get((host, port))
+    if snapshot is not None and monotonic() - snapshot.taken < ttl:
+        return snapshot
+
+    try:
+        torrents = _call_daemon(host, port, auth_path,
+                                "core.get_torrents_status", {},
+                                _SNAPSHOT_FIELDS)
+        snapshot = TorrentSnapshot(monotonic(), torrents, len(torrents) > 0)
+    except _ConnectionError:
+        snapshot = TorrentSnapshot(monotonic(), None,
+                                   _has_active_torrents_console())
+    _snapshots[(host, port)] = snapshot
+    return snapshot
+
+
+def invalidate_torrent_snapshot(host=DAEMON_HOST, port=DAEMON_PORT):
+    """ Drops the shared snapshot so the next check queries deluged. """
+    _snapshots.pop((host, port), None)
+
+
+def has_active_torrents(host=DAEMON_HOST, port=DAEMON_PORT, auth_path=None,
+                        ttl=SNAPSHOT_TTL):
     """ Check for any active torrents on the local deluged server.
 
+    :param host: the deluged host
+    :param port: the deluged RPC port
+    :param auth_path: the deluge auth file, found automatically if None
+    :param ttl: the max age in seconds of a shared snapshot
     :return: True if one or more torrents are active
     :rtype: Bool
     """
+    return get_torrent_snapshot(host, port, auth_path, ttl).has_active
+
+
+def get_active_torrent_paths(host=DAEMON_HOST, port=DAEMON_PORT,
+                             auth_path=None, ttl=SNAPSHOT_TTL):
+    """ Get the content paths of the active torrents on the local deluged
+    server, see TorrentSnapshot.active_paths.
+
+    :param host: the deluged host
+    :param port: the deluged RPC port
+    :param auth_path: the deluge auth file, found automatically if None
+    :param ttl: the max age in seconds of a shared snapshot
+    :return: a set of paths, None if torrents are active but the paths are
+             unknown
+    :rtype: set
+    """
+    return get_torrent_snapshot(host, port, auth_path, ttl).active_paths
+
+
+def get_incomplete_torrent_paths(host=DAEMON_HOST, port=DAEMON_PORT,
+                                 auth_path=None, ttl=SNAPSHOT_TTL):
+    """ Get the content paths of the unfinished torrents on the local deluged
+    server, see TorrentSnapshot.incomplete_paths.
+
+    :param host: the deluged host
+    :param port: the deluged RPC port
+    :param auth_path: the deluge auth file, found automatically if None
+    :param ttl: the max age in seconds of a shared snapshot
+    :return: a set of paths, None if torrents are active but the paths are
+             unknown
+    :rtype: set
+    """
+    return get_torrent_snapshot(host, port, auth_path, ttl).incomplete_paths
+
+
+def _has_active_torrents_console():
+    """ Check for any active torrents using deluge-console. """
     std_output, std_err_output = '', ''
     proc = None
     try:
@@ -33,3 +181,332 @@ def has_active_torrents():
     else:
         # Success!
         return std_output.strip() != ""
+
+
+def _call_daemon(host, port, auth_path, method, *args):
+    """ Calls a method on deluged using a kept connection.
+        A kept connection that was closed is reconnected once.
+    """
+    client = _clients.pop((host, port), None)
+    if client is not None:
+        try:
+            result = client.call(method, *args)
+            _clients[(host, port)] = client
+            return result
+        except _ConnectionError:
+            client.close()
+
+    username, password = _read_auth(auth_path)
+    client = DelugeClient(host, port)
+    try:
+        client.login(username, password)
+        result = client.call(method, *args)
+    except Exception:
+        client.close()
+        raise
+    _clients[(host, port)] = client
+    return result
+
+
+##########################################################
+##################### Authentication #####################
+
+def _get_auth_paths():
+    """ Returns the possible deluge auth file paths in order. """
+    config_dir = environ.get("XDG_CONFIG_HOME",
+                             path.join(path.expanduser("~"), ".config"))
+    return [path.join(config_dir, "deluge", "auth"),
+            "/var/lib/deluged/config/auth",
+            "/var/lib/deluge/.config/deluge/auth"]
+
+
+def _read_auth(auth_path=None):
+    """ Returns the (username, password) used by local clients from the
+        deluge auth file.
+    """
+    for auth_path_ in [auth_path] if auth_path is not None else \
+            _get_auth_paths():
+        try:
+            with open(auth_path_) as auth_file:
+                lines = [line.strip().split(":") for line in auth_file
+                         if line.strip() and not line.startswith("#")]
+        except OSError:
+            continue
+        accounts = [(line[0], line[1]) for line in lines if len(line) >= 2]
+        # Prefer the account deluge creates for local clients.
+        for account in accounts:
+            if account[0] == "localclient":
+                return account
+        if accounts:
+            return accounts[0]
+    raise _ConnectionError("No deluge auth file found")
+
+
+##########################################################
+####################### RPC client #######################
+
+# Deluge RPC message types.
+_RPC_RESPONSE = 1
+_RPC_ERROR = 2
+_RPC_EVENT = 3
+
+# The message header: protocol version and body length.
+_PROTOCOL_VERSION = 1
+_HEADER_FORMAT = "!BI"
+_HEADER_SIZE = calcsize(_HEADER_FORMAT)
+
+# The client version sent when logging in, required by deluge 2.
+_CLIENT_VERSION = "2.0.0"
+
+
+class _ConnectionError(Exception):
+    """ The daemon could not be reached or doesn't speak the protocol. """
+
+
+class DelugeClient(object):
+    """ A minimal client for the deluged RPC protocol.
+        Messages are rencoded, zlib compressed and sent over TLS.
+    """
+
+    def __init__(self, host=DAEMON_HOST, port=DAEMON_PORT,
+                 timeout=DAEMON_TIMEOUT):
+        # The daemon uses a self-signed certificate.
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        try:
+            self._socket = context.wrap_socket(
+                create_connection((host, port), timeout))
+        except OSError as err:
+            raise _ConnectionError("Could not connect to deluged: {}".
+                                   format(err))
+        self._request_id = 0
+
+    def login(self, username, password):
+        """ Logs in to the daemon. """
+        self.call("daemon.login", username, password,
+                  client_version=_CLIENT_VERSION)
+
+    def call(self, method, *args, **kwargs):
+        """ Calls a daemon method and returns the result.
+            Errors raised by the daemon raise a RuntimeError.
+        """
+        self._request_id += 1
+        request_id = self._request_id
+        body = zlib.compress(_rencode_dumps(
+            ((request_id, method, args, kwargs),)))
+        try:
+            self._socket.sendall(pack(_HEADER_FORMAT, _PROTOCOL_VERSION,
+                                      len(body)) + body)
+            while True:
+                message = self._receive()
+                if message[0] == _RPC_EVENT or message[1] != request_id:
+                    # Not the response to this request.
+                    continue
+                elif message[0] == _RPC_RESPONSE:
+                    return message[2]
+                elif message[0] == _RPC_ERROR:
+                    raise RuntimeError("Status check failed, deluged {}: {}".
+                                       format(message[2], " ".join(
+                                           str(arg) for arg in message[3])))
+                raise _ConnectionError("Unknown deluged message type")
+        except (OSError, IndexError, TypeError) as err:
+            raise _ConnectionError("Lost connection to deluged: {}".
+                                   format(err))
+
+    def _receive(self):
+        """ Receives and decodes a message. """
+        version, length = unpack(_HEADER_FORMAT,
+                                 self._receive_exactly(_HEADER_SIZE))
+        if version != _PROTOCOL_VERSION:
+            raise _ConnectionError("Unsupported deluged protocol version: {}".
+                                   format(version))
+        try:
+            return _rencode_loads(zlib.decompress(
+                self._receive_exactly(length)))
+        except (zlib.error, ValueError) as err:
+            raise _ConnectionError("Invalid deluged message: {}".format(err))
+
+    def _receive_exactly(self, size):
+        """ Receives exactly size bytes. """
+        data = b""
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if not chunk:
+                raise _ConnectionError("Connection closed by deluged")
+            data += chunk
+        return data
+
+    def close(self):
+        """ Closes the connection. """
+        self._socket.close()
+
+
+##########################################################
+######################## rencode #########################
+
+# The rencode type codes as used by deluge.
+_CHR_LIST = 59
+_CHR_DICT = 60
+_CHR_INT = 61
+_CHR_INT1 = 62
+_CHR_INT2 = 63
+_CHR_INT4 = 64
+_CHR_INT8 = 65
+_CHR_FLOAT32 = 66
+_CHR_FLOAT64 = 44
+_CHR_TRUE = 67
+_CHR_FALSE = 68
+_CHR_NONE = 69
+_CHR_TERM = 127
+
+# Small values are encoded in the type code itself.
+_INT_POS_FIXED_START = 0
+_INT_POS_FIXED_COUNT = 44
+_INT_NEG_FIXED_START = 70
+_INT_NEG_FIXED_COUNT = 32
+_DICT_FIXED_START = 102
+_DICT_FIXED_COUNT = 25
+_STR_FIXED_START = 128
+_STR_FIXED_COUNT = 64
+_LIST_FIXED_START = _STR_FIXED_START + _STR_FIXED_COUNT
+_LIST_FIXED_COUNT = 64
+
+# Struct formats of the fixed size values by type code.
+_FIXED_FORMATS = {_CHR_INT1: "!b", _CHR_INT2: "!h", _CHR_INT4: "!l",
+                  _CHR_INT8: "!q", _CHR_FLOAT32: "!f", _CHR_FLOAT64: "!d"}
+
+
+def _rencode_dumps(value):
+    """ Encodes a value with rencode. """
+    chunks = []
+    _rencode_encode(value, chunks)
+    return b"".join(chunks)
+
+
+def _rencode_encode(value, chunks):
+    """ Appends the rencoded chunks of a value. """
+    if value is None:
+        chunks.append(bytes([_CHR_NONE]))
+    elif value is True or value is False:
+        chunks.append(bytes([_CHR_TRUE if value else _CHR_FALSE]))
+    elif isinstance(value, int):
+        if 0 <= value < _INT_POS_FIXED_COUNT:
+            chunks.append(bytes([_INT_POS_FIXED_START + value]))
+        elif -_INT_NEG_FIXED_COUNT <= value < 0:
+            chunks.append(bytes([_INT_NEG_FIXED_START - 1 - value]))
+        else:
+            for code in (_CHR_INT1, _CHR_INT2, _CHR_INT4, _CHR_INT8):
+                bits = calcsize(_FIXED_FORMATS[code]) * 8
+                if -2 ** (bits - 1) <= value < 2 ** (bits - 1):
+                    chunks.append(bytes([code]) +
+                                  pack(_FIXED_FORMATS[code], value))
+                    break
+            else:
+                chunks.append(bytes([_CHR_INT]) + str(value).encode() +
+                              bytes([_CHR_TERM]))
+    elif isinstance(value, float):
+        chunks.append(bytes([_CHR_FLOAT64]) + pack("!d", value))
+    elif isinstance(value, (str, bytes)):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        if len(value) < _STR_FIXED_COUNT:
+            chunks.append(bytes([_STR_FIXED_START + len(value)]) + value)
+        else:
+            chunks.append(str(len(value)).encode() + b":" + value)
+    elif isinstance(value, (list, tuple)):
+        if len(value) < _LIST_FIXED_COUNT:
+            chunks.append(bytes([_LIST_FIXED_START + len(value)]))
+            for item in value:
+                _rencode_encode(item, chunks)
+        else:
+            chunks.append(bytes([_CHR_LIST]))
+            for item in value:
+                _rencode_encode(item, chunks)
+            chunks.append(bytes([_CHR_TERM]))
+    elif isinstance(value, dict):
+        fixed = len(value) < _DICT_FIXED_COUNT
+        chunks.append(bytes([_DICT_FIXED_START + len(value)] if fixed
+                            else [_CHR_DICT]))
+        for key, item in value.items():
+            _rencode_encode(key, chunks)
+            _rencode_encode(item, chunks)
+        if not fixed:
+            chunks.append(bytes([_CHR_TERM]))
+    else:
+        raise TypeError("Can't rencode: {}".format(type(value)))
+
+
+def _rencode_loads(data):
+    """ Decodes a rencoded value, strings are decoded as utf-8 if
+        possible.
+    """
+    value, end = _rencode_decode(data, 0)
+    if end != len(data):
+        raise ValueError("Trailing data after rencoded value")
+    return value
+
+
+def _rencode_decode(data, pos):
+    """ Decodes the value at pos, returns the value and the end position. """
+    code = data[pos]
+    if _INT_POS_FIXED_START <= code < \
+            _INT_POS_FIXED_START + _INT_POS_FIXED_COUNT:
+        return code - _INT_POS_FIXED_START, pos + 1
+    elif _INT_NEG_FIXED_START <= code < \
+            _INT_NEG_FIXED_START + _INT_NEG_FIXED_COUNT:
+        return _INT_NEG_FIXED_START - 1 - code, pos + 1
+    elif code in _FIXED_FORMATS:
+        size = calcsize(_FIXED_FORMATS[code])
+        return unpack(_FIXED_FORMATS[code], data[pos + 1:pos + 1 + size])[0], \
+            pos + 1 + size
+    elif code == _CHR_INT:
+        end = data.index(_CHR_TERM, pos)
+        return int(data[pos + 1:end]), end + 1
+    elif code in (_CHR_TRUE, _CHR_FALSE, _CHR_NONE):
+        return {_CHR_TRUE: True, _CHR_FALSE: False}.get(code), pos + 1
+    elif _STR_FIXED_START <= code < _STR_FIXED_START + _STR_FIXED_COUNT:
+        end = pos + 1 + code - _STR_FIXED_START
+        return _decode_string(data[pos + 1:end]), end
+    elif 48 <= code <= 57:
+        # A long string prefixed with its length.
+        colon = data.index(b":", pos)
+        end = colon + 1 + int(data[pos:colon])
+        return _decode_string(data[colon + 1:end]), end
+    elif _LIST_FIXED_START <= code < _LIST_FIXED_START + _LIST_FIXED_COUNT:
+        items = []
+        pos += 1
+        for _ in range(code - _LIST_FIXED_START):
+            item, pos = _rencode_decode(data, pos)
+            items.append(item)
+        return tuple(items), pos
+    elif code == _CHR_LIST:
+        items = []
+        pos += 1
+        while data[pos] != _CHR_TERM:
+            item, pos = _rencode_decode(data, pos)
+            items.append(item)
+        return tuple(items), pos + 1
+    elif _DICT_FIXED_START <= code < _DICT_FIXED_START + _DICT_FIXED_COUNT:
+        items = {}
+        pos += 1
+        for _ in range(code - _DICT_FIXED_START):
+            key, pos = _rencode_decode(data, pos)
+            items[key], pos = _rencode_decode(data, pos)
+        return items, pos
+    elif code == _CHR_DICT:
+        items = {}
+        pos += 1
+        while data[pos] != _CHR_TERM:
+            key, pos = _rencode_decode(data, pos)
+            items[key], pos = _rencode_decode(data, pos)
+        return items, pos + 1
+    raise ValueError("Invalid rencode type code: {}".format(code))
+
+
+def _decode_string(value):
+    """ Decodes a rencoded string as utf-8, binary strings are kept. """
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        return value
@@ -11,18 +11,33 @@ class Flag(Enum):
     QUIET = 'quiet'
     COLOR = 'color'
     SAFEMODE = 'safemode'
+    VERIFY = 'verify'
+    REFLINK = 'reflink'
 
 
 class Option(Enum):
     """ Execution option identifiers. """
     VERSION = 'version'
     CRON = 'cron'
+    WATCH = 'watch'
     FORCE = 'force'
+    JOBS = 'jobs'
+    EXTRACT_JOBS = 'extract-jobs'
+    SNAPSHOT_TTL = 'snapshot-ttl'
     TV_SERIES = 'tv'
     MOVIE = 'movie'
+    DEDUPE = 'dedupe'
     CONFIG = 'config'
     MOVIE_DIR = 'movie-dir'
     TV_SERIES_DIR = 'tv-dir'
+    MOVIE_LINK_DIR = 'movie-link-dir'
+    TV_SERIES_LINK_DIR = 'tv-link-dir'
+    INDEX = 'index'
+    RESCAN = 'rescan'
+    LOG_JSON = 'log-json'
+    METRICS = 'metrics'
+    PROFILE = 'profile'
+    PROFILE_DUMP = 'profile-dump'
     HELP = 'help'
     SHOW_FLAGS = 'show-flags'
     SHOW_OPTIONS = 'show-options'
@@ -4,18 +4,94 @@ mediacleaner module:
 The main media-cleaner script.
 """
 from argparse import ArgumentParser, SUPPRESS
+from collections import OrderedDict
+from contextlib import nullcontext
+from os import path
 from time import strftime
 
-from delugetools import has_active_torrents
+from delugetools import get_active_torrent_paths, \
+    get_incomplete_torrent_paths, invalidate_torrent_snapshot
 from mediaargs import Flag, Option
+from mediaconfig import MediaConfig, load_config
+from mediaindex import TitleIndex
+from mediametrics import LibraryMetrics, write_textfile
+from mediaprofile import Profiler
+from mediawatch import watch_libraries
 from mediatools import log, TextType, clean_tv, log_err, clean_movie, \
-    get_value_from_yaml
+    json_log
 
 __version__ = "1.8"
 
+# The title index file name used next to the config file.
+_INDEX_FILE_NAME = "media-cleaner.db"
 
-def clean(flags, options):
-    """ Cleans libraries . """
+
+def clean(flags, options, config, busy_paths=(), profiler=None):
+    """ Cleans libraries with the config (MediaConfig), titles with busy
+        paths are skipped.
+        The phase times are added to the profiler (Profiler) if given.
+    """
+    _log_clean_header(flags, options)
+
+    with _open_index(options) as index:
+        _clean_libraries(flags, options, config, index, busy_paths,
+                         profiler)
+
+    # Check if in cron-mode and write extra log info.
+    if options[Option.CRON]:
+        log(flags, "-" * 30, TextType.INFO)
+
+
+def watch(flags, options, config, profiler=None):
+    """ Cleans libraries with the config (MediaConfig) and keeps cleaning
+        titles as they change.
+        The phase times are added to the profiler (Profiler) if given.
+    """
+    _log_clean_header(flags, options)
+    libraries = _get_libraries(options)
+
+    with _open_index(options) as index:
+        # Clean everything once before watching for changes.
+        busy_paths = _get_busy_paths(flags, options, waiting=True)
+        library_metrics = OrderedDict()
+        if busy_paths is not None:
+            library_metrics = _clean_libraries(flags, options, config, index,
+                                               busy_paths, profiler)
+        # The torrents may have changed while cleaning.
+        invalidate_torrent_snapshot()
+
+        def clean_titles(root_dir, title_names):
+            """ Cleans the changed titles, returns the paths changed by the
+                cleaning or None if postponed.
+            """
+            busy_paths = _get_busy_paths(flags, options, waiting=True)
+            if busy_paths is None:
+                return None
+            name, clean_library, link_dir = libraries[root_dir]
+            log(flags, "\nRunning {} cleanup script on: {} ({})".
+                format(name, root_dir, strftime("%a %Y-%m-%d %H:%M:%S")),
+                TextType.INFO)
+            metrics = LibraryMetrics(name)
+            changed_paths = clean_library(
+                flags, root_dir, index, title_names, options[Option.JOBS],
+                options[Option.EXTRACT_JOBS], options[Option.DEDUPE],
+                busy_paths, link_dir, metrics, config.classifier)
+            invalidate_torrent_snapshot()
+            library_metrics[root_dir] = metrics
+            if profiler is not None:
+                profiler.add_metrics(metrics)
+            _write_metrics(flags, options, library_metrics.values())
+            return changed_paths
+
+        log(flags, "Watching for changes", TextType.INFO)
+        try:
+            watch_libraries(list(libraries), clean_titles)
+        except KeyboardInterrupt:
+            log(flags, "Stopped watching for changes", TextType.INFO)
+
+
+def _log_clean_header(flags, options):
+    """ Logs the safemode state and finishes the log header. """
     # Check if safemode is enabled.
     if flags[Flag.SAFEMODE]:
         log(flags, "Safemode enabled, not changing any files",
@@ -28,34 +104,157 @@ def clean(flags, options):
     if options[Option.CRON]:
         log(flags, "-" * 30, TextType.INFO)
 
-    # Clean what was specified.
-    if options[Option.MOVIE]:
-        # Find the library path.
-        if options[Option.MOVIE_DIR] is not None:
-            root_dir = options[Option.MOVIE_DIR]
+
+def _get_busy_paths(flags, options, waiting=False):
+    """ Checks torrent activity, returns the content paths of the active
+        torrents to skip or None if cleaning can't start.
+        If all libraries are linked only unfinished torrents are skipped,
+        seeding torrents are left untouched by the linking.
+    """
+    # Check if torrent activity should be ignored.
+    if options[Option.FORCE]:
+        return set()
+
+    # Do torrent activity check.
+    try:
+        ttl = options[Option.SNAPSHOT_TTL]
+        if all(link_dir is not None
+               for _, _, link_dir in _get_libraries(options).values()):
+            busy_paths = get_incomplete_torrent_paths(ttl=ttl)
         else:
-            # Get path from yaml file.
-            root_dir = get_value_from_yaml(options[Option.CONFIG],
-                                           "path", "movie")
-        log(flags, "\nRunning movie cleanup script on: {}".format(root_dir),
-            TextType.INFO)
-        clean_movie(flags, root_dir)
+            busy_paths = get_active_torrent_paths(ttl=ttl)
+        if busy_paths is None:
+            log_err(flags, "There are still live torrents, {}".
+                    format("waiting" if waiting else "aborting"))
+        return busy_paths
+    except RuntimeError as err:
+        log_err(flags, err.args[0])
+        return None
+
+
+def _open_index(options):
+    """ Opens the title index, returns a null context if no index is used.
+    """
+    index_path = _get_index_path(options)
+    if index_path is not None:
+        return TitleIndex(index_path, options[Option.RESCAN])
+    else:
+        return nullcontext()
+
+
+def _open_json_log(options):
+    """ Opens the JSON-lines operation log, returns a null context if no
+        operations are logged.
+    """
+    if options[Option.LOG_JSON] is not None:
+        return json_log(options[Option.LOG_JSON])
+    else:
+        return nullcontext()
+
+
+def _open_profiler(options):
+    """ Opens the profiler, returns a null context if not profiling. """
+    if options[Option.PROFILE] or options[Option.PROFILE_DUMP] is not None:
+        return Profiler(options[Option.PROFILE_DUMP])
+    else:
+        return nullcontext()
+
+
+def _get_index_path(options):
+    """ Returns the title index path, None if no index is used. """
+    if options[Option.INDEX] is not None:
+        return options[Option.INDEX]
+    elif options[Option.CONFIG] is not None:
+        # Keep the index next to the config file.
+        return path.join(path.dirname(path.abspath(options[Option.CONFIG])),
+                         _INDEX_FILE_NAME)
+    else:
+        return None
+
+
+def _get_libraries(options):
+    """ Returns the libraries to clean as a dict of
+        root path -> (library name, clean function, link library path).
+        The link library path is None if the library isn't linked.
+    """
+    libraries = OrderedDict()
+    if options[Option.MOVIE]:
+        libraries[path.abspath(options[Option.MOVIE_DIR])] = (
+            "movie", clean_movie,
+            _get_link_dir(options[Option.MOVIE_LINK_DIR]))
 
     if options[Option.TV_SERIES]:
-        # Find the library path.
-        if options[Option.TV_SERIES_DIR] is not None:
-            root_dir = options[Option.TV_SERIES_DIR]
-        else:
-            # Get path from yaml file.
-            root_dir = get_value_from_yaml(options[Option.CONFIG], "path", "tv")
+        libraries[path.abspath(options[Option.TV_SERIES_DIR])] = (
+            "tv-series", clean_tv,
+            _get_link_dir(options[Option.TV_SERIES_LINK_DIR]))
+    return libraries
+
+
+def _load_config(flags, options):
+    """ Loads the config file once, returns the config (MediaConfig).
+        Settings given as arguments take precedence over the config file,
+        the missing arguments are set from it. Quits if the config file is
+        invalid.
+    """
+    config = MediaConfig()
+    if options[Option.CONFIG] is not None:
+        try:
+            config = load_config(options[Option.CONFIG])
+        except RuntimeError as err:
+            log_err(flags, err.args[0])
+            quit()
+
+    for option, value in ((Option.MOVIE_DIR, config.paths.get("movie")),
+                          (Option.TV_SERIES_DIR, config.paths.get("tv")),
+                          (Option.JOBS, config.jobs),
+                          (Option.EXTRACT_JOBS, config.extract_jobs),
+                          (Option.SNAPSHOT_TTL, config.snapshot_ttl)):
+        if options[option] is None:
+            options[option] = value
+    return config
+
+
+def _get_link_dir(link_dir):
+    """ Returns the absolute link library path, None if not linked. """
+    return path.abspath(link_dir) if link_dir is not None else None
 
-        log(flags, "\nRunning tv-series cleanup script on: {}".format(root_dir),
+
+def _clean_libraries(flags, options, config, index, busy_paths=(),
+                     profiler=None):
+    """ Cleans the specified libraries with the config (MediaConfig), titles
+        with busy paths are skipped.
+        Returns the metrics of each library by root path, their phase times
+        are added to the profiler (Profiler) if given.
+    """
+    library_metrics = OrderedDict()
+    # Clean what was specified.
+    for root_dir, (name, clean_library, link_dir) in \
+            _get_libraries(options).items():
+        log(flags, "\nRunning {} cleanup script on: {}".format(name, root_dir),
             TextType.INFO)
-        clean_tv(flags, root_dir)
+        library_metrics[root_dir] = LibraryMetrics(name)
+        clean_library(flags, root_dir, index, jobs=options[Option.JOBS],
+                      extract_jobs=options[Option.EXTRACT_JOBS],
+                      dedupe=options[Option.DEDUPE], busy_paths=busy_paths,
+                      link_dir=link_dir, metrics=library_metrics[root_dir],
+                      classifier=config.classifier)
+        if profiler is not None:
+            profiler.add_metrics(library_metrics[root_dir])
+    _write_metrics(flags, options, library_metrics.values())
+    return library_metrics
 
-    # Check if in cron-mode and write extra log info.
-    if options[Option.CRON]:
-        log(flags, "-" * 30, TextType.INFO)
+
+def _write_metrics(flags, options, library_metrics):
+    """ Writes the metrics of the last run of each library to the textfile
+        collector file, if enabled. Nothing is written in safemode.
+    """
+    if options[Option.METRICS] is None or flags[Flag.SAFEMODE]:
+        return
+    try:
+        write_textfile(options[Option.METRICS], library_metrics)
+    except OSError as err:
+        log_err(flags, "Error (OsError: {}) while writing metrics: {}".
+                format(err.errno, options[Option.METRICS]))
 
 
 ########################## Argument Parsing #############################
@@ -78,25 +277,77 @@ def parse_args_and_execute():
                         action='store_true', help='enables colored log output')
     parser.add_argument('-s', '--{}'.format(Flag.SAFEMODE.value),
                         action='store_true', help='disables any file changes')
+    parser.add_argument('--{}'.format(Flag.VERIFY.value),
+                        action='store_true',
+                        help='verify files moved across filesystems by '
+                             'checksum')
+    parser.add_argument('--{}'.format(Flag.REFLINK.value),
+                        action='store_true',
+                        help='link files by reflink where supported instead '
+                             'of hard link')
     parser.add_argument('-C', '--{}'.format(Option.CRON.value),
                         action='store_true',
                         help='enables cron mode with extra log output')
 
+    parser.add_argument('-w', '--{}'.format(Option.WATCH.value),
+                        action='store_true',
+                        help='keep running and clean titles as they change')
+
     parser.add_argument('-f', '--{}'.format(Option.FORCE.value),
                         action='store_true',
                         help='force clean and ignore torrent activity')
 
+    parser.add_argument('-j', '--{}'.format(Option.JOBS.value), type=int,
+                        help='number of titles to clean concurrently, '
+                             'defaults to 1')
+    parser.add_argument('--{}'.format(Option.EXTRACT_JOBS.value), type=int,
+                        help='number of archives to extract concurrently, '
+                             'defaults to one per device')
+    parser.add_argument('--{}'.format(Option.SNAPSHOT_TTL.value), type=int,
+                        help='seconds a torrent state check is reused, '
+                             'defaults to 10')
+
     parser.add_argument('-t', '--{}'.format(Option.TV_SERIES.value),
                         action='store_true', help='clean tv-series directory')
     parser.add_argument('-m', '--{}'.format(Option.MOVIE.value),
                         action='store_true', help='clean movie directory')
+    parser.add_argument('-d', '--{}'.format(Option.DEDUPE.value),
+                        action='store_true',
+                        help='remove main files with the same content as a '
+                             'file in another title')
     parser.add_argument('--{}'.format(Option.MOVIE_DIR.value),
                         help='path to movie directory')
     parser.add_argument('--{}'.format(Option.TV_SERIES_DIR.value),
                         help='path to tv-series directory')
+    parser.add_argument('--{}'.format(Option.MOVIE_LINK_DIR.value),
+                        help='link the movies into this directory and clean '
+                             'them there')
+    parser.add_argument('--{}'.format(Option.TV_SERIES_LINK_DIR.value),
+                        help='link the tv-series into this directory and '
+                             'clean them there')
 
     parser.add_argument('--{}'.format(Option.CONFIG.value),
-                        help='path to the yaml file containing media paths')
+                        help='path to the yaml file containing media paths '
+                             'and settings')
+    parser.add_argument('--{}'.format(Option.INDEX.value),
+                        help='path to the title index, defaults to a file '
+                             'next to the config file')
+    parser.add_argument('--{}'.format(Option.RESCAN.value),
+                        action='store_true',
+                        help='clean all titles, including unchanged ones')
+    parser.add_argument('--{}'.format(Option.LOG_JSON.value),
+                        help='append a JSON line for each executed operation '
+                             'to this file')
+    parser.add_argument('--{}'.format(Option.METRICS.value),
+                        help='write Prometheus metrics of each run to this '
+                             'textfile collector file')
+    parser.add_argument('--{}'.format(Option.PROFILE.value),
+                        action='store_true',
+                        help='print the time of each phase, hot function '
+                             'and filesystem call at the end of the run')
+    parser.add_argument('--{}'.format(Option.PROFILE_DUMP.value),
+                        help='profile and write cProfile stats of the main '
+                             'thread to this file')
 
     # Hidden options.
     parser.add_argument('--{}'.format(Option.SHOW_FLAGS.value),
@@ -108,16 +359,31 @@ def parse_args_and_execute():
     flags = {Flag.SAFEMODE: args.safemode,
              Flag.VERBOSE: args.verbose,
              Flag.QUIET: args.quiet,
-             Flag.COLOR: args.color}
+             Flag.COLOR: args.color,
+             Flag.VERIFY: args.verify,
+             Flag.REFLINK: args.reflink}
 
     options = {Option.VERSION: args.version,
                Option.CRON: args.cron,
+               Option.WATCH: args.watch,
                Option.FORCE: args.force,
+               Option.JOBS: args.jobs,
+               Option.EXTRACT_JOBS: args.extract_jobs,
+               Option.SNAPSHOT_TTL: args.snapshot_ttl,
                Option.TV_SERIES: args.tv,
                Option.MOVIE: args.movie,
+               Option.DEDUPE: args.dedupe,
                Option.CONFIG: args.config,
                Option.MOVIE_DIR: args.movie_dir,
                Option.TV_SERIES_DIR: args.tv_dir,
+               Option.MOVIE_LINK_DIR: args.movie_link_dir,
+               Option.TV_SERIES_LINK_DIR: args.tv_link_dir,
+               Option.INDEX: args.index,
+               Option.RESCAN: args.rescan,
+               Option.LOG_JSON: args.log_json,
+               Option.METRICS: args.metrics,
+               Option.PROFILE: args.profile,
+               Option.PROFILE_DUMP: args.profile_dump,
                Option.SHOW_FLAGS: args.show_flags,
                Option.SHOW_OPTIONS: args.show_options}
 
@@ -140,20 +406,50 @@ def parse_args_and_execute():
         # Always exit after listing options.
         quit()
 
+    # Load the config, the path and concurrency args default to it.
+    config = _load_config(flags, options)
+
     # Check path args.
-    if options[Option.TV_SERIES] and options[Option.TV_SERIES_DIR] is None and \
-            not options[Option.CONFIG]:
+    if options[Option.TV_SERIES] and options[Option.TV_SERIES_DIR] is None:
         log(flags, "No path set for tv library, see --{} or --{}".
             format(Option.TV_SERIES_DIR.value, Option.CONFIG.value),
             TextType.INFO)
         quit()
-    if options[Option.MOVIE] and options[Option.MOVIE_DIR] is None and \
-            not options[Option.CONFIG]:
+    if options[Option.MOVIE] and options[Option.MOVIE_DIR] is None:
         log(flags, "No path set for movie library, see --{} or --{}".
             format(Option.MOVIE_DIR.value, Option.CONFIG.value),
             TextType.INFO)
         quit()
 
+    # Check link args, the link state is kept in the index.
+    for root_dir, (name, _, link_dir) in _get_libraries(options).items():
+        if link_dir is None:
+            continue
+        elif _get_index_path(options) is None:
+            log(flags, "Linking requires a title index, see --{} or --{}".
+                format(Option.INDEX.value, Option.CONFIG.value),
+                TextType.INFO)
+            quit()
+        elif path.commonpath([root_dir, link_dir]) in (root_dir, link_dir):
+            log(flags, "The {} link directory can't overlap the library: {}".
+                format(name, link_dir), TextType.INFO)
+            quit()
+
+    # Check concurrency args.
+    if options[Option.JOBS] < 1:
+        log(flags, "The number of jobs must be at least 1, see --{}".
+            format(Option.JOBS.value), TextType.INFO)
+        quit()
+    if options[Option.EXTRACT_JOBS] is not None and \
+            options[Option.EXTRACT_JOBS] < 1:
+        log(flags, "The number of extract jobs must be at least 1, see --{}".
+            format(Option.EXTRACT_JOBS.value), TextType.INFO)
+        quit()
+    if options[Option.SNAPSHOT_TTL] < 0:
+        log(flags, "The torrent snapshot ttl can't be negative, see --{}".
+            format(Option.SNAPSHOT_TTL.value), TextType.INFO)
+        quit()
+
     # Check if in cron-mode and write extra log header info.
     if options[Option.CRON]:
         log(flags, "-" * 30, TextType.INFO)
@@ -165,19 +461,26 @@ def parse_args_and_execute():
     if options[Option.FORCE]:
         log(flags, "Force enabled, skipping torrent activity check",
             TextType.INFO)
-        # Start cleanup.
-        clean(flags, options)
-    else:
-        # Do torrent activity check and start cleanup.
-        try:
-            if has_active_torrents():
-                log_err(flags, "There are still live torrents, aborting")
-            else:
-                clean(flags, options)
-        except RuntimeError as err:
-            log_err(flags, err.args[0])
+
+    # Start cleanup.
+    with _open_json_log(options), _open_profiler(options) as profiler:
+        if options[Option.WATCH]:
+            try:
+                watch(flags, options, config, profiler)
+            except RuntimeError as err:
+                log_err(flags, err.args[0])
+        else:
+            busy_paths = _get_busy_paths(flags, options)
+            if busy_paths is not None:
+                clean(flags, options, config, busy_paths, profiler)
+
+    # Print the profile of the run.
+    if profiler is not None:
+        for line in profiler.format_report():
+            log(flags, line, TextType.INFO)
 
 
 ############################ Start script ###############################
 #########################################################################
-parse_args_and_execute()
+if __name__ == "__main__":
+    parse_args_and_execute()
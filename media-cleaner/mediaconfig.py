@@ -0,0 +1,118 @@
+"""
+mediaconfig module:
+Contains the configuration read once from the yaml config file.
+"""
+from yaml import YAMLError, load
+
+# The C accelerated safe loader, not available without libyaml.
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
+from delugetools import SNAPSHOT_TTL
+from mediatools import MediaClassifier
+
+# The MediaClassifier arguments by config key of each section.
+_SIZE_KEYS = {"min-video": "min_video_size",
+              "min-main-video": "min_main_video_size",
+              "sort-increment": "size_sort_increment"}
+_SUFFIX_KEYS = {"video": "video_suffixes",
+                "subtitle": "subtitle_suffixes",
+                "music": "music_suffixes"}
+
+# The library path keys.
+_PATH_KEYS = ("movie", "tv")
+
+
+class MediaConfig(object):
+    """ The library paths, file classification, concurrency and torrent
+        check settings.
+        Settings missing in the config file keep their defaults.
+    """
+
+    def __init__(self, paths=None, classifier=None, jobs=1,
+                 extract_jobs=None, snapshot_ttl=SNAPSHOT_TTL):
+        # Library root paths by library key ("movie", "tv").
+        self.paths = paths if paths is not None else {}
+        # The MediaClassifier with the size thresholds and suffixes.
+        self.classifier = classifier if classifier is not None \
+            else MediaClassifier()
+        self.jobs = jobs
+        self.extract_jobs = extract_jobs
+        # Seconds a torrent state snapshot is shared between checks.
+        self.snapshot_ttl = snapshot_ttl
+
+
+def load_config(file_path):
+    """ Reads a yaml config file into a MediaConfig.
+        Raises RuntimeError if the file can't be read or holds an invalid
+        setting.
+    """
+    try:
+        with open(file_path, 'r') as file_:
+            doc = load(file_, Loader=_SafeLoader)
+    except OSError as err:
+        raise RuntimeError("Error (OsError: {}) while reading config: {}".
+                           format(err.errno, file_path))
+    except YAMLError:
+        raise RuntimeError("Error (YAMLError) while parsing config: {}".
+                           format(file_path))
+
+    doc = doc if doc is not None else {}
+    if not isinstance(doc, dict):
+        raise RuntimeError("Invalid config, expected a mapping: {}".
+                           format(file_path))
+
+    paths = _get_section(doc, "path", _PATH_KEYS, str)
+    classifier_args = {}
+    for arg, value in _get_section(doc, "size", _SIZE_KEYS, int,
+                                   1).items():
+        classifier_args[_SIZE_KEYS[arg]] = value
+    for arg, value in _get_section(doc, "suffix", _SUFFIX_KEYS,
+                                   list).items():
+        classifier_args[_SUFFIX_KEYS[arg]] = [str(suffix)
+                                              for suffix in value]
+    return MediaConfig(paths, MediaClassifier(**classifier_args),
+                       _get_value(doc, "jobs", int, 1, minimum=1),
+                       _get_value(doc, "extract-jobs", int, minimum=1),
+                       _get_value(doc, "snapshot-ttl", int, SNAPSHOT_TTL,
+                                  minimum=0))
+
+
+def _get_section(doc, section, keys, type_, minimum=None):
+    """ Returns the settings of a config section as a dict, empty if
+        missing. Raises RuntimeError for unknown keys or values of the wrong
+        type or below minimum.
+    """
+    values = doc.get(section)
+    if values is None:
+        return {}
+    elif not isinstance(values, dict):
+        raise RuntimeError("Invalid config section, expected a mapping: {}".
+                           format(section))
+    for key in values:
+        if key not in keys:
+            raise RuntimeError("Unknown config setting: {}.{}".
+                               format(section, key))
+        _get_value(values, key, type_, name="{}.{}".format(section, key),
+                   minimum=minimum)
+    return values
+
+
+def _get_value(doc, key, type_, default=None, name=None, minimum=None):
+    """ Returns a config value checked by type and minimum, default if
+        missing. Raises RuntimeError for values of the wrong type or below
+        minimum.
+    """
+    value = doc.get(key)
+    if value is None:
+        return default
+    # Booleans are ints to isinstance but never a valid number.
+    elif not isinstance(value, type_) or isinstance(value, bool):
+        raise RuntimeError("Invalid config setting, expected {}: {}".format(
+            type_.__name__, name or key))
+    elif minimum is not None and value < minimum:
+        raise RuntimeError("Invalid config setting, expected at least {}: {}".
+                           format(minimum, name or key))
+    return value
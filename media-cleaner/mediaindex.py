@@ -0,0 +1,175 @@
+"""
+mediaindex module:
+Contains a persistent index of cleaned library titles, file content
+hashes and linked files.
+"""
+import sqlite3
+from os import path, scandir, stat
+
+
+class TitleIndex(object):
+    """ Fingerprints of cleaned titles stored in a SQLite database.
+        A fingerprint is the (inode, mtime, size) of a title directory, the
+        mtimes of the directories in its tree are stored with it. Titles
+        with an unchanged fingerprint and directory mtimes don't need to be
+        cleaned again.
+        Content hashes of files are cached by file fingerprint and the files
+        linked into a link library are recorded by path and fingerprint.
+    """
+
+    def __init__(self, db_path, rescan=False):
+        """ Opens or creates the index database.
+
+        :param db_path: path to the SQLite database file
+        :param rescan: treat all titles as changed but keep updating the index
+        """
+        self.rescan = rescan
+        self._conn = sqlite3.connect(db_path)
+        # Titles indexed without their directory mtimes are cleaned again.
+        has_dirs = self._conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND "
+            "name = 'dirs'").fetchone() is not None
+        self._conn.execute("CREATE TABLE IF NOT EXISTS titles ("
+                           "path TEXT PRIMARY KEY, inode INTEGER, "
+                           "mtime REAL, size INTEGER)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS dirs ("
+                           "title TEXT, path TEXT, mtime REAL, "
+                           "PRIMARY KEY (title, path))")
+        if not has_dirs:
+            self._conn.execute("DELETE FROM titles")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                           "inode INTEGER, mtime REAL, size INTEGER, "
+                           "partial BLOB, full BLOB, "
+                           "PRIMARY KEY (inode, mtime, size))")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS links ("
+                           "path TEXT PRIMARY KEY, inode INTEGER, "
+                           "mtime REAL, size INTEGER)")
+        # Load all fingerprints at once, a lookup per title is too slow.
+        self._fingerprints = {
+            row[0]: tuple(row[1:]) for row in
+            self._conn.execute("SELECT path, inode, mtime, size FROM titles")}
+        # The directory mtimes of each title by path relative to the title.
+        self._dirs = {}
+        for title, dir_path, mtime in self._conn.execute(
+                "SELECT title, path, mtime FROM dirs"):
+            self._dirs.setdefault(title, {})[dir_path] = mtime
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def is_unchanged(self, title_path):
+        """ Checks if a title is unchanged since it was last cleaned.
+            Files added, removed or renamed anywhere in the tree change the
+            mtime of their directory, only the stored directories are
+            stat'ed and none are read.
+        """
+        if self.rescan or title_path not in self._fingerprints:
+            return False
+        try:
+            if self._fingerprints[title_path] != _get_fingerprint(title_path):
+                return False
+            for dir_path, mtime in self._dirs.get(title_path, {}).items():
+                if stat(path.join(title_path, dir_path)).st_mtime != mtime:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def update(self, title_path):
+        """ Stores the current fingerprint and directory mtimes of a cleaned
+            title, walking its tree once.
+            Titles that no longer exist are removed from the index.
+        """
+        try:
+            fingerprint = _get_fingerprint(title_path)
+            dirs = _get_dir_mtimes(title_path)
+        except OSError:
+            self.remove(title_path)
+            return
+        self.remove(title_path)
+        self._fingerprints[title_path] = fingerprint
+        self._dirs[title_path] = dirs
+        self._conn.execute("INSERT INTO titles VALUES (?, ?, ?, ?)",
+                           (title_path,) + fingerprint)
+        self._conn.executemany("INSERT INTO dirs VALUES (?, ?, ?)",
+                               [(title_path, dir_path, mtime)
+                                for dir_path, mtime in dirs.items()])
+
+    def remove(self, title_path):
+        """ Removes a title from the index. """
+        self._dirs.pop(title_path, None)
+        if self._fingerprints.pop(title_path, None) is not None:
+            self._conn.execute("DELETE FROM titles WHERE path = ?",
+                               (title_path,))
+            self._conn.execute("DELETE FROM dirs WHERE title = ?",
+                               (title_path,))
+
+    def get_hash(self, fingerprint, full=False):
+        """ Returns the cached partial or full content hash of a file,
+            None if not cached.
+        """
+        row = self._conn.execute(
+            "SELECT {} FROM hashes WHERE inode = ? AND mtime = ? AND "
+            "size = ?".format("full" if full else "partial"),
+            tuple(fingerprint)).fetchone()
+        return row[0] if row is not None else None
+
+    def store_hash(self, fingerprint, hash_, full=False):
+        """ Caches the partial or full content hash of a file. """
+        self._conn.execute("INSERT OR IGNORE INTO hashes (inode, mtime, size) "
+                           "VALUES (?, ?, ?)", tuple(fingerprint))
+        self._conn.execute(
+            "UPDATE hashes SET {} = ? WHERE inode = ? AND mtime = ? AND "
+            "size = ?".format("full" if full else "partial"),
+            (hash_,) + tuple(fingerprint))
+
+    def is_linked(self, file_path, fingerprint):
+        """ Checks if a file has been linked since it last changed.
+            Links are kept when rescanning, so links removed by the cleaning
+            aren't made again.
+        """
+        row = self._conn.execute(
+            "SELECT inode, mtime, size FROM links WHERE path = ?",
+            (file_path,)).fetchone()
+        return row == tuple(fingerprint)
+
+    def store_link(self, file_path, fingerprint):
+        """ Records that a file has been linked. """
+        self._conn.execute("INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?)",
+                           (file_path,) + tuple(fingerprint))
+
+    def commit(self):
+        """ Commits all updates to the database. """
+        self._conn.commit()
+
+    def close(self):
+        """ Commits all updates and closes the database. """
+        self.commit()
+        self._conn.close()
+
+
+def _get_fingerprint(title_path):
+    """ Returns the fingerprint of a title directory.
+        Raises OSError if it can't be read.
+    """
+    stat_ = stat(title_path)
+    return stat_.st_ino, stat_.st_mtime, stat_.st_size
+
+
+def _get_dir_mtimes(title_path):
+    """ Returns the mtimes of the directories below a title by path relative
+        to the title. Raises OSError if the tree can't be read.
+    """
+    dirs = {}
+    pending = [title_path]
+    while pending:
+        with scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs[path.relpath(entry.path, title_path)] = \
+                        entry.stat(follow_symlinks=False).st_mtime
+                    pending.append(entry.path)
+    return dirs
@@ -0,0 +1,105 @@
+"""
+mediametrics module:
+Contains metrics of library cleaning runs and their export as a Prometheus
+textfile collector file.
+"""
+from collections import OrderedDict
+from os import replace
+from time import monotonic, time
+
+# The prefix of all exported metric names.
+_METRIC_PREFIX = "media_cleaner_"
+
+
+class LibraryMetrics(object):
+    """ Wall time per phase, operation counts and bytes of a run cleaning a
+        library. A phase lasts until the next phase is started or the run
+        is finished.
+    """
+
+    def __init__(self, library):
+        self.library = library
+        # Unix time the run finished, None until finished.
+        self.finished = None
+        # Seconds by phase name, in the order the phases were started.
+        self.phases = OrderedDict()
+        # Operation counts and bytes by operation name.
+        self.operations = {}
+        self.bytes = {}
+        # The current phase and when it was started.
+        self._phase = None
+        self._started = None
+
+    def start_phase(self, name):
+        """ Ends the current phase and starts timing another. """
+        self._end_phase()
+        self._phase, self._started = name, monotonic()
+
+    def add_operations(self, name, count, size=0):
+        """ Adds executed operations moving, extracting or deleting size
+            bytes.
+        """
+        self.operations[name] = self.operations.get(name, 0) + count
+        self.bytes[name] = self.bytes.get(name, 0) + size
+
+    def finish(self):
+        """ Ends the current phase and marks the run as finished. """
+        self._end_phase()
+        self.finished = time()
+
+    def _end_phase(self):
+        """ Adds the time of the current phase, if any. """
+        if self._phase is not None:
+            self.phases[self._phase] = self.phases.get(self._phase, 0.0) + \
+                monotonic() - self._started
+            self._phase = None
+
+
+def write_textfile(file_path, library_metrics):
+    """ Writes the metrics of libraries in the Prometheus text format.
+        The file is replaced at once so the collector never reads it half
+        written.
+    """
+    lines = []
+    _add_metric(lines, "phase_seconds",
+                "Wall time of each cleaning phase in the last run.",
+                [({"library": metrics.library, "phase": phase}, seconds)
+                 for metrics in library_metrics
+                 for phase, seconds in metrics.phases.items()])
+    _add_metric(lines, "operations",
+                "Operations executed in the last run.",
+                [({"library": metrics.library, "operation": name}, count)
+                 for metrics in library_metrics
+                 for name, count in sorted(metrics.operations.items())])
+    _add_metric(lines, "operation_bytes",
+                "Bytes moved, linked, extracted or deleted in the last run.",
+                [({"library": metrics.library, "operation": name}, size)
+                 for metrics in library_metrics
+                 for name, size in sorted(metrics.bytes.items())])
+    _add_metric(lines, "last_run_timestamp_seconds",
+                "Unix time the last run finished.",
+                [({"library": metrics.library}, metrics.finished)
+                 for metrics in library_metrics
+                 if metrics.finished is not None])
+
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'w') as file_:
+        file_.write("\n".join(lines) + "\n")
+    replace(temp_path, file_path)
+
+
+def _add_metric(lines, name, help_, samples):
+    """ Adds the lines of a gauge with its samples as (labels, value). """
+    name = _METRIC_PREFIX + name
+    lines.append("# HELP {} {}".format(name, help_))
+    lines.append("# TYPE {} gauge".format(name))
+    for labels, value in samples:
+        lines.append("{}{{{}}} {}".format(
+            name, ",".join('{}="{}"'.format(key, _escape_label(label))
+                           for key, label in labels.items()), value))
+
+
+def _escape_label(value):
+    """ Escapes a label value for the text format. """
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace(
+        "\n", "\\n")
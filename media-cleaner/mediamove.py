@@ -0,0 +1,223 @@
+"""
+mediamove module:
+Contains functions for moving files and directories across filesystems and
+for linking files.
+"""
+from errno import EXDEV, EBADF, EINVAL, ENOSYS, ENOTTY, EOPNOTSUPP, EIO
+from fcntl import ioctl
+from hashlib import blake2b
+from os import makedirs, removedirs, rename, remove, rmdir, walk, lseek, \
+    ftruncate, link, stat, fstat, path, getxattr, setxattr, removexattr, \
+    open as open_fd, close, O_RDONLY, O_WRONLY, O_CREAT, O_EXCL, SEEK_SET, \
+    SEEK_END
+from shutil import copystat
+
+# The in-kernel copy calls, not available on every platform.
+try:
+    from os import copy_file_range
+except ImportError:
+    copy_file_range = None
+try:
+    from os import sendfile
+except ImportError:
+    sendfile = None
+
+# Files are copied to the target path with this suffix and renamed once
+# complete, an interrupted copy is resumed from the size of this file.
+# Unlike the .part files of torrent clients leftovers are cleaned.
+PARTIAL_SUFFIX = ".mediacleaner-part"
+
+# The extended attribute of a partial copy holding the identity of its
+# source, a partial copy is only resumed for the same unchanged source.
+_SOURCE_XATTR = "user.mediacleaner.source"
+
+# Bytes copied in the kernel per system call.
+_COPY_CHUNK_SIZE = 67108864
+
+# Bytes read per block when verifying by checksum.
+_VERIFY_READ_SIZE = 1048576
+
+# The FICLONE ioctl sharing the data of a file, see ioctl_ficlone(2).
+_FICLONE = 0x40049409
+
+# Errors from FICLONE that mean a hard link should be used instead.
+_NO_REFLINK_ERRORS = (EXDEV, EINVAL, ENOTTY, EOPNOTSUPP)
+
+# Errors from copy_file_range that mean sendfile should be used instead.
+_NO_COPY_RANGE_ERRORS = (EXDEV, EBADF, EINVAL, ENOSYS, EOPNOTSUPP)
+
+
+def renames(old, new, verify=False):
+    """ Moves a file or directory like os.renames, creating the parent
+        directories of the new path and removing empty ones of the old path.
+        Moves across filesystems are done by copying, see move.
+    """
+    head, tail = path.split(new)
+    if head and tail and not path.exists(head):
+        makedirs(head)
+    move(old, new, verify)
+    head, tail = path.split(old)
+    if head and tail:
+        try:
+            removedirs(head)
+        except OSError:
+            pass
+
+
+def replace(old, new, verify=False):
+    """ Moves a file like os.replace, overwriting an existing file.
+        Moves across filesystems are done by copying, see move.
+    """
+    move(old, new, verify)
+
+
+def move(source, target, verify=False):
+    """ Renames a file or directory, copies it if the target is on another
+        filesystem. Copied files are checked by size, and by checksum if
+        verify is set, before the source is removed.
+        Directories are moved file by file, merging into the target.
+    """
+    try:
+        rename(source, target)
+    except OSError as err:
+        if err.errno != EXDEV:
+            raise
+        if path.isdir(source):
+            _move_tree(source, target, verify)
+        else:
+            _move_file(source, target, verify)
+
+
+def link_file(source, target, reflink=False):
+    """ Links a file to a new path, creating the parent directories.
+        With reflink the data is shared by a copy-on-write clone where the
+        filesystem supports it, a hard link is made otherwise.
+    """
+    head = path.dirname(target)
+    if head and not path.exists(head):
+        makedirs(head)
+    if not reflink or not _clone_file(source, target):
+        link(source, target)
+
+
+def _clone_file(source, target):
+    """ Clones a file with FICLONE, returns False if not supported. """
+    source_fd = open_fd(source, O_RDONLY)
+    try:
+        target_fd = open_fd(target, O_WRONLY | O_CREAT | O_EXCL, 0o644)
+        try:
+            ioctl(target_fd, _FICLONE, source_fd)
+        except OSError as err:
+            close(target_fd)
+            remove(target)
+            if err.errno not in _NO_REFLINK_ERRORS:
+                raise
+            return False
+        close(target_fd)
+    finally:
+        close(source_fd)
+    copystat(source, target)
+    return True
+
+
+def _move_tree(source, target, verify):
+    """ Moves a directory tree to another filesystem file by file. """
+    for dir_path, _, files in walk(source):
+        target_dir = path.join(target, path.relpath(dir_path, source))
+        makedirs(target_dir, exist_ok=True)
+        for file_ in files:
+            _move_file(path.join(dir_path, file_),
+                       path.join(target_dir, file_), verify)
+
+    # Remove the emptied source directories bottom up.
+    for dir_path, _, _ in walk(source, topdown=False):
+        rmdir(dir_path)
+
+
+def _move_file(source, target, verify):
+    """ Moves a file to another filesystem by copying it in the kernel.
+        The copy is resumed if a partial copy of the same source exists.
+    """
+    partial = target + PARTIAL_SUFFIX
+    source_fd = open_fd(source, O_RDONLY)
+    try:
+        stat_ = fstat(source_fd)
+        size = stat_.st_size
+        target_fd = open_fd(partial, O_WRONLY | O_CREAT, 0o644)
+        try:
+            # Continue after the data copied before an interruption.
+            offset = _get_resume_offset(target_fd, "{}:{}:{}:{}".format(
+                stat_.st_dev, stat_.st_ino, size, stat_.st_mtime_ns).encode())
+            _copy_range(source_fd, target_fd, offset, size)
+        finally:
+            close(target_fd)
+    finally:
+        close(source_fd)
+
+    if stat(partial).st_size != size or \
+            verify and _get_checksum(source) != _get_checksum(partial):
+        remove(partial)
+        raise OSError(EIO, "Copy verification failed", source)
+
+    copystat(source, partial)
+    try:
+        removexattr(partial, _SOURCE_XATTR)
+    except OSError:
+        pass
+    rename(partial, target)
+    remove(source)
+
+
+def _get_resume_offset(target_fd, identity):
+    """ Returns the size of a partial copy of the source with the identity,
+        a partial copy of another or a changed source is truncated.
+        Copies are only resumed on filesystems with extended attributes.
+    """
+    try:
+        if getxattr(target_fd, _SOURCE_XATTR) == identity:
+            return lseek(target_fd, 0, SEEK_END)
+    except OSError:
+        pass
+    ftruncate(target_fd, 0)
+    try:
+        setxattr(target_fd, _SOURCE_XATTR, identity)
+    except OSError:
+        # Not supported, the copy is never resumed.
+        pass
+    return 0
+
+
+def _copy_range(source_fd, target_fd, offset, size):
+    """ Copies the source from offset to size to the same offset in the
+        target without passing the data through Python.
+        copy_file_range is used if supported, sendfile otherwise.
+    """
+    use_copy_range = copy_file_range is not None
+    while offset < size:
+        count = min(_COPY_CHUNK_SIZE, size - offset)
+        if use_copy_range:
+            try:
+                copied = copy_file_range(source_fd, target_fd, count,
+                                         offset, offset)
+            except OSError as err:
+                if err.errno not in _NO_COPY_RANGE_ERRORS:
+                    raise
+                use_copy_range = False
+                continue
+        elif sendfile is not None:
+            lseek(target_fd, offset, SEEK_SET)
+            copied = sendfile(target_fd, source_fd, offset, count)
+        else:
+            raise OSError(ENOSYS, "No in-kernel copy available", source_fd)
+        if copied == 0:
+            raise OSError(EIO, "Source file shrunk while copying")
+        offset += copied
+
+
+def _get_checksum(file_path):
+    """ Returns the checksum of a file's content. """
+    checksum = blake2b()
+    with open(file_path, 'rb') as file_:
+        for block in iter(lambda: file_.read(_VERIFY_READ_SIZE), b""):
+            checksum.update(block)
+    return checksum.digest()
@@ -0,0 +1,158 @@
+"""
+mediaprofile module:
+Contains the profiling of cleaning runs, timing the hot functions and the
+filesystem calls of the cleaning modules while a Profiler is active.
+"""
+from cProfile import Profile
+from functools import wraps
+from os import path
+from threading import Lock, local
+from time import perf_counter
+
+import delugetools
+import mediaindex
+import mediamove
+import mediatools
+
+# The timed functions by owning module or class.
+_TIMED_FUNCTIONS = [
+    (delugetools, ["_call_daemon", "_has_active_torrents_console"]),
+    (mediatools, ["_link_library", "_scan_library", "_scan_title",
+                  "_extract_and_clean_archives", "_execute_extractions",
+                  "_find_library_duplicates", "_hash_file",
+                  "_clean_tv_main_file", "_clean_movie_main_file",
+                  "_parse_release_name", "_execute_plan", "_move_file_dir",
+                  "_remove_file", "_remove_dir", "_link_file",
+                  "_plan_empty_folder_pruning", "_update_index",
+                  # Imported by name from mediamove.
+                  "link_file", "renames", "replace"]),
+    (mediaindex.TitleIndex, ["is_unchanged", "update", "get_hash",
+                             "store_hash", "commit"])]
+
+# The modules whose os functions are timed as filesystem calls.
+_FILESYSTEM_MODULES = [mediatools, mediamove, mediaindex]
+
+# The os.path functions that stat a path, timed as filesystem calls in every
+# module.
+_PATH_FUNCTIONS = ["exists", "lexists", "isdir", "isfile", "islink",
+                   "getsize", "getmtime"]
+
+# The names of the timed functions running in each thread, nested calls
+# of a running function only add to its call count.
+_RUNNING = local()
+
+
+class Profiler(object):
+    """ Times the hot functions and filesystem calls of the cleaning while
+        in the context, optionally with a cProfile dump of the main thread.
+        The functions are only replaced by timed ones while in the context,
+        nothing is timed otherwise.
+    """
+
+    def __init__(self, dump_path=None):
+        self.dump_path = dump_path
+        # Wall seconds in the context.
+        self.wall = 0.0
+        # Seconds by (library, phase) of the cleaned libraries.
+        self.phases = {}
+        # [calls, seconds] by function and by filesystem call name.
+        self.functions = {}
+        self.filesystem_calls = {}
+        self._lock = Lock()
+        self._replaced = []
+        self._profile = None
+        self._started = None
+
+    def __enter__(self):
+        for owner, names in _TIMED_FUNCTIONS:
+            for name in names:
+                self._replace(owner, name, self.functions,
+                              "{}.{}".format(owner.__name__, name))
+        for module in _FILESYSTEM_MODULES:
+            for name, func in list(vars(module).items()):
+                if callable(func) and getattr(func, "__module__", None) in \
+                        ("posix", "os"):
+                    self._replace(module, name, self.filesystem_calls, name)
+        for name in _PATH_FUNCTIONS:
+            self._replace(path, name, self.filesystem_calls,
+                          "path.{}".format(name))
+        if self.dump_path is not None:
+            self._profile = Profile()
+            self._profile.enable()
+        self._started = perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.wall += perf_counter() - self._started
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.dump_path)
+            self._profile = None
+        for owner, name, func in reversed(self._replaced):
+            setattr(owner, name, func)
+        self._replaced = []
+
+    def add_metrics(self, metrics):
+        """ Adds the phase times of a cleaned library (LibraryMetrics). """
+        for phase, seconds in metrics.phases.items():
+            key = (metrics.library, phase)
+            self.phases[key] = self.phases.get(key, 0.0) + seconds
+
+    def format_report(self):
+        """ Returns the lines of the profile, sorted by time. """
+        lines = ["Profile, {:.3f}s wall time".format(self.wall)]
+        if self.phases:
+            lines.append("{:<40} {:>10}".format("phase", "seconds"))
+            for (library, phase), seconds in sorted(
+                    self.phases.items(), key=lambda item: -item[1]):
+                lines.append("{:<40} {:>10.3f}".format(
+                    "{} {}".format(library, phase), seconds))
+        lines.extend(_format_calls("function", self.functions))
+        lines.extend(_format_calls("filesystem call", self.filesystem_calls))
+        return lines
+
+    def _replace(self, owner, name, stats, stat_name):
+        """ Replaces a function of a module or class by a timed one. """
+        func = vars(owner).get(name)
+        if func is None:
+            return
+        self._replaced.append((owner, name, func))
+        setattr(owner, name, self._make_timed(func, stats, stat_name))
+
+    def _make_timed(self, func, stats, name):
+        """ Returns func adding its calls and time to stats. """
+
+        @wraps(func)
+        def timed(*args, **kwargs):
+            """ Times the call of func. """
+            running = getattr(_RUNNING, "names", None)
+            if running is None:
+                running = _RUNNING.names = set()
+            nested = name in running
+            running.add(name)
+            started = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = 0.0 if nested else perf_counter() - started
+                if not nested:
+                    running.discard(name)
+                with self._lock:
+                    stat = stats.setdefault(name, [0, 0.0])
+                    stat[0] += 1
+                    stat[1] += elapsed
+
+        return timed
+
+
+def _format_calls(title, stats):
+    """ Returns the lines of a table of calls, sorted by time. """
+    if not stats:
+        return []
+    lines = ["{:<40} {:>10} {:>10} {:>10}".format(title, "calls", "seconds",
+                                                  "us/call")]
+    for name, (calls, seconds) in sorted(stats.items(),
+                                         key=lambda item: -item[1][1]):
+        lines.append("{:<40} {:>10} {:>10.3f} {:>10.1f}".format(
+            name, calls, seconds, seconds / calls * 1e6))
+    return lines
@@ -3,267 +3,557 @@ mediatools module:
 Contains various media and io functions.
 """
 
-from os import path, listdir, walk, renames, remove, rmdir, replace
-from re import match, search, sub
+from atexit import register
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, \
+    ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, nullcontext
+from os import path, walk, makedirs, remove, rmdir, scandir, stat, utime
+from enum import Enum
+from functools import lru_cache
+from hashlib import blake2b
+from shutil import copyfileobj
+from heapq import heapify, heappop, heappush
+from itertools import zip_longest
+from json import dumps
+from re import sub, compile as compile_regex
+from stat import S_ISDIR
+from sys import stdout
+from threading import Lock, local
+from time import mktime, monotonic, time
 import rarfile
 from rarfile import RarFile
-from yaml import load
 
 from mediaargs import Flag
+from mediametrics import LibraryMetrics
+from mediamove import PARTIAL_SUFFIX, link_file, renames, replace
 
 
 ##########################################################
 ################## Cleaning Procedures ###################
 
 
-def clean_movie(flags, root_dir):
-    """ Cleans a movie library. """
-
-    # Setup a new operation counter for tv-series cleaning.
-    # Extract and clean any archives.
-    op_counter = _extract_and_clean_archives(flags, root_dir)
-
-    # Sort and cleanup.
-    for movie_name in listdir(root_dir):
+def clean_movie(flags, root_dir, index=None, title_names=None, jobs=1,
+                extract_jobs=None, dedupe=False, busy_paths=(),
+                link_dir=None, metrics=None, classifier=None):
+    """ Cleans a movie library.
+        Titles that are unchanged in the index (TitleIndex) are skipped,
+        title_names limits the cleaning to the given titles.
+        Up to jobs titles are scanned and cleaned concurrently and up to
+        extract_jobs archives extracted, by default one per device.
+        With dedupe main files with the same content as a file in another
+        title are removed as well. Titles holding any of the busy paths,
+        like the content of active torrents, are left untouched.
+        With link_dir the titles are linked into the link library and
+        cleaned there instead, the files in the root are never changed.
+        The time of each phase, the operations and their bytes are added to
+        metrics (LibraryMetrics) if given. Files are classified by the
+        classifier (MediaClassifier), by default with the default sizes and
+        suffixes.
+        Returns the paths changed by the cleaning.
+    """
+    metrics = metrics if metrics is not None else LibraryMetrics(root_dir)
+    classifier = classifier if classifier is not None else _CLASSIFIER
+    busy_titles = _get_busy_titles(flags, root_dir, busy_paths)
+    if busy_titles is None:
+        return []
+
+    if link_dir is not None:
+        metrics.start_phase("link")
+        _link_library(flags, root_dir, link_dir, metrics, index, title_names,
+                      jobs, busy_titles)
+        if not path.isdir(link_dir):
+            # Nothing has been linked yet in safemode.
+            _finish_cleanup(flags, _OperationPlan(link_dir), metrics)
+            return []
+        root_dir, busy_titles = link_dir, ()
+
+    # Scan the library once, extract and clean any archives.
+    metrics.start_phase("scan")
+    titles, skipped_titles = _scan_library(root_dir, index, title_names, jobs,
+                                           busy_titles)
+    metrics.start_phase("extract")
+    titles = _extract_and_clean_archives(flags, root_dir, titles, metrics,
+                                         jobs, extract_jobs, classifier,
+                                         "movie")
+    duplicates = {}
+    if dedupe:
+        metrics.start_phase("dedupe")
+        duplicates = _find_library_duplicates(titles, skipped_titles, index,
+                                              jobs, classifier)
+
+    # Plan the sorting and cleanup.
+    metrics.start_phase("classify")
+    plan = _OperationPlan(root_dir)
+    # Busy titles by case-insensitive name, like the plan compares titles.
+    busy_names = {title.lower() for title in busy_titles}
+    main_files = {}
+    cleaned_titles = {}
+    for entry, tree in titles:
+        movie_name = entry.name
 
         # Extract the cleaned movie directory name.
-        cleaned_movie_name = _get_clean_movie_dir_name(movie_name,
-                                                       path.join(root_dir,
-                                                                 movie_name))
+        cleaned_movie_name = _get_clean_movie_dir_name(movie_name, tree,
+                                                       classifier)
+
+        # The planned movie directory path.
+        current_dir = path.join(root_dir, cleaned_movie_name)
+        if _is_busy_title(flags, current_dir, busy_names):
+            continue
+        cleaned_titles[entry.full_path] = current_dir
+        _include_skipped_title(titles, skipped_titles, current_dir)
 
         # Try to clean the movie directory or file.
-        if path.isfile(path.join(root_dir, movie_name)):
-            log(flags, "Found movie file in root directory: " + movie_name)
-            op_counter = _merge_op_counts(op_counter,
-                                          _move_file_dir(
-                                              flags, path.join(root_dir,
-                                                               movie_name),
-                                              path.join(root_dir,
-                                                        cleaned_movie_name,
-                                                        movie_name),
-                                              "movie"))
+        if not entry.is_dir:
+            log(flags, "Found movie file in root directory: {}",
+                TextType.STD, movie_name)
+            new_path = path.join(current_dir, movie_name)
         else:
-            op_counter = _merge_op_counts(op_counter,
-                                          _move_file_dir(
-                                              flags,
-                                              path.join(root_dir,
-                                                        movie_name),
-                                              path.join(root_dir,
-                                                        cleaned_movie_name),
-                                              "movie"))
-
-        # Update path in case directory has been renamed or the file moved.
-        if not flags[Flag.SAFEMODE]:
-            movie_name = cleaned_movie_name
-
-        # Update the current directory path.
-        current_dir = path.join(root_dir, movie_name)
-
-        # Check that movie is in a directory.
-        if path.isdir(current_dir):
-            # Go through files in movies folder and check path.
-            for dir_path, _, files in walk(current_dir):
-                for file_ in files:
-                    # Check if main file.
-                    if _is_main_file(file_, dir_path):
-                        # Clean tv main file name.
-                        op_counter = _merge_op_counts(op_counter,
-                                                      _clean_movie_main_file(
-                                                          flags, dir_path,
-                                                          file_,
-                                                          current_dir,
-                                                          movie_name))
-                    else:
-                        op_counter = _merge_op_counts(op_counter,
-                                                      _clean_other_file(
-                                                          flags, current_dir,
-                                                          dir_path, file_))
-
-            # Delete duplicate main files.
-            op_counter = _merge_op_counts(op_counter,
-                                          _clean_duplicates(flags, current_dir))
-        else:
-            log_err(flags, "Skipping, movie not in directory: {}".
-                    format(current_dir))
-
-    _finish_cleanup(flags, op_counter, root_dir)
-
+            new_path = current_dir
+        plan.move(entry, new_path, "movie")
 
-def clean_tv(flags, root_dir):
-    """ Cleans a tv-series library. """
+        # Update paths since the directory is renamed or the file moved.
+        plan.prune_dirs.update(_get_empty_dirs(tree))
+        tree = _relocate_title(entry, tree, new_path)
+        plan.prune_dirs.update(_get_empty_dirs(tree))
 
-    # Extract and clean any archives.
-    op_counter = _extract_and_clean_archives(flags, root_dir)
-
-    # Sort and cleanup.
-    for tv_name in listdir(root_dir):
+        # Go through files in movies folder and check path.
+        for _, _, files in tree:
+            for file_ in files:
+                if file_.inode in duplicates:
+                    # The same content is kept in another title.
+                    plan.remove(file_.full_path, "duplicate",
+                                "same content as " + duplicates[file_.inode],
+                                file_.size)
+                    continue
+                kind = classifier.classify(file_.name, file_.size)
+                # Check if main file.
+                if kind.is_main:
+                    # Clean movie main file name.
+                    main_file = _clean_movie_main_file(plan, file_, kind,
+                                                       current_dir,
+                                                       cleaned_movie_name)
+                    if kind is FileKind.MAIN:
+                        main_files.setdefault(main_file.dir_path, {})[
+                            main_file.full_path] = main_file
+                else:
+                    _clean_other_file(plan, current_dir, file_, kind)
+
+    # Delete duplicate main files.
+    for dir_main_files in main_files.values():
+        _clean_duplicates(plan, list(dir_main_files.values()),
+                          classifier.size_sort_increment)
+    _drop_busy_operations(flags, plan, busy_names)
+
+    # Apply the plan.
+    plan.optimize()
+    metrics.start_phase("move")
+    _execute_plan(flags, plan, jobs)
+    _add_plan_metrics(metrics, plan)
+
+    _finish_cleanup(flags, plan, metrics)
+    _update_index(flags, index, plan, cleaned_titles)
+    return _get_changed_paths(flags, plan)
+
+
+def clean_tv(flags, root_dir, index=None, title_names=None, jobs=1,
+             extract_jobs=None, dedupe=False, busy_paths=(), link_dir=None,
+             metrics=None, classifier=None):
+    """ Cleans a tv-series library.
+        Titles that are unchanged in the index (TitleIndex) are skipped,
+        title_names limits the cleaning to the given titles.
+        Up to jobs titles are scanned and cleaned concurrently and up to
+        extract_jobs archives extracted, by default one per device.
+        With dedupe main files with the same content as a file in another
+        title are removed as well. Titles holding any of the busy paths,
+        like the content of active torrents, are left untouched.
+        With link_dir the titles are linked into the link library and
+        cleaned there instead, the files in the root are never changed.
+        The time of each phase, the operations and their bytes are added to
+        metrics (LibraryMetrics) if given. Files are classified by the
+        classifier (MediaClassifier), by default with the default sizes and
+        suffixes.
+        Returns the paths changed by the cleaning.
+    """
+    metrics = metrics if metrics is not None else LibraryMetrics(root_dir)
+    classifier = classifier if classifier is not None else _CLASSIFIER
+    busy_titles = _get_busy_titles(flags, root_dir, busy_paths)
+    if busy_titles is None:
+        return []
+
+    if link_dir is not None:
+        metrics.start_phase("link")
+        _link_library(flags, root_dir, link_dir, metrics, index, title_names,
+                      jobs, busy_titles)
+        if not path.isdir(link_dir):
+            # Nothing has been linked yet in safemode.
+            _finish_cleanup(flags, _OperationPlan(link_dir), metrics)
+            return []
+        root_dir, busy_titles = link_dir, ()
+
+    # Scan the library once, extract and clean any archives.
+    metrics.start_phase("scan")
+    titles, skipped_titles = _scan_library(root_dir, index, title_names, jobs,
+                                           busy_titles)
+    metrics.start_phase("extract")
+    titles = _extract_and_clean_archives(flags, root_dir, titles, metrics,
+                                         jobs, extract_jobs, classifier,
+                                         "tv")
+    duplicates = {}
+    if dedupe:
+        metrics.start_phase("dedupe")
+        duplicates = _find_library_duplicates(titles, skipped_titles, index,
+                                              jobs, classifier)
+
+    # Plan the sorting and cleanup.
+    metrics.start_phase("classify")
+    plan = _OperationPlan(root_dir)
+    # Busy titles by case-insensitive name, like the plan compares titles.
+    busy_names = {title.lower() for title in busy_titles}
+    main_files = {}
+    cleaned_titles = {}
+    for entry, tree in titles:
         # Set the current series to walk through.
-        cleaned_tv_name = _get_clean_tv_dir_name(tv_name,
-                                                 path.join(root_dir, tv_name))
-
-        op_counter = _merge_op_counts(op_counter,
-                                      _move_file_dir(
-                                          flags,
-                                          path.join(root_dir, tv_name),
-                                          path.join(root_dir,
-                                                    cleaned_tv_name),
-                                          "tv-series"))
-
-        # Update path in case directory has been renamed.
-        if not flags[Flag.SAFEMODE]:
-            tv_name = cleaned_tv_name
+        tv_name = _get_clean_tv_dir_name(entry.name, tree, classifier)
 
-        # Update the current directory path.
+        # The planned series directory path.
         current_dir = path.join(root_dir, tv_name)
+        if _is_busy_title(flags, current_dir, busy_names):
+            continue
+        plan.move(entry, current_dir, "tv-series")
 
         # If path is a directory, assume it is a proper tv series directory.
-        if path.isdir(current_dir):
-            # Go through files in a series folder and check path.
-            for dir_path, _, files in walk(current_dir):
-                for file_ in files:
-                    if _has_markers(file_) and \
-                            _is_main_file(file_, dir_path):
-                        # Clean tv main file name.
-                        op_counter = _merge_op_counts(op_counter,
-                                                      _clean_tv_main_file(
-                                                          flags, current_dir,
-                                                          dir_path, file_,
-                                                          tv_name))
-                    else:
-                        op_counter = _merge_op_counts(op_counter,
-                                                      _clean_other_file(
-                                                          flags, current_dir,
-                                                          dir_path, file_))
-
-            for season in listdir(current_dir):
-                # A season directory.
-                season_dir = path.join(current_dir, season)
-                if path.isdir(season_dir):
-                    for episode in listdir(season_dir):
-                        # An episode directory.
-                        episode_dir = path.join(season_dir, episode)
-                        if path.isdir(episode_dir):
-                            # Delete duplicate main files.
-                            op_counter = _merge_op_counts(op_counter,
-                                                          _clean_duplicates(
-                                                              flags,
-                                                              episode_dir))
-        else:
+        if not entry.is_dir:
             log_err(flags, "Skipping, tv-series not in directory: {}".
                     format(current_dir))
+            continue
+
+        cleaned_titles[entry.full_path] = current_dir
+        _include_skipped_title(titles, skipped_titles, current_dir)
+
+        # Update paths since the directory is renamed.
+        plan.prune_dirs.update(_get_empty_dirs(tree))
+        tree = _relocate_title(entry, tree, current_dir)
+        plan.prune_dirs.update(_get_empty_dirs(tree))
 
-    _finish_cleanup(flags, op_counter, root_dir)
+        # Go through files in a series folder and check path.
+        for _, _, files in tree:
+            for file_ in files:
+                if file_.inode in duplicates:
+                    # The same content is kept in another title.
+                    plan.remove(file_.full_path, "duplicate",
+                                "same content as " + duplicates[file_.inode],
+                                file_.size)
+                    continue
+                kind = classifier.classify(file_.name, file_.size)
+                if kind.is_main and \
+                        _parse_release_name(file_.name).has_markers:
+                    # Clean tv main file name.
+                    main_file = _clean_tv_main_file(plan, current_dir, file_,
+                                                    kind, tv_name)
+                    if kind is FileKind.MAIN:
+                        main_files.setdefault(main_file.dir_path, {})[
+                            main_file.full_path] = main_file
+                else:
+                    _clean_other_file(plan, current_dir, file_, kind)
 
+    # Delete duplicate main files in each episode directory.
+    for dir_main_files in main_files.values():
+        _clean_duplicates(plan, list(dir_main_files.values()),
+                          classifier.size_sort_increment)
+    _drop_busy_operations(flags, plan, busy_names)
 
-def _clean_other_file(flags, base_dir, dir_path, file_):
-    """ Cleans auxiliary fies like extras content, soundtracks etc. """
+    # Apply the plan.
+    plan.optimize()
+    metrics.start_phase("move")
+    _execute_plan(flags, plan, jobs)
+    _add_plan_metrics(metrics, plan)
 
-    op_counter = {}
+    _finish_cleanup(flags, plan, metrics)
+    _update_index(flags, index, plan, cleaned_titles)
+    return _get_changed_paths(flags, plan)
 
+
+def _clean_other_file(plan, base_dir, file_, kind):
+    """ Plans cleaning of auxiliary fies like extras content, soundtracks etc.
+    """
     # Clean other types of files.
-    if _is_extras_file(file_, dir_path):
+    if kind is FileKind.EXTRAS:
         # Extra video content, move to folder.
         extras_path = path.join(base_dir, "Extras")
-        op_counter = _merge_op_counts(op_counter,
-                                      _move_file_dir(flags,
-                                                     path.join(dir_path,
-                                                               file_),
-                                                     path.join(extras_path,
-                                                               file_),
-                                                     "extras"))
-
-    elif _is_music_file(file_):
+        plan.move(file_, path.join(extras_path, file_.name), "extras")
+
+    elif kind is FileKind.MUSIC:
         # Extra music content, move to folder.
         music_path = path.join(base_dir, "Soundtrack")
-        op_counter = _merge_op_counts(op_counter,
-                                      _move_file_dir(flags,
-                                                     path.join(dir_path,
-                                                               file_),
-                                                     path.join(music_path,
-                                                               file_),
-                                                     "music"))
-
-    elif not _is_torrent_file(file_):
+        plan.move(file_, path.join(music_path, file_.name), "music")
+
+    elif kind is not FileKind.PARTIAL:
         # File not needed remove.
-        op_counter = _merge_op_counts(op_counter,
-                                      _remove_file(flags, dir_path, file_))
-    return op_counter
+        plan.remove(file_.full_path, size=file_.size)
 
 
-def _finish_cleanup(flags, op_counter, root_dir):
-    """ Finishes cleanup with empty folder removal and stats message. """
+def _get_changed_paths(flags, plan):
+    """ Returns the source and target paths of the executed plan, none in
+        safemode.
+    """
+    if flags[Flag.SAFEMODE]:
+        return []
+    return [path_ for operation in plan.operations
+            for path_ in (operation.source, operation.target)
+            if path_ is not None]
+
+
+def _finish_cleanup(flags, plan, metrics):
+    """ Finishes cleanup with empty folder removal and stats message from
+        the operations in the metrics (LibraryMetrics).
+        Only folders that were empty when scanned or had content moved or
+        removed by the executed plan are checked.
+    """
     # Delete empty directories.
-    op_counter = _merge_op_counts(op_counter,
-                                  _remove_empty_folders(flags, root_dir))
+    metrics.start_phase("prune")
+    prune_plan = _OperationPlan(plan.root_dir)
+    _plan_empty_folder_pruning(prune_plan, plan.root_dir,
+                               _get_prune_candidates(plan))
+    _execute_plan(flags, prune_plan)
+    _add_plan_metrics(metrics, prune_plan)
+    metrics.finish()
 
     # Log stats.
-    _print_op_count(flags, op_counter)
+    _print_op_count(flags, metrics.operations)
     log(flags, "Cleanup completed.\n", TextType.INFO)
 
 
-##########################################################
-################ File type checking/parsing ###############
+def _link_library(flags, root_dir, link_dir, metrics, index=None,
+                  title_names=None, jobs=1, busy_titles=()):
+    """ Links the files of the titles to the same paths in the link library,
+        by hard links or reflinks, the operations are added to the metrics.
+        Titles are skipped like when cleaning. Files linked since they last
+        changed are left out, so the links removed when cleaning the link
+        library aren't made again.
+    """
+    titles, _ = _scan_library(root_dir, index, title_names, jobs,
+                              busy_titles)
+    if not flags[Flag.SAFEMODE]:
+        makedirs(link_dir, exist_ok=True)
+
+    plan = _OperationPlan(root_dir)
+    linked_files = []
+    for entry, tree in titles:
+        for _, _, files in tree or [(root_dir, [], [entry])]:
+            for file_ in files:
+                if index is not None and \
+                        index.is_linked(file_.full_path, file_.fingerprint):
+                    continue
+                target = path.join(link_dir,
+                                   path.relpath(file_.full_path, root_dir))
+                if not _is_same_file(file_, target):
+                    plan.link(file_, target)
+                linked_files.append(file_)
+    _execute_plan(flags, plan, jobs)
+    _add_plan_metrics(metrics, plan)
+
+    # Record the links, titles with failed links are linked again.
+    if index is not None and not flags[Flag.SAFEMODE]:
+        for file_ in linked_files:
+            if file_.full_path not in plan.failed:
+                index.store_link(file_.full_path, file_.fingerprint)
+    _update_index(flags, index, plan, {entry.full_path: entry.full_path
+                                       for entry, _ in titles})
+
+
+def _is_same_file(entry, path_):
+    """ Checks if a path is a link to a scanned file. """
+    try:
+        return stat(path_).st_ino == entry.inode
+    except OSError:
+        return False
 
-# Min video file size = 2 MB.
-_MIN_VIDEO_SIZE = 2000000
 
-# Min main file file size = 200 MB.
-_MIN_MAIN_VIDEO_SIZE = 200000000
+def _get_busy_titles(flags, root_dir, busy_paths):
+    """ Returns the names of the titles holding busy paths, None if the
+        whole library is busy.
+    """
+    root_prefix = path.join(path.abspath(root_dir), "")
+    busy_titles = set()
+    for busy_path in busy_paths:
+        busy_path = path.abspath(busy_path)
+        if busy_path.startswith(root_prefix):
+            busy_titles.add(busy_path[len(root_prefix):].split(path.sep, 1)[0])
+        elif root_prefix.startswith(path.join(busy_path, "")):
+            log_err(flags, "Skipping, library in use by active torrent: {}".
+                    format(busy_path))
+            return None
+
+    for title_name in sorted(busy_titles):
+        log(flags, "Skipping, title in use by active torrent: {}",
+            TextType.STD, path.join(root_dir, title_name))
+    return busy_titles
+
+
+def _is_busy_title(flags, title_dir, busy_names):
+    """ Checks if a title would be cleaned into a busy title, busy_names are
+        the lower case names of the busy titles.
+    """
+    if path.basename(title_dir).lower() in busy_names:
+        log(flags, "Skipping, cleaned title in use by active torrent: {}",
+            TextType.STD, title_dir)
+        return True
+    return False
 
-# A file size factor for determining relevance. = 100 MB
-_SIZE_SORT_INCREMENT = 100000000
 
+def _drop_busy_operations(flags, plan, busy_names):
+    """ Drops the planned operations touching a busy title, the content of
+        active torrents is never changed. busy_names are the lower case
+        names of the busy titles.
+    """
+    if not busy_names:
+        return
+    operations = []
+    for operation in plan.operations:
+        if _get_operation_titles(operation, plan.root_dir) & busy_names:
+            log(flags, "Skipping, path in use by active torrent: {}",
+                TextType.STD, operation.target or operation.source)
+        else:
+            operations.append(operation)
+    plan.operations = operations
 
-def _is_video_file(file_):
-    """ Checks if a file is a video file. """
-    return file_.endswith(".mkv") or file_.endswith(".mp4") or \
-           file_.endswith(".avi") or file_.endswith(".flv")
 
+def _include_skipped_title(titles, skipped_titles, title_dir):
+    """ Adds a skipped title to the titles to clean if another title is
+        moved into it, so the merged content is cleaned as a whole.
+    """
+    if title_dir in skipped_titles:
+        titles.append((skipped_titles.pop(title_dir), _scan_tree(title_dir)))
 
-def _is_subtitle_file(file_):
-    """ Checks if a file is a subtitle file. """
-    return file_.endswith(".srt") or file_.endswith(".smi") or \
-           file_.endswith(".sub")
+
+def _update_index(flags, index, plan, cleaned_titles):
+    """ Stores the fingerprints of the cleaned titles in the index.
+        Titles with failed operations are left out to be cleaned again.
+    """
+    if index is None or flags[Flag.SAFEMODE]:
+        return
+
+    for old_path, new_path in cleaned_titles.items():
+        if old_path != new_path:
+            index.remove(old_path)
+        if old_path not in plan.failed and not any(
+                failed.startswith(path.join(new_path, ""))
+                for failed in plan.failed):
+            index.update(new_path)
+    index.commit()
 
 
-def _is_sample_file(file_, path_):
-    """ Checks if a file is a video sample file. """
-    match_ = match(r'(?i)(?:(?:^|.*\W+)Sample(?:\W+|\d+))', file_)
-    return path.getsize(path.join(path_, file_)) < _MIN_VIDEO_SIZE or \
-           (match_ is not None and
-            path.getsize(path.join(path_, file_)) < _MIN_MAIN_VIDEO_SIZE)
+##########################################################
+################ File type checking/parsing ###############
 
+# Min video file size = 2 MB.
+_MIN_VIDEO_SIZE = 2000000
 
-def _is_compressed_file(file_):
-    """ Checks if a file is compressed. """
-    match_ = match(r'.*\.(?:rar|r\d{1,3}|part|part\d{1,3})$', file_)
-    return match_ is not None
+# Min main file file size = 200 MB.
+_MIN_MAIN_VIDEO_SIZE = 200000000
 
+# A file size factor for determining relevance. = 100 MB
+_SIZE_SORT_INCREMENT = 100000000
 
-def _is_music_file(file_):
-    """ Checks if a file is a music file. """
-    return file_.endswith(".mp3") or file_.endswith(".wav") or \
-           file_.endswith(".flac") or file_.endswith(".aac") or \
-           file_.endswith(".ogg")
+# File name suffixes (without the dot) for each media type.
+_VIDEO_SUFFIXES = frozenset(["mkv", "mp4", "avi", "flv"])
+_SUBTITLE_SUFFIXES = frozenset(["srt", "smi", "sub"])
+_MUSIC_SUFFIXES = frozenset(["mp3", "wav", "flac", "aac", "ogg"])
+
+# Precompiled file name patterns.
+_SAMPLE_PATTERN = compile_regex(r'(?i)(?:(?:^|.*\W+)Sample(?:\W+|\d+))')
+_EXTRAS_PATTERN = compile_regex(r'(?i).*(?:\W+extra\W+)')
+_ARCHIVE_SUFFIX_PATTERN = compile_regex(r'(?:rar|r\d{1,3}|part\d{1,3})$')
+_PROPER_PATTERN = compile_regex(r'(?i).*\W+(?:proper|repack|rerip|real)\W+')
+
+
+class FileKind(Enum):
+    """ Kinds of files found in a media library. """
+    MAIN = 'main'
+    SAMPLE = 'sample'
+    EXTRAS = 'extras'
+    SUBTITLE = 'subtitle'
+    MUSIC = 'music'
+    ARCHIVE = 'archive'
+    PARTIAL = 'partial'
+    OTHER = 'other'
+
+    @property
+    def is_main(self):
+        """ Checks if the kind is sorted as a main file. """
+        return self in (FileKind.MAIN, FileKind.SUBTITLE, FileKind.ARCHIVE)
+
+    @property
+    def main_type(self):
+        """ The type of a main file used in log messages. """
+        return "subtitle" if self is FileKind.SUBTITLE else "video"
+
+
+class MediaClassifier(object):
+    """ Classifies files by name and size in a single pass. """
+
+    def __init__(self, min_video_size=_MIN_VIDEO_SIZE,
+                 min_main_video_size=_MIN_MAIN_VIDEO_SIZE,
+                 video_suffixes=_VIDEO_SUFFIXES,
+                 subtitle_suffixes=_SUBTITLE_SUFFIXES,
+                 music_suffixes=_MUSIC_SUFFIXES,
+                 size_sort_increment=_SIZE_SORT_INCREMENT):
+        self.min_video_size = min_video_size
+        self.min_main_video_size = min_main_video_size
+        # Main files of about the same size are ranked by quality, see
+        # DuplicateRank.
+        self.size_sort_increment = size_sort_increment
+        self.video_suffixes = frozenset(video_suffixes)
+        self.subtitle_suffixes = frozenset(subtitle_suffixes)
+        self.music_suffixes = frozenset(music_suffixes)
+
+    def classify(self, name, size):
+        """ Returns the FileKind of a file. """
+        suffix = _get_suffix(name)
+
+        if suffix in self.video_suffixes:
+            if size < self.min_video_size or \
+                    (size < self.min_main_video_size and
+                     _SAMPLE_PATTERN.match(name) is not None):
+                return FileKind.SAMPLE
+            elif _EXTRAS_PATTERN.match(name) is not None or \
+                    (size < self.min_main_video_size and
+                     not _parse_release_name(name).has_markers):
+                return FileKind.EXTRAS
+            else:
+                return FileKind.MAIN
+        elif suffix in self.subtitle_suffixes:
+            if _EXTRAS_PATTERN.match(name) is not None:
+                return FileKind.EXTRAS
+            else:
+                return FileKind.SUBTITLE
+        elif suffix == "part":
+            # Incomplete torrent download.
+            return FileKind.PARTIAL
+        elif suffix is not None and \
+                _ARCHIVE_SUFFIX_PATTERN.match(suffix) is not None:
+            return FileKind.ARCHIVE
+        elif suffix in self.music_suffixes:
+            return FileKind.MUSIC
+        else:
+            return FileKind.OTHER
 
 
-def _is_torrent_file(file_):
-    """ Checks if a file is an incomplete torrent file. """
-    return file_.endswith(".part")
+# The classifier used when cleaning.
+_CLASSIFIER = MediaClassifier()
 
 
-def _is_main_file(file_, path_):
-    """ Checks if a file is a main video file. """
-    return (_is_video_file(file_) and not (_is_sample_file(file_, path_) or
-                                           _is_extras_file(file_, path_))) or \
-           (_is_subtitle_file(file_) and not _is_extras_file(file_, path_)) or \
-           _is_compressed_file(file_)
+def _get_suffix(file_):
+    """ Returns the file name suffix without the dot, None if missing. """
+    index = file_.rfind(".")
+    return file_[index + 1:] if index >= 0 else None
 
 
 def _is_proper_main_file(file_):
     """ Checks if a file is a proper/repack etc. release. """
-    match_ = match(r'(?i).*\W+(?:proper|repack|rerip|real)\W+', file_)
-    return match_ is not None
+    return _PROPER_PATTERN.match(file_) is not None
 
 
 def _is_valid_media_name(name):
@@ -271,136 +561,344 @@ def _is_valid_media_name(name):
     return name != "None" and name.strip()
 
 
-def _is_extras_file(file_, path_):
-    """ Checks if a file is a extras file. """
-    match_ = match(r'(?i).*(?:\W+extra\W+)', file_)
-    return (_is_video_file(file_) and not _is_sample_file(file_, path_) and
-            ((path.getsize(path.join(path_, file_)) <
-              _MIN_MAIN_VIDEO_SIZE and
-              not _has_markers(file_)) or match_ is not None)) or \
-           (_is_subtitle_file(file_) and match_ is not None)
-
-
-def _has_markers(file_):
-    """ Checks if a file has season and episode markers/numbering. """
-    return _get_season_num(file_) is not None and \
-           _get_episode_num(file_) is not None
-
-
-def _get_season_num(file_):
-    """ Extract the season number of a file. """
-    # Check standard pattern S01E01
-    match_ = search(
-        r'(?i)(?:season|s)\s*(\d{1,2})|(\d{1,2})\s*x|^(\d)\s*\d{2}', file_)
-    if match_ is not None:
-        if match_.group(1) is not None:
-            return sub("^0+", "", match_.group(1))
-        elif match_.group(2) is not None:
-            return sub("^0+", "", match_.group(2))
-        elif match_.group(3) is not None:
-            return sub("^0+", "", match_.group(3))
-
-
-def _get_episode_num(file_):
-    """ Extract the episode number of a file. """
+##########################################################
+################ Release name parsing ####################
+
+# The number of parsed release names to keep between lookups.
+_RELEASE_NAME_CACHE_SIZE = 4096
+
+# Precompiled release name patterns.
+_SEASON_PATTERN = compile_regex(
+    r'(?i)(?:season|s)\s*(\d{1,2})|(\d{1,2})\s*x|^(\d)\s*\d{2}')
+_EPISODE_PATTERN = compile_regex(r'(?i)(?:episode|x|e)\s*(\d{1,3})|^\d(\d{2})')
+_EPISODE_QUALITY_PATTERN = compile_regex(
+    r'(?i)(?:(?:episode|x|e)\s*(?:\d{1,2})|^\d{3})\W+(.*)\..{1,4}$')
+_SERIES_PATTERN = compile_regex(r'(?i)(^.+?)\W+(?:season|s)\s*(?:\d{1,2})'
+                                r'|(?:\d{1,2})\s*x|^(?:\d)\s*\d{2}')
+_SERIES_YEAR_PATTERN = compile_regex(r'(?i)(^.+?)\W+[\[(]?(\d{4})[\])]?\W')
+_MOVIE_PATTERN = compile_regex(r'(?i)(.*?)\W+[\[(]?(\d{4})[\])]?\W')
+_MOVIE_QUALITY_PATTERN = compile_regex(
+    r'(?i)(?:\W[\[(]?\d{4}[\])]?\W)(.*)\..{1,4}$')
+_MOVIE_DIR_PATTERN = compile_regex(r'(?i)(^.+)\s[(](\d{4})[)]$')
+
+
+class ReleaseName(namedtuple('ReleaseName',
+                             ['season', 'episode', 'series_name',
+                              'series_year', 'episode_quality', 'movie_name',
+                              'movie_year', 'movie_quality'])):
+    """ The parts of a release name, None for the parts not found. """
+    __slots__ = ()
+
+    @property
+    def has_markers(self):
+        """ Checks if the name has season and episode markers/numbering. """
+        return self.season is not None and self.episode is not None
+
+
+@lru_cache(maxsize=_RELEASE_NAME_CACHE_SIZE)
+def _parse_release_name(name):
+    """ Parses a tv-series or movie file/directory name in a single pass. """
     # Check standard pattern S01E01
-    match_ = search(r'(?i)(?:episode|x|e)\s*(\d{1,3})|^\d(\d{2})', file_)
-    if match_ is not None:
-        if match_.group(1) is not None:
-            return sub("^0+", "", match_.group(1))
-        elif match_.group(2) is not None:
-            return sub("^0+", "", match_.group(2))
+    season_match = _SEASON_PATTERN.search(name)
+    season = None
+    if season_match is not None:
+        season = next(group for group in season_match.groups()
+                      if group is not None).lstrip("0")
+
+    episode_match = _EPISODE_PATTERN.search(name)
+    episode = None
+    if episode_match is not None:
+        episode = next(group for group in episode_match.groups()
+                       if group is not None).lstrip("0")
+
+    # Extract the quality strings following the episode marker and year.
+    episode_quality_match = _EPISODE_QUALITY_PATTERN.search(name)
+    movie_quality_match = _MOVIE_QUALITY_PATTERN.search(name)
+
+    # Series name, with an optional year, precedes the season marker.
+    series_name, series_year = None, None
+    series_match = _SERIES_PATTERN.match(name)
+    if series_match is not None and series_match.group(1) is not None:
+        series_year_match = _SERIES_YEAR_PATTERN.match(series_match.group(1))
+        if series_year_match is not None:
+            series_name = series_year_match.group(1).strip()
+            series_year = series_year_match.group(2)
+        else:
+            series_name = series_match.group(1).strip()
 
+    # Movie name precedes the year.
+    movie_match = _MOVIE_PATTERN.match(name)
 
-def _get_main_file_type(file_):
-    """ Extract the type of a main video file. """
-    if _is_subtitle_file(file_):
-        return "subtitle"
-    else:
-        return "video"
-
-
-##########################################################
-##################### YAML tools #########################
-
-def get_value_from_yaml(file_path, root_tree, branch):
-    """ Extract a value from a yaml file. """
-    doc = load(open(file_path, 'r'))
-    return doc[root_tree][branch]
+    return ReleaseName(
+        season, episode, series_name, series_year,
+        episode_quality_match.group(1)
+        if episode_quality_match is not None else None,
+        movie_match.group(1).strip() if movie_match is not None else None,
+        movie_match.group(2) if movie_match is not None else None,
+        movie_quality_match.group(1)
+        if movie_quality_match is not None else None)
 
 
 ##########################################################
 ################### Cleaning  tools ######################
 
-def _clean_duplicates(flags, dir_path):
-    """ Removes the least wanted duplicate main files. """
-    op_counter = {}
-    # Get all main files in directory.
-    main_files = []
-    for file_ in listdir(dir_path):
-        # print "\tFile: " + file_
-        file_path = path.join(dir_path, file_)
-        if path.isfile(file_path) and (_is_main_file(file_, dir_path) and
-                                           _is_video_file(file_)):
-            main_files += [file_path]
-
+def _clean_duplicates(plan, main_files,
+                      size_sort_increment=_SIZE_SORT_INCREMENT):
+    """ Plans removal of the least wanted duplicate main files.
+        Expects the scanned main video files of a single directory.
+    """
     if len(main_files) > 1:
-        main_files.sort(key=path.getsize, reverse=True)
-        main_files.sort(key=_is_proper_main_file, reverse=True)
-        main_files.sort(key=lambda f: path.getsize(f) / _SIZE_SORT_INCREMENT,
-                        reverse=True)
-
         # Keep the best file.
-        main_files = main_files[1:]
-        for main_file in main_files:
-            parts = path.split(main_file)
-            op_counter = _merge_op_counts(op_counter,
-                                          _remove_file(flags, parts[0],
-                                                       parts[1],
-                                                       file_type="duplicate"))
+        _, losers = _rank_duplicates(main_files, size_sort_increment)
+        for main_file, reason in losers:
+            plan.remove(main_file.full_path, "duplicate", reason,
+                        main_file.size)
+
+
+# The reasons for a lower rank by differing DuplicateRank field.
+_RANK_REASONS = {'size_bucket': "smaller than {}",
+                 'proper': "{} is a proper/repack release",
+                 'resolution': "lower resolution than {}",
+                 'codec': "older codec than {}",
+                 'size': "smaller than {}"}
+
+# Precompiled quality tag patterns.
+_RESOLUTION_PATTERN = compile_regex(
+    r'(?i)(?:^|[\W_])(?:(\d{3,4})[pi]|(4k|uhd))(?=[\W_]|$)')
+_CODEC_PATTERN = compile_regex(
+    r'(?i)(?:^|[\W_])(x265|h\.?265|hevc|x264|h\.?264|avc|xvid|divx)'
+    r'(?=[\W_]|$)')
+
+# Codec ranks by normalized codec tag, untagged files rank lowest.
+_CODEC_RANKS = {'x265': 3, 'h265': 3, 'hevc': 3,
+                'x264': 2, 'h264': 2, 'avc': 2,
+                'xvid': 1, 'divx': 1}
+
+
+class DuplicateRank(namedtuple('DuplicateRank',
+                               ['size_bucket', 'proper', 'resolution',
+                                'codec', 'size'])):
+    """ The composite rank of a main file among its duplicates,
+        higher ranks are kept. The size bucket groups files of about the
+        same size so the release tags decide between them.
+    """
+    __slots__ = ()
+
+
+def _get_duplicate_rank(file_, size_sort_increment=_SIZE_SORT_INCREMENT):
+    """ Returns the DuplicateRank of a scanned main file. """
+    resolution = 0
+    match = _RESOLUTION_PATTERN.search(file_.name)
+    if match is not None:
+        resolution = int(match.group(1)) if match.group(1) is not None \
+            else 2160
+    match = _CODEC_PATTERN.search(file_.name)
+    codec = _CODEC_RANKS[match.group(1).lower().replace(".", "")] \
+        if match is not None else 0
+    return DuplicateRank(file_.size // size_sort_increment,
+                         _is_proper_main_file(file_.name), resolution, codec,
+                         file_.size)
+
+
+def _rank_duplicates(main_files, size_sort_increment=_SIZE_SORT_INCREMENT):
+    """ Ranks duplicate main files by DuplicateRank, returns the winner and
+        a list of (loser, reason) tuples. Files of equal rank are ordered by
+        name.
+    """
+    ranked = sorted(((_get_duplicate_rank(file_, size_sort_increment), file_)
+                     for file_ in sorted(main_files, key=lambda f: f.name)),
+                    key=lambda ranked_file: ranked_file[0], reverse=True)
+    winner_rank, winner = ranked[0]
+    losers = []
+    for rank, file_ in ranked[1:]:
+        reason = next((_RANK_REASONS[field] for field, winner_value, value
+                       in zip(DuplicateRank._fields, winner_rank, rank)
+                       if winner_value != value), "same rank as {}")
+        losers.append((file_, reason.format(winner.name)))
+    return winner, losers
+
+
+# Block size of the partial content hash, read at the start, middle and end.
+_HASH_BLOCK_SIZE = 65536
+
+# Block size used when reading files for the full content hash.
+_HASH_READ_SIZE = 1048576
+
+
+def _find_library_duplicates(titles, skipped_titles, index=None, jobs=1,
+                             classifier=None):
+    """ Finds main video files with the same content as a file elsewhere in
+        the library, returns the path of the kept file by the inode of each
+        file to remove.
+        Candidates are grouped by size, then by a partial content hash and
+        only collisions are fully hashed. Hashes are cached in the index.
+        Files in skipped titles are never removed and kept over the others.
+    """
+    skipped_entries = list(skipped_titles.values())
+    skipped_trees = _map_grouped(jobs, _scan_title,
+                                 [(entry,) for entry in skipped_entries])
+
+    # Candidates by size and inode, hard links are not duplicates.
+    candidates = {}
+    for (entry, tree), removable in \
+            [(title, True) for title in titles] + \
+            [(title, False) for title in zip(skipped_entries, skipped_trees)]:
+        for file_ in _get_main_video_files(entry, tree, classifier):
+            same_size = candidates.setdefault(file_.size, {})
+            # A file linked into a skipped title is never removed.
+            same_size[file_.inode] = (file_, removable and same_size.get(
+                file_.inode, (None, True))[1])
+
+    duplicates = {}
+    for same_size in candidates.values():
+        if len(same_size) < 2:
+            continue
+        for partial_group in _group_by_hash(list(same_size.values()), False,
+                                            index, jobs):
+            for group in _group_by_hash(partial_group, True, index, jobs):
+                # Keep files in skipped titles, proper releases and then the
+                # first by path.
+                group.sort(key=lambda candidate: (
+                    candidate[1], not _is_proper_main_file(candidate[0].name),
+                    candidate[0].full_path))
+                duplicates.update((file_.inode, group[0][0].full_path)
+                                  for file_, removable in group[1:]
+                                  if removable)
+    return duplicates
+
+
+def _get_main_video_files(entry, tree, classifier=None):
+    """ Returns the main video files of a scanned title. """
+    classifier = classifier or _CLASSIFIER
+    files = [entry] if tree is None else \
+        [file_ for _, _, files in tree for file_ in files]
+    return [file_ for file_ in files
+            if classifier.classify(file_.name, file_.size) is FileKind.MAIN]
+
+
+def _group_by_hash(candidates, full, index=None, jobs=1):
+    """ Groups (file, removable) candidates by partial or full content hash,
+        returns the groups with more than one file.
+        Files that can't be read are left out.
+    """
+    hashes = [index.get_hash(file_.fingerprint, full)
+              if index is not None else None for file_, _ in candidates]
+
+    # Hash the files missing in the index.
+    missing = [i for i, hash_ in enumerate(hashes) if hash_ is None]
+    missing_files = [candidates[i][0] for i in missing]
+    missing_hashes = _map_grouped(jobs, _hash_file,
+                                  [(file_.full_path, file_.size, full)
+                                   for file_ in missing_files])
+    for i, file_, hash_ in zip(missing, missing_files, missing_hashes):
+        hashes[i] = hash_
+        if index is not None and hash_ is not None:
+            index.store_hash(file_.fingerprint, hash_, full)
+
+    groups = {}
+    for candidate, hash_ in zip(candidates, hashes):
+        if hash_ is not None:
+            groups.setdefault(hash_, []).append(candidate)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def _hash_file(file_path, size, full=False):
+    """ Returns the partial or full content hash of a file, None if it can't
+        be read. The partial hash only reads blocks at the start, middle and
+        end of the file.
+    """
+    hash_ = blake2b(digest_size=20)
+    try:
+        with open(file_path, 'rb') as file_:
+            if full:
+                for block in iter(lambda: file_.read(_HASH_READ_SIZE), b""):
+                    hash_.update(block)
+            else:
+                for offset in (0, size // 2, max(size - _HASH_BLOCK_SIZE, 0)):
+                    file_.seek(offset)
+                    hash_.update(file_.read(_HASH_BLOCK_SIZE))
+    except OSError:
+        return None
+    return hash_.digest()
 
-    return op_counter
+
+# The max directory depth below a title searched for a valid title name.
+_NAME_RECOVERY_DEPTH = 2
+
+
+def _iter_recovery_names(tree, classifier=None,
+                         max_depth=_NAME_RECOVERY_DEPTH):
+    """ Yields the names in a scanned title tree to recover a title name
+        from. The largest video files come first, then the top directories
+        and then the remaining names down to max_depth.
+    """
+    classifier = classifier or _CLASSIFIER
+    top = tree[0][0]
+    levels = [level for level in tree
+              if level[0][len(top):].count(path.sep) <= max_depth]
+
+    def is_video(file_):
+        """ Checks if a file is a video file by suffix. """
+        return _get_suffix(file_.name) in classifier.video_suffixes
+
+    for file_ in sorted((file_ for _, _, files in levels for file_ in files
+                         if is_video(file_)),
+                        key=lambda f: f.size, reverse=True):
+        yield file_.name
+    for dir_ in tree[0][1]:
+        yield dir_.name
+    for i, (_, dirs, files) in enumerate(levels):
+        for file_ in files:
+            if not is_video(file_):
+                yield file_.name
+        if i > 0:
+            for dir_ in dirs:
+                yield dir_.name
 
 
 ###################### Tv-series #########################
 
-def _clean_tv_main_file(flags, series_dir, dir_path, file_, series_name):
-    """ Clean a main tv-series file. """
+def _clean_tv_main_file(plan, series_dir, file_, kind, series_name):
+    """ Plans cleaning of a main tv-series file.
+        Returns the file at its planned location.
+    """
+    release = _parse_release_name(file_.name)
+
     # Make proper path.
     proper_path = path.join(series_dir,
-                            "Season {}".format(_get_season_num(file_)),
+                            "Season {}".format(release.season),
                             "{} S{}E{}".
                             format(series_name,
-                                   _get_season_num(file_).zfill(2),
-                                   _get_episode_num(file_).zfill(2)))
+                                   release.season.zfill(2),
+                                   release.episode.zfill(2)))
 
     # Get a clean file name.
-    cleaned_file_name = _get_clean_tv_main_file_name(file_, series_name)
+    cleaned_file_name = _get_clean_tv_main_file_name(
+        file_.name, series_name, kind is FileKind.SUBTITLE)
 
     # Try to move the video file to the correct location and name.
-    op_counter = _move_file_dir(flags, path.join(dir_path, file_),
-                                path.join(proper_path, cleaned_file_name),
-                                _get_main_file_type(file_))
+    new_path = path.join(proper_path, cleaned_file_name)
+    plan.move(file_, new_path, kind.main_type)
 
-    return op_counter
+    return _moved_entry(file_, new_path)
 
 
-def _get_clean_tv_main_file_name(file_, series_name):
-    """ Returns a cleaned a main tv-series file name. """
-    if _has_markers(file_):
+def _get_clean_tv_main_file_name(file_, series_name, subtitle):
+    """ Returns a cleaned a main tv-series file name.
+        Subtitle tells if the file is a subtitle, as classified by the
+        MediaClassifier.
+    """
+    release = _parse_release_name(file_)
+    if release.has_markers:
         # Create episode id.
         episode_id = series_name.replace(" ", ".") + ".S" + \
-                     str(_get_season_num(file_)).zfill(2) + "E" + \
-                     str(_get_episode_num(file_)).zfill(2)
-
-        # Name can be formatted.
-        quality_match = search(
-            r'(?i)(?:(?:episode|x|e)\s*(?:\d{1,2})|^\d{3})\W+(.*)\..{1,4}$',
-            file_)
-        # Omit quality if not found
-        if quality_match is not None:
-            quality = quality_match.group(1)
-        elif _is_subtitle_file(file_):
+                     release.season.zfill(2) + "E" + \
+                     release.episode.zfill(2)
+
+        # Name can be formatted, omit quality if not found
+        if release.episode_quality is not None:
+            quality = release.episode_quality
+        elif subtitle:
             quality = file_.rsplit(".", 1)[0]
         else:
             quality = ""
@@ -420,13 +918,13 @@ def _get_clean_tv_main_file_name(file_, series_name):
         return file_
 
 
-def _get_clean_tv_dir_name(tv_name, dir_):
+def _get_clean_tv_dir_name(tv_name, tree, classifier=None):
     """ Returns a cleaned tv-series directory name. """
 
     # If the name might be incorrect, check for possible alts.
-    if not _is_valid_media_name(tv_name):
+    if not _is_valid_media_name(tv_name) and tree is not None:
 
-        match_ = _find_tv_name_year_match(dir_)
+        match_ = _find_tv_name_year_match(tree, classifier)
         if match_ is not None:
 
             # Format movie name into std format: "My Series", optional year.
@@ -442,16 +940,12 @@ def _get_clean_tv_dir_name(tv_name, dir_):
         return tv_name.strip()
 
 
-def _find_tv_name_year_match(dir_):
-    """ Finds a valid tv-series name in a tv directory, None if no exists. """
-    # Find all possible files and directories to check.
-    names_to_check = []
-    for _, dirs, files in walk(dir_):
-        names_to_check += files
-        names_to_check += dirs
-
-    # Test all names.
-    for name in names_to_check:
+def _find_tv_name_year_match(tree, classifier=None):
+    """ Finds a valid tv-series name in a scanned tv directory,
+        None if no exists.
+    """
+    # Test the names until the first valid match.
+    for name in _iter_recovery_names(tree, classifier):
         match_ = _get_tv_file_name_year_match(name)
         if match_ is not None and _is_valid_media_name(match_[0]):
             return match_
@@ -460,50 +954,46 @@ def _find_tv_name_year_match(dir_):
 
 def _get_tv_file_name_year_match(tv_name):
     """ Returns a tuple with tv-series name and year or None if not found. """
-    match_ = match(r'(?i)(^.+?)\W+(?:season|s)\s*(?:\d{1,2})'
-                   r'|(?:\d{1,2})\s*x|^(?:\d)\s*\d{2}', tv_name)
-    if match_ is not None:
-        name_year_match = match(r'(?i)(^.+?)\W+[\[(]?(\d{4})[\])]?\W',
-                                match_.group(1))
-        if name_year_match is not None:
-            return name_year_match.group(1).strip(), name_year_match.group(2)
-        else:
-            return match_.group(1).strip(), None
+    release = _parse_release_name(tv_name)
+    if release.series_name is not None:
+        return release.series_name, release.series_year
     else:
         return None
 
 
 ####################### Movies ###########################
 
-def _clean_movie_main_file(flags, dir_path, file_, movie_dir, movie_name):
-    """ Clean a main movie file. """
+def _clean_movie_main_file(plan, file_, kind, movie_dir, movie_name):
+    """ Plans cleaning of a main movie file.
+        Returns the file at its planned location.
+    """
     # Get a clean file name.
-    clean_movie_name = _get_clean_movie_main_file_name(file_, movie_name)
+    clean_movie_name = _get_clean_movie_main_file_name(
+        file_.name, movie_name, kind is FileKind.SUBTITLE)
 
     # Try to move the video file to the correct location and name.
-    op_counter = _move_file_dir(flags, path.join(dir_path, file_),
-                                path.join(movie_dir, clean_movie_name),
-                                _get_main_file_type(file_))
-    return op_counter
+    new_path = path.join(movie_dir, clean_movie_name)
+    plan.move(file_, new_path, kind.main_type)
+    return _moved_entry(file_, new_path)
 
 
-def _get_clean_movie_main_file_name(file_, movie_name):
+def _get_clean_movie_main_file_name(file_, movie_name, subtitle):
     """ Returns a cleaned a main movie file name.
         Relies on names formatted in std movie dir format:
         - "My Movie (2015)".
+        Subtitle tells if the file is a subtitle, as classified by the
+        MediaClassifier.
     """
-    name_year_match = match(r'(?i)(^.+)\s[(](\d{4})[)]$', movie_name)
+    name_year_match = _MOVIE_DIR_PATTERN.match(movie_name)
     # Extract quality string from file name.
-    quality_match = search(
-        r'(?i)(?:\W[\[(]?\d{4}[\])]?\W)(.*)\..{1,4}$', file_)
+    quality = _parse_release_name(file_).movie_quality
     # Omit quality if not found
-    if quality_match is not None:
-        quality = quality_match.group(1)
-    elif _is_subtitle_file(file_) and name_year_match is not None:
-        quality = file_.rsplit(".", 1)[0].upper().replace(
-            name_year_match.group(1).upper(), "")
-    else:
-        quality = ""
+    if quality is None:
+        if subtitle and name_year_match is not None:
+            quality = file_.rsplit(".", 1)[0].upper().replace(
+                name_year_match.group(1).upper(), "")
+        else:
+            quality = ""
     quality = quality.strip(" ._-")
     if name_year_match is not None:
         return name_year_match.group(1).replace(" ", ".") + "." + \
@@ -516,14 +1006,14 @@ def _get_clean_movie_main_file_name(file_, movie_name):
                file_.rsplit(".", 1)[1]
 
 
-def _get_clean_movie_dir_name(movie_name, dir_):
+def _get_clean_movie_dir_name(movie_name, tree, classifier=None):
     """ Returns a cleaned movie directory name. """
     match_ = _get_movie_name_year_match(movie_name)
 
     # If the name might be incorrect, check for possible alts.
     if (match_ is None or not _is_valid_media_name(match_[0])) \
-            and path.isdir(dir_):
-        match_ = _find_movie_name_year_match(dir_)
+            and tree is not None:
+        match_ = _find_movie_name_year_match(tree, classifier)
 
     if match_ is not None:
         # Format movie name into std format: "My Movie (2015)."
@@ -533,16 +1023,12 @@ def _get_clean_movie_dir_name(movie_name, dir_):
         return movie_name.strip()
 
 
-def _find_movie_name_year_match(dir_):
-    """ Finds a valid movie name in a movie directory, None if no exists. """
-    # Find all possible files and directories to check.
-    names_to_check = []
-    for _, dirs, files in walk(dir_):
-        names_to_check += files
-        names_to_check += dirs
-
-    # Test all names.
-    for name in names_to_check:
+def _find_movie_name_year_match(tree, classifier=None):
+    """ Finds a valid movie name in a scanned movie directory,
+        None if no exists.
+    """
+    # Test the names until the first valid match.
+    for name in _iter_recovery_names(tree, classifier):
         match_ = _get_movie_name_year_match(name)
         if match_ is not None and _is_valid_media_name(match_[0]):
             return match_
@@ -551,121 +1037,528 @@ def _find_movie_name_year_match(dir_):
 
 def _get_movie_name_year_match(movie_name):
     """ Returns a tuple with movie name and year or None if not found. """
-    match_std = match(r'(?i)(.*?)\W+[\[(]?(\d{4})[\])]?\W', movie_name)
-    if match_std is not None:
-        return match_std.group(1).strip(), match_std.group(2)
+    release = _parse_release_name(movie_name)
+    if release.movie_name is not None:
+        return release.movie_name, release.movie_year
     else:
         return None
 
 
 ##########################################################
-################ File/Directory tools ####################
+#################### Library scanning ####################
 
-def _remove_empty_folders(flags, path_, remove_root=True):
-    """ Removes empty folders in the given path. """
-    if not path.isdir(path_):
-        return
+class _Entry(namedtuple('_Entry', ['name', 'dir_path', 'is_dir', 'is_link',
+                                   'size', 'mtime', 'inode'])):
+    """ A scanned file or directory with the stat results of a single scan. """
+    __slots__ = ()
+
+    @property
+    def full_path(self):
+        """ The full path of the entry. """
+        return path.join(self.dir_path, self.name)
+
+    @property
+    def fingerprint(self):
+        """ The (inode, mtime, size) identifying the entry content. """
+        return self.inode, self.mtime, self.size
+
+
+def _scan_dir(dir_path):
+    """ Scans a directory, stats each entry once.
+        Entries that vanish or can't be stat'ed are skipped.
+    """
+    entries = []
+    with scandir(dir_path) as dir_entries:
+        for dir_entry in dir_entries:
+            try:
+                stat_ = dir_entry.stat()
+                is_link = dir_entry.is_symlink()
+            except OSError:
+                continue
+            is_dir = S_ISDIR(stat_.st_mode)
+            entries.append(_Entry(dir_entry.name, dir_path, is_dir, is_link,
+                                  stat_.st_size, stat_.st_mtime,
+                                  stat_.st_ino))
+    return entries
+
+
+def _scan_tree(top):
+    """ Scans a directory tree top-down like os.walk.
+        Returns a list of (dir_path, dirs, files) tuples with scanned entries,
+        directory links are listed but not followed.
+    """
+    tree = []
+    pending = [top]
+    while pending:
+        dir_path = pending.pop()
+        try:
+            entries = _scan_dir(dir_path)
+        except OSError:
+            # Skip unreadable directories just like os.walk.
+            continue
+        dirs = [entry for entry in entries if entry.is_dir]
+        tree.append((dir_path, dirs,
+                     [entry for entry in entries if not entry.is_dir]))
+        pending += [dir_.full_path for dir_ in reversed(dirs)
+                    if not dir_.is_link]
+    return tree
+
+
+def _scan_library(root_dir, index=None, title_names=None, jobs=1,
+                  busy_titles=()):
+    """ Scans a library root, returns a list of (entry, tree) tuples and
+        the skipped title directories by path.
+        The tree is None for titles that are files. Titles not in title_names
+        (if given) or unchanged in the index are skipped and not scanned.
+        Busy titles are left out completely.
+    """
+    entries = []
+    skipped_titles = {}
+    for entry in _scan_dir(root_dir):
+        if entry.name in busy_titles:
+            continue
+        elif title_names is not None and entry.name not in title_names:
+            if entry.is_dir:
+                skipped_titles[entry.full_path] = entry
+        elif entry.is_dir and index is not None and \
+                index.is_unchanged(entry.full_path):
+            skipped_titles[entry.full_path] = entry
+        else:
+            entries.append(entry)
+
+    # Scan the title directories concurrently.
+    trees = _map_grouped(jobs, _scan_title, [(entry,) for entry in entries])
+    return list(zip(entries, trees)), skipped_titles
+
+
+def _scan_title(entry):
+    """ Scans a title directory tree, None if the title is a file. """
+    return _scan_tree(entry.full_path) if entry.is_dir else None
+
+
+def _rebase_tree(tree, old_top, new_top):
+    """ Relocates a scanned tree after its top directory has been moved. """
+
+    def rebase(dir_path):
+        """ Returns the new path of a directory in the tree. """
+        return new_top + dir_path[len(old_top):]
+
+    return [(rebase(dir_path),
+             [entry._replace(dir_path=rebase(dir_path)) for entry in dirs],
+             [entry._replace(dir_path=rebase(dir_path)) for entry in files])
+            for dir_path, dirs, files in tree]
+
+
+def _get_empty_dirs(tree):
+    """ Returns the directories of a scanned tree that have no entries. """
+    return [dir_path for dir_path, dirs, files in tree or []
+            if not dirs and not files]
+
+
+def _relocate_title(entry, tree, new_path):
+    """ Returns the scanned tree of a title at its planned new path.
+        A title file is placed alone in its new directory.
+    """
+    if not entry.is_dir:
+        return [(path.dirname(new_path), [], [_moved_entry(entry, new_path)])]
+    elif entry.full_path != new_path:
+        return _rebase_tree(tree, entry.full_path, new_path)
+    else:
+        return tree
+
+
+def _moved_entry(entry, new_path):
+    """ Returns a scanned file or directory at a new location. """
+    return entry._replace(dir_path=path.dirname(new_path),
+                          name=path.basename(new_path))
+
+
+##########################################################
+################## Operation planning ####################
+
+# Operations are planned first and then executed by _execute_plan.
+# Each operation is identified by its operation counter key,
+# paths in later operations refer to the state after earlier operations.
+
+class _Operation(namedtuple('_Operation', ['op', 'source', 'target',
+                                           'type_', 'reason', 'size'],
+                            defaults=(None, None))):
+    """ A planned filesystem operation with a type and an optional reason
+        used for logging, size is the bytes of the source if known.
+    """
+    __slots__ = ()
+
+
+# Operation keys of file and directory moves.
+_FILE_MOVE_OPS = ('f_m', 'f_r')
+_DIR_MOVE_OPS = ('d_m', 'd_me')
+
+
+class _OperationPlan(object):
+    """ An ordered plan of filesystem operations. """
+
+    def __init__(self, root_dir=None):
+        # The library root, operations on different titles in it are
+        # independent.
+        self.root_dir = root_dir
+        self.operations = []
+        # Sources of the operations that failed when executed.
+        self.failed = set()
+        # Directories created or moved away by the planned operations.
+        self._dirs = {}
+        # Directories that may be empty once the plan is executed.
+        self.prune_dirs = set()
+
+    def is_dir(self, path_):
+        """ Checks if a path is a directory after the planned operations. """
+        if path_ in self._dirs:
+            return self._dirs[path_]
+        return path.isdir(path_)
+
+    def move(self, source, new_path, type_):
+        """ Plans a move, rename or merge of a scanned file or directory. """
+        old_path = source.full_path
+        if old_path == new_path:
+            return
+
+        if not source.is_dir:
+            # Move or rename a file, parent directories are created.
+            op = 'f_m' if path.dirname(old_path) != path.dirname(new_path) \
+                else 'f_r'
+            self._dirs[path.dirname(new_path)] = True
+        else:
+            # Merge into an existing directory unless only case is changed.
+            if old_path.lower() != new_path.lower() and self.is_dir(new_path):
+                op = 'd_me'
+            else:
+                op = 'd_m'
+            self._dirs[old_path] = False
+            self._dirs[new_path] = True
+        self.operations.append(_Operation(
+            op, old_path, new_path, type_,
+            size=source.size if not source.is_dir else None))
+
+    def remove(self, path_, type_=None, reason=None, size=None):
+        """ Plans removal of a file of size bytes. """
+        self.operations.append(_Operation('f_rm', path_, None, type_,
+                                          reason, size))
+
+    def remove_dir(self, path_):
+        """ Plans removal of an empty directory. """
+        self.operations.append(_Operation('d_rm', path_, None, None))
+
+    def link(self, source, target):
+        """ Plans linking of a scanned file to a new path. """
+        self.operations.append(_Operation('f_l', source.full_path, target,
+                                          None, size=source.size))
+
+    def extract(self, path_, target_dir, size=None):
+        """ Plans extraction of an archive of size bytes into a directory.
+        """
+        self.operations.append(_Operation('a_e', path_, target_dir,
+                                          "archive", size=size))
+
+    def optimize(self):
+        """ Removes duplicate operations and needless intermediate moves.
+            Files that are moved and later removed are removed in place,
+            files that are moved twice are moved straight to the final path.
+        """
+        operations = []
+        seen = set()
+        # The index and operation of the last move to a path.
+        moved_to = {}
+        # Files can't skip past directory moves since the target may change.
+        last_dir_move = -1
+
+        for operation in self.operations:
+            if operation in seen:
+                continue
+            seen.add(operation)
+
+            if operation.op in _FILE_MOVE_OPS + ('f_rm',) and \
+                    operation.source in moved_to:
+                index, earlier = moved_to.pop(operation.source)
+                if operation.op == 'f_rm':
+                    # Remove the file where it is.
+                    operations[index] = operation._replace(
+                        source=earlier.source)
+                    continue
+                elif index > last_dir_move:
+                    # Move the file straight to the final path.
+                    operations[index] = _coalesce_moves(earlier, operation)
+                    if operations[index] is not None:
+                        moved_to[operation.target] = (index,
+                                                      operations[index])
+                    continue
+
+            if operation.op in _DIR_MOVE_OPS:
+                last_dir_move = len(operations)
+            elif operation.op in _FILE_MOVE_OPS:
+                moved_to[operation.target] = (len(operations), operation)
+            operations.append(operation)
+
+        self.operations = [operation for operation in operations
+                           if operation is not None]
+
+
+def _coalesce_moves(first, second):
+    """ Returns a single file move doing two moves, None if not moved. """
+    if first.source == second.target:
+        return None
+    op = 'f_m' if path.dirname(first.source) != path.dirname(second.target) \
+        else 'f_r'
+    return _Operation(op, first.source, second.target, second.type_,
+                      size=first.size)
+
+
+def _get_prune_candidates(plan):
+    """ Returns the folders that may be empty after executing a plan. """
+    candidates = set(plan.prune_dirs)
+    for operation in plan.operations:
+        if operation.op in _FILE_MOVE_OPS + _DIR_MOVE_OPS + ('f_rm',):
+            candidates.add(path.dirname(operation.source))
+        if operation.op == 'd_me':
+            # The content is moved out of a merged directory.
+            candidates.add(operation.source)
+    return candidates
+
+
+def _plan_empty_folder_pruning(plan, root_dir, candidates):
+    """ Plans removal of the empty candidate folders below the root.
+        Deeper folders are checked first and the parent of each removed
+        folder is checked in turn, the root is never removed.
+    """
+    root_prefix = path.join(root_dir, "")
+    pending = [(-dir_.count(path.sep), dir_) for dir_ in candidates
+               if dir_.startswith(root_prefix)]
+    heapify(pending)
+    removed = set()
+    while pending:
+        _, dir_ = heappop(pending)
+        if dir_ not in removed and \
+                _plan_empty_folder_removal(plan, dir_, removed):
+            parent = path.dirname(dir_)
+            if parent.startswith(root_prefix):
+                heappush(pending, (-parent.count(path.sep), parent))
+
+
+def _plan_empty_folder_removal(plan, path_, removed):
+    """ Plans removal of empty folders in the given path.
+        Returns True if the folder is empty once the planned folders are
+        removed, the planned folders are added to removed.
+    """
+    if path_ in removed:
+        return True
+    try:
+        entries = list(scandir(path_))
+    except OSError:
+        return False
 
-    op_counter = {}
     # Remove empty sub folders.
-    files = listdir(path_)
-    for file_ in files:
-        full_path = path.join(path_, file_)
-        if path.isdir(full_path):
-            op_counter = _merge_op_counts(op_counter,
-                                          _remove_empty_folders(flags,
-                                                                full_path))
+    is_empty = True
+    for entry in entries:
+        if not (entry.is_dir(follow_symlinks=False) and
+                _plan_empty_folder_removal(plan, entry.path, removed)):
+            is_empty = False
 
     # If folder empty, delete it
-    files = listdir(path_)
-    if len(files) == 0 and remove_root:
-        log(flags, "Removing empty folder:" + path_)
-        try:
-            if not flags[Flag.SAFEMODE]:
-                rmdir(path_)
-            op_counter = _merge_op_counts(op_counter, {'d_rm': 1})
-        except OSError as err:
-            log_err(flags, "Error (OsError: {}) while removing directory: {}".
-                    format(err.errno, path_))
-            op_counter = _merge_op_counts(op_counter, {'err': 1})
-    return op_counter
+    if is_empty:
+        plan.remove_dir(path_)
+        removed.add(path_)
+    return is_empty
 
 
-def _move_file_dir(flags, old_path, new_path, file_dir_type):
-    """ Moves a file or a directory. """
-    op_counter = {}
-
-    if old_path != new_path:
-        # Calculate the parent directory paths.
-        old_dir = path.dirname(old_path)
-        new_dir = path.dirname(new_path)
-
-        # Check if the file/dir is being moved or just renamed.
-        if path.isfile(old_path):
-            # File
-            log(flags, "{} {} file: {}\nTo: {}".
-                format("Moving" if old_dir != new_dir else "Renaming",
-                       file_dir_type, old_path, new_path))
-            op_counter = {('f_m' if old_dir != new_dir else 'f_r'): 1}
-        elif path.isdir(old_path):
-            # Directory
-            if path.isdir(new_path):
-                # Merge directories.
-                log(flags, "Merging {} directory: {}\nInto: {}".
-                    format(file_dir_type, old_path, new_path))
-                op_counter = {'d_me': 1}
+##########################################################
+################## Operation execution ###################
+
+def _execute_plan(flags, plan, jobs=1):
+    """ Executes the planned operations, the sources of the operations that
+        failed are added to plan.failed. In safemode the operations are only
+        logged.
+        Operations on separate titles of the plan library are executed by up
+        to jobs threads, the log output is grouped per title.
+        Archives are extracted by _execute_extractions instead.
+    """
+    if jobs > 1 and plan.root_dir is not None:
+        groups = _group_operations(plan.operations, plan.root_dir)
+    else:
+        groups = [plan.operations]
+
+    for failed in _map_grouped(jobs, _execute_operations,
+                               [(flags, group) for group in groups]):
+        plan.failed |= failed
+
+
+def _group_operations(operations, root_dir):
+    """ Splits operations into groups that can be executed independently.
+        Operations touching the same title (by case-insensitive name) are in
+        the same group and keep their order.
+    """
+    # Groups as (operations, titles) tuples by title.
+    group_of = {}
+    groups = []
+    for operation in operations:
+        titles = _get_operation_titles(operation, root_dir)
+        group = None
+        for title in titles:
+            other = group_of.get(title)
+            if other is None or other is group:
+                continue
+            elif group is None:
+                group = other
             else:
-                # Move directory.
-                log(flags, "Moving {} directory: {}\nTo: {}".
-                    format(file_dir_type, old_path, new_path))
-                op_counter = {'d_m': 1}
+                # The operation joins two groups, merge them.
+                group[0].extend(other[0])
+                group[1].update(other[1])
+                for other_title in other[1]:
+                    group_of[other_title] = group
+                groups = [group_ for group_ in groups if group_ is not other]
+        if group is None:
+            group = ([], set())
+            groups.append(group)
+        group[0].append(operation)
+        group[1].update(titles)
+        for title in titles:
+            group_of[title] = group
+    return [group[0] for group in groups]
+
+
+def _get_operation_titles(operation, root_dir):
+    """ Returns the (lower case) names of the titles an operation touches. """
+    root_prefix = path.join(root_dir, "")
+    titles = set()
+    for path_ in (operation.source, operation.target):
+        if path_ is None:
+            continue
+        elif path_.startswith(root_prefix):
+            titles.add(path_[len(root_prefix):].split(path.sep, 1)[0].lower())
         else:
-            # The source file/directory does not exist.
-            log_err(flags, "Error (Source does not exist) " +
-                    "while moving file/directory: {}".format(old_path))
-            op_counter = {'err': 1}
+            titles.add(path_.lower())
+    return titles
 
-        # Do the move/rename.
-        if not flags[Flag.SAFEMODE]:
-            try:
-                # If only case has been changed do temp move (Samba comp).
-                if old_path.lower() == new_path.lower():
-                    renames(old_path, old_path + "_temp")
-                    old_path += "_temp"
-                # Do the move/rename.
-                if path.isdir(old_path) and path.isdir(new_path):
-                    # Target and source are existing directories, do a merge.
-                    _merge_dirs(old_path, new_path)
-                elif path.isfile(old_path) and path.isfile(new_path):
-                    # Target and source are existing files, overwrite.
-                    replace(old_path, new_path)
-                else:
-                    # Do a standard move/rename.
-                    renames(old_path, new_path)
-            except OSError as err:
-                log_err(flags,
-                        "Error (OsError: {}) while moving file/directory: {}".
-                        format(err.errno, old_path))
-                op_counter = {'err': 1}
-    return op_counter
+
+def _execute_operations(flags, operations):
+    """ Executes operations in order, returns the sources of the operations
+        that failed.
+    """
+    failed = set()
+    # Operations within directories that failed to move are skipped.
+    failed_dirs = []
+
+    for operation in operations:
+        if any(operation.source.startswith(path.join(dir_, ""))
+               for dir_ in failed_dirs):
+            log_err(flags, "Skipping, source directory was not moved: {}".
+                    format(operation.source))
+            failed.add(operation.source)
+            continue
+
+        started = monotonic()
+        if operation.op in _FILE_MOVE_OPS + _DIR_MOVE_OPS:
+            count = _move_file_dir(flags, operation)
+            if 'err' in count and operation.op in _DIR_MOVE_OPS:
+                failed_dirs.append(operation.target)
+        elif operation.op == 'f_rm':
+            count = _remove_file(flags, operation)
+        elif operation.op == 'd_rm':
+            count = _remove_dir(flags, operation)
+        else:
+            count = _link_file(flags, operation)
+        _record_operation(flags, operation, count, monotonic() - started)
+        if 'err' in count:
+            failed.add(operation.source)
+    return failed
 
 
-def _remove_file(flags, dir_path, file_, file_type=None):
+def _move_file_dir(flags, operation):
+    """ Moves a file or a directory. """
+    old_path, new_path = operation.source, operation.target
+
+    if operation.op in _FILE_MOVE_OPS:
+        # File
+        log(flags, "{} {} file: {}\nTo: {}", TextType.STD,
+            "Moving" if operation.op == 'f_m' else "Renaming",
+            operation.type_, old_path, new_path)
+    elif operation.op == 'd_me':
+        # Merge directories.
+        log(flags, "Merging {} directory: {}\nInto: {}", TextType.STD,
+            operation.type_, old_path, new_path)
+    else:
+        # Move directory.
+        log(flags, "Moving {} directory: {}\nTo: {}", TextType.STD,
+            operation.type_, old_path, new_path)
+
+    # Do the move/rename.
+    if not flags[Flag.SAFEMODE]:
+        verify = flags[Flag.VERIFY]
+        try:
+            # If only case has been changed do temp move (Samba comp).
+            if old_path.lower() == new_path.lower():
+                renames(old_path, old_path + "_temp")
+                old_path += "_temp"
+            # Do the move/rename, copying if across filesystems.
+            if operation.op == 'd_me':
+                # Target and source are existing directories, do a merge.
+                _merge_dirs(old_path, new_path, verify=verify)
+            elif operation.op in _FILE_MOVE_OPS and path.isfile(new_path):
+                # Target and source are existing files, overwrite.
+                replace(old_path, new_path, verify)
+            else:
+                # Do a standard move/rename.
+                renames(old_path, new_path, verify)
+        except OSError as err:
+            log_err(flags,
+                    "Error (OsError: {}) while moving file/directory: {}".
+                    format(err.errno, old_path))
+            return {'err': 1}
+    return {operation.op: 1}
+
+
+def _remove_file(flags, operation):
     """ Removes a file. """
-    log(flags, "Removing " + (
-        file_type + " " if file_type is not None else "") + "file: " +
-        path.join(dir_path, file_))
+    log(flags, "Removing {}file: {}{}", TextType.STD,
+        operation.type_ + " " if operation.type_ is not None else "",
+        operation.source,
+        "\nReason: " + operation.reason
+        if operation.reason is not None else "")
     try:
         if not flags[Flag.SAFEMODE]:
-            remove(path.join(dir_path, file_))
+            remove(operation.source)
         return {'f_rm': 1}
     except OSError as err:
         log_err(flags, "Error (OsError: {}) while removing file: {}".
-                format(err.errno, path.join(dir_path, file_)))
+                format(err.errno, operation.source))
+        return {'err': 1}
+
+
+def _remove_dir(flags, operation):
+    """ Removes an empty directory. """
+    log(flags, "Removing empty folder:{}", TextType.STD, operation.source)
+    try:
+        if not flags[Flag.SAFEMODE]:
+            rmdir(operation.source)
+        return {'d_rm': 1}
+    except OSError as err:
+        log_err(flags, "Error (OsError: {}) while removing directory: {}".
+                format(err.errno, operation.source))
         return {'err': 1}
 
 
-def _merge_dirs(root_src_dir, root_dst_dir, overwrite=False):
+def _link_file(flags, operation):
+    """ Links a file, as a reflink if enabled and supported. """
+    log(flags, "Linking file: {}\nTo: {}", TextType.STD, operation.source,
+        operation.target)
+    try:
+        if not flags[Flag.SAFEMODE]:
+            link_file(operation.source, operation.target, flags[Flag.REFLINK])
+        return {'f_l': 1}
+    except OSError as err:
+        log_err(flags, "Error (OsError: {}) while linking file: {}".
+                format(err.errno, operation.source))
+        return {'err': 1}
+
+
+def _merge_dirs(root_src_dir, root_dst_dir, overwrite=False, verify=False):
     """ Merges two directories. """
     for src_dir, _, files in walk(root_src_dir):
         dst_dir = src_dir.replace(root_src_dir, root_dst_dir, 1)
@@ -674,68 +1567,363 @@ def _merge_dirs(root_src_dir, root_dst_dir, overwrite=False):
             dst_file = path.join(dst_dir, file_)
             if path.isfile(dst_file):
                 if overwrite:
-                    replace(dst_file, src_file)
+                    replace(dst_file, src_file, verify)
             else:
-                renames(src_file, dst_file)
+                renames(src_file, dst_file, verify)
 
 
 ##########################################################
 ################ Archive extraction ######################
 
-def _extract_and_clean_archives(flags, root_dir):
-    """ Extracts all archives and removes the compressed archives. """
-    op_counter = {}
+# Archive volume names, either name.part1.rar, name.part2.rar...
+# or the older name.rar, name.r00, name.r01...
+_ARCHIVE_PART_PATTERN = compile_regex(r'(?i)^(.+)\.part(\d{1,3})\.rar$')
+_ARCHIVE_VOLUME_PATTERN = compile_regex(r'(?i)^(.+)\.(rar|r\d{2,3})$')
 
-    for content_folder in listdir(root_dir):
-        # Set the current series to walk through.
-        current_dir = path.join(root_dir, content_folder)
 
-        # Go through files in a series folder and check path.
-        for dir_path, _, files in walk(current_dir):
-            for file_ in files:
-                if file_.endswith(".rar"):
-                    op_counter = _merge_op_counts(op_counter,
-                                                  _extract_rar(flags, dir_path,
-                                                               file_))
-                    op_counter = _merge_op_counts(op_counter,
-                                                  _remove_archive(flags,
-                                                                  dir_path,
-                                                                  file_))
-    return op_counter
-
-
-def _extract_rar(flags, dir_path, main_file):
-    """ Extracts a .rar archive. """
-    log(flags, "Extracting archive: " + path.join(dir_path, main_file))
+def _index_archive_sets(files):
+    """ Groups the archive volumes among the files of a directory into sets.
+        Returns a dict of first volume -> all volumes in order, sets without
+        a first volume can't be extracted and are left out.
+    """
+    volumes_by_set = {}
+    for file_ in files:
+        match = _ARCHIVE_PART_PATTERN.match(file_.name)
+        if match is not None:
+            set_key = (match.group(1).lower(), True)
+            number = int(match.group(2))
+        else:
+            match = _ARCHIVE_VOLUME_PATTERN.match(file_.name)
+            if match is None:
+                continue
+            set_key = (match.group(1).lower(), False)
+            # The .rar volume comes before .r00.
+            suffix = match.group(2).lower()
+            number = 0 if suffix == "rar" else int(suffix[1:]) + 1
+        volumes_by_set.setdefault(set_key, []).append((number, file_))
+
+    archive_sets = {}
+    for (_, is_part_set), volumes in volumes_by_set.items():
+        volumes.sort(key=lambda volume: volume[0])
+        # Sets are extracted from the .part1.rar or .rar volume.
+        if volumes[0][0] == (1 if is_part_set else 0):
+            archive_sets[volumes[0][1]] = [file_ for _, file_ in volumes]
+    return archive_sets
+
+
+def _extract_and_clean_archives(flags, root_dir, titles, metrics, jobs=1,
+                                extract_jobs=None, classifier=None,
+                                library=None):
+    """ Extracts all archives and removes the compressed archives, the
+        operations are added to the metrics (LibraryMetrics).
+        Returns the scanned titles, titles with extracted archives are
+        rescanned.
+        The members of the archives in a library ("movie" or "tv") are
+        extracted to their cleaned paths where known, see _ExtractLayout.
+    """
+    plan = _OperationPlan(root_dir)
+    # The volumes of each extracted archive set by first volume.
+    archive_sets = {}
+    extracted_titles = set()
+    layouts = {}
+
+    for entry, tree in titles:
+        # Go through files in a title folder and check path.
+        for dir_path, _, files in tree or []:
+            for first_volume, volumes in _index_archive_sets(files).items():
+                plan.extract(first_volume.full_path, dir_path,
+                             sum(volume.size for volume in volumes))
+                archive_sets[first_volume.full_path] = volumes
+                extracted_titles.add(entry.full_path)
+                if library is not None:
+                    layouts[first_volume.full_path] = \
+                        _get_extract_layout(library, entry)
+
+    _execute_extractions(flags, plan, extract_jobs, classifier, layouts)
+
+    # Remove all volumes of the archive sets that were extracted.
+    removal_plan = _OperationPlan(root_dir)
+    for first_volume, volumes in archive_sets.items():
+        if first_volume not in plan.failed:
+            for volume in volumes:
+                removal_plan.remove(volume.full_path, "archive",
+                                    size=volume.size)
+    _execute_plan(flags, removal_plan, jobs)
+    _add_plan_metrics(metrics, plan)
+    _add_plan_metrics(metrics, removal_plan)
+
+    # The title content has changed, scan it again.
+    if not flags[Flag.SAFEMODE] and extracted_titles:
+        trees = _map_grouped(jobs, _scan_title,
+                             [(entry,) for entry, _ in titles
+                              if entry.full_path in extracted_titles])
+        trees.reverse()
+        titles = [(entry, trees.pop())
+                  if entry.full_path in extracted_titles else (entry, tree)
+                  for entry, tree in titles]
+    return titles
+
+
+def _execute_extractions(flags, plan, workers=None, classifier=None,
+                         layouts=None):
+    """ Extracts the planned archives using a pool of worker processes.
+        Archives that failed are added to plan.failed. By default one worker
+        is used per device the archives are extracted to, a single worker
+        extracts in this process.
+        The members are placed by the _ExtractLayout of each archive in
+        layouts, by archive path, if any. In safemode nothing is extracted.
+    """
+    operations, device_count = _order_by_device(plan.operations)
+    if workers is None:
+        workers = device_count
+    layouts = layouts or {}
+    in_process = flags[Flag.SAFEMODE] or workers <= 1 or len(operations) <= 1
+
+    with nullcontext() if in_process else \
+            ProcessPoolExecutor(workers) as executor:
+        futures = []
+        for operation in operations:
+            log(flags, "Extracting archive: {}", TextType.STD,
+                operation.source)
+            args = (_extract_rar_archive, operation.source, operation.target,
+                    classifier, layouts.get(operation.source))
+            futures.append(_call_in_process(flags, *args) if in_process
+                           else executor.submit(_call_timed, *args))
+        for operation, future in zip(operations, futures):
+            try:
+                _, duration = future.result()
+                count = {'a_e': 1}
+            except (rarfile.Error, OSError, BrokenProcessPool) as err:
+                # A worker that died breaks the pool, the archives left are
+                # failed and extracted again by the next run.
+                _log_extraction_error(flags, operation, err)
+                plan.failed.add(operation.source)
+                duration, count = None, {'err': 1}
+            _record_operation(flags, operation, count, duration)
+
+
+def _order_by_device(operations):
+    """ Orders operations round-robin over the devices of their targets so
+        concurrent operations are spread over the devices.
+        Returns the ordered operations and the number of devices.
+    """
+    by_device = {}
+    for operation in operations:
+        try:
+            device = stat(operation.target).st_dev
+        except OSError:
+            device = None
+        by_device.setdefault(device, []).append(operation)
+    return [operation for operations_ in zip_longest(*by_device.values())
+            for operation in operations_ if operation is not None], \
+        len(by_device)
+
+
+def _call_timed(func, *args):
+    """ Calls func with args, returns the result and the seconds taken. """
+    started = monotonic()
+    return func(*args), monotonic() - started
+
+
+def _call_in_process(flags, func, *args):
+    """ Calls func with args like a process pool worker, returns a Future
+        of the timed result or the error. In safemode nothing is called.
+    """
+    future = Future()
     try:
-        if not flags[Flag.SAFEMODE]:
-            # Set to '/' to be more compatible with zipfile
-            rarfile.PATH_SEP = '/'
-            # Open rar archive.
-            with RarFile(path.join(dir_path, main_file)) as r_file:
-                r_file.extractall(dir_path)
-        return {'a_e': 1}
-    except rarfile.Error:
-        log_err(flags, "Error (rarfile.Error) while extracting archive: {}".
-                format(path.join(dir_path, main_file)))
-        return {'err': 1}
+        future.set_result(_call_timed(func, *args)
+                          if not flags[Flag.SAFEMODE] else (None, 0.0))
+    except (rarfile.Error, OSError) as err:
+        future.set_exception(err)
+    return future
+
+
+def _log_extraction_error(flags, operation, err):
+    """ Logs an error extracting an archive. """
+    if isinstance(err, rarfile.Error):
+        cause = "rarfile.Error"
+    elif isinstance(err, OSError):
+        cause = "OsError: {}".format(err.errno)
+    else:
+        cause = type(err).__name__
+    log_err(flags, "Error ({}) while extracting archive: {}".format(
+        cause, operation.source))
 
 
-def _remove_archive(flags, dir_path, main_file):
-    """ Removes all archive files belonging to and including the main file. """
-    for file_ in listdir(dir_path):
-        if _is_compressed_file(file_) and main_file[:-4] in file_:
-            log(flags, "Removing archive file: " +
-                path.join(dir_path, file_))
-            try:
-                if not flags[Flag.SAFEMODE]:
-                    remove(path.join(dir_path, file_))
-                return {'f_rm': 1}
-            except OSError as err:
-                log_err(flags, "Error (OsError: {}) while removing archive: {}".
-                        format(err.errno, path.join(dir_path, main_file)))
-                return {'err': 1}
-    return {}
+# Bytes read per block when streaming archive members.
+_EXTRACT_READ_SIZE = 1048576
+
+
+class _ExtractLayout(namedtuple('_ExtractLayout',
+                                ['library', 'title_dir', 'title_name'])):
+    """ Where the members of an archive in a title of a library ("movie" or
+        "tv") are cleaned to. The title name is the cleaned name of the title
+        directory, None if it's only known after the extraction.
+    """
+    __slots__ = ()
+
+
+def _get_extract_layout(library, entry):
+    """ Returns the _ExtractLayout of the archives in a scanned title.
+        The cleaned title name is only known before the extraction if the
+        title is already named properly, otherwise it may be recovered from
+        the extracted files.
+    """
+    title_name = None
+    if library == "tv":
+        if _is_valid_media_name(entry.name):
+            title_name = entry.name.strip()
+    else:
+        match_ = _get_movie_name_year_match(entry.name)
+        if match_ is not None and _is_valid_media_name(match_[0]):
+            title_name = _get_clean_movie_dir_name(entry.name, None)
+    return _ExtractLayout(library, entry.full_path, title_name)
+
+
+def _extract_rar_archive(archive_path, target_dir, classifier=None,
+                         layout=None):
+    """ Extracts the wanted members of a .rar archive, files that the
+        cleaning would remove, like samples and other junk, are never
+        written. With a layout (_ExtractLayout) the members are streamed to
+        their cleaned paths where known, into target_dir otherwise.
+        Raises rarfile.BadRarFile for members outside target_dir.
+    """
+    classifier = classifier or _CLASSIFIER
+    with RarFile(archive_path) as r_file:
+        # Pick the members from the archive listing and stream only those.
+        for info in r_file.infolist():
+            target = _get_member_target(info, classifier, layout, target_dir)
+            if target is not None:
+                _extract_member(r_file, info, target)
+
+
+def _get_member_name(info):
+    """ Returns the normalized path of an archive member relative to the
+        extraction directory. Raises rarfile.BadRarFile for absolute names
+        and names with parent directory parts.
+    """
+    name = path.normpath(info.filename)
+    if path.isabs(name) or name == "." or ".." in name.split(path.sep):
+        raise rarfile.BadRarFile("Archive member outside the archive "
+                                 "directory: {}".format(info.filename))
+    return name
+
+
+def _get_member_target(info, classifier, layout, target_dir):
+    """ Returns the path an archive member is extracted to, None if the
+        cleaning would remove it.
+    """
+    if not info.is_file():
+        # Directories are created for the extracted files, links are never
+        # extracted.
+        return None
+    member_name = _get_member_name(info)
+    name = path.basename(member_name)
+    kind = classifier.classify(name, info.file_size)
+    if kind is FileKind.SAMPLE or kind is FileKind.OTHER:
+        return None
+    elif layout is None:
+        return path.join(target_dir, member_name)
+
+    is_episode = kind.is_main and _parse_release_name(name).has_markers
+    if layout.library == "tv" and kind.is_main and not is_episode:
+        # Main files that aren't episodes are removed from tv-series.
+        return None
+    elif layout.title_name is None or kind is FileKind.ARCHIVE or \
+            kind is FileKind.PARTIAL:
+        return path.join(target_dir, member_name)
+    elif kind is FileKind.EXTRAS:
+        return path.join(layout.title_dir, "Extras", name)
+    elif kind is FileKind.MUSIC:
+        return path.join(layout.title_dir, "Soundtrack", name)
+
+    # The planned path of a main file, see _clean_*_main_file.
+    subtitle = kind is FileKind.SUBTITLE
+    if layout.library == "tv":
+        release = _parse_release_name(name)
+        return path.join(layout.title_dir, "Season {}".format(release.season),
+                         "{} S{}E{}".format(layout.title_name,
+                                            release.season.zfill(2),
+                                            release.episode.zfill(2)),
+                         _get_clean_tv_main_file_name(name, layout.title_name,
+                                                      subtitle))
+    return path.join(layout.title_dir, _get_clean_movie_main_file_name(
+        name, layout.title_name, subtitle))
+
+
+def _extract_member(r_file, info, target):
+    """ Streams an archive member to a file, through a partial file that is
+        renamed once complete. Existing files are never overwritten, the
+        member is given a numbered name instead.
+    """
+    target_dir = path.dirname(target)
+    if not path.isdir(target_dir):
+        makedirs(target_dir, exist_ok=True)
+    target = _reserve_file(target)
+    partial = target + PARTIAL_SUFFIX
+    try:
+        with r_file.open(info) as member, open(partial, 'wb') as file_:
+            copyfileobj(member, file_, _EXTRACT_READ_SIZE)
+    except (rarfile.Error, OSError):
+        for path_ in (partial, target):
+            if path.exists(path_):
+                remove(path_)
+        raise
+    # Keep the modification time of the member.
+    if info.date_time:
+        mtime = mktime(info.date_time + (0, 0, -1))
+        utime(partial, (mtime, mtime))
+    replace(partial, target)
+
+
+def _reserve_file(file_path):
+    """ Creates an empty file at the path, or at the first free numbered
+        path like "name (2).mkv" if it exists. Returns the created path.
+        Files are created exclusively, concurrent extractions never get the
+        same path.
+    """
+    root, suffix = path.splitext(file_path)
+    number = 1
+    while True:
+        try:
+            with open(file_path, 'xb'):
+                return file_path
+        except FileExistsError:
+            number += 1
+            file_path = "{} ({}){}".format(root, number, suffix)
+
+
+##########################################################
+###################### Concurrency #######################
+
+def _map_grouped(jobs, func, args_list):
+    """ Calls func with each argument tuple using up to jobs threads.
+        Returns the results in order, the log output of each call is
+        printed as a group in the same order.
+    """
+    if jobs <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+
+    results = []
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = [executor.submit(_call_buffered, func, args)
+                   for args in args_list]
+        for future in futures:
+            result, messages = future.result()
+            _write_output(messages)
+            results.append(result)
+    return results
+
+
+def _call_buffered(func, args):
+    """ Calls func with buffered log output, returns the result and the
+        buffered messages.
+    """
+    _LOG_BUFFER.messages = []
+    try:
+        return func(*args), _LOG_BUFFER.messages
+    finally:
+        _LOG_BUFFER.messages = None
 
 
 ##########################################################
@@ -748,6 +1936,7 @@ _OP_KEYS = ['a_e',
             'f_rm',
             'f_r',
             'f_m',
+            'f_l',
             'd_rm',
             'd_r',
             'd_m',
@@ -758,6 +1947,7 @@ _OP_VALUES = ["Archive extraction",
               "File remove",
               "File rename",
               "File move",
+              "File link",
               "Directory remove",
               "Directory rename",
               "Directory move",
@@ -765,17 +1955,35 @@ _OP_VALUES = ["Archive extraction",
               "Error"]
 
 
+def _get_op_name(key):
+    """ Returns the metric name of an operation, like file_move. """
+    return _OP_VALUES[_OP_KEYS.index(key)].lower().replace(" ", "_")
+
+
+def _add_plan_metrics(metrics, plan):
+    """ Adds the executed operations of a plan and their bytes to the
+        metrics, operations that failed are counted as errors.
+    """
+    for operation in plan.operations:
+        if operation.source in plan.failed:
+            metrics.add_operations(_get_op_name('err'), 1)
+        else:
+            metrics.add_operations(_get_op_name(operation.op), 1,
+                                   operation.size or 0)
+
+
 def _format_op_count(op_count):
-    """ Formats an operation count """
+    """ Formats an operation count by metric name """
     f_str = []
     for i, key in enumerate(_OP_KEYS):
-        if key in op_count:
-            f_str.append("- " + _OP_VALUES[i] + ": " + str(op_count[key]))
+        if _get_op_name(key) in op_count:
+            f_str.append("- " + _OP_VALUES[i] + ": " +
+                         str(op_count[_get_op_name(key)]))
     return "\n".join(f_str)
 
 
 def _print_op_count(flags, op_count):
-    """ Prints an operation count summary. """
+    """ Prints an operation count summary, by metric name. """
     if len(op_count.keys()) > 0:
         # Check that it's not empty.
         log(flags, "Operation count" +
@@ -786,16 +1994,6 @@ def _print_op_count(flags, op_count):
         log(flags, "No operations performed.", TextType.INFO)
 
 
-def _merge_op_counts(op_count1, op_count2):
-    """ Merges and adds two operation counters. """
-    for key, val in op_count2.items():
-        if key in op_count1:
-            op_count1[key] += val
-        else:
-            op_count1[key] = val
-    return op_count1
-
-
 ##########################################################
 ####################### Logging ##########################
 
@@ -833,30 +2031,128 @@ class TextType(object):
     STD = ([], 0)
 
 
-def _print_format(msg, format_):
+# Log messages of threads running grouped calls are buffered.
+_LOG_BUFFER = local()
+
+# Console output is written in blocks of this many lines, messages with a
+# priority above standard are written at once.
+_OUTPUT_BLOCK_LINES = 256
+
+# Console output waiting to be written.
+_OUTPUT = []
+_OUTPUT_LOCK = Lock()
+
+
+class _RecordLog(object):
+    """ A JSON-lines file of operation records shared by all threads. """
+
+    def __init__(self):
+        self.file = None
+        self._lock = Lock()
+
+    def write(self, record):
+        """ Writes a record as a line. """
+        line = dumps(record) + "\n"
+        with self._lock:
+            self.file.write(line)
+
+
+# The operation records of the executed plans, see json_log.
+_RECORD_LOG = _RecordLog()
+
+
+@contextmanager
+def json_log(file_path):
+    """ Appends a JSON record of each executed operation to a file while in
+        the context, one record per line.
+    """
+    with open(file_path, 'a') as file_:
+        _RECORD_LOG.file = file_
+        try:
+            yield file_
+        finally:
+            _RECORD_LOG.file = None
+
+
+def _record_operation(flags, operation, count, duration):
+    """ Writes the record of an executed operation if records are logged.
+        Nothing is recorded in safemode.
+    """
+    if _RECORD_LOG.file is None or flags[Flag.SAFEMODE]:
+        return
+    _RECORD_LOG.write({"time": time(),
+                       "operation": operation.op,
+                       "source": operation.source,
+                       "target": operation.target,
+                       "kind": operation.type_,
+                       "reason": operation.reason,
+                       "bytes": operation.size,
+                       "duration": duration,
+                       "error": 'err' in count})
+
+
+def _print_format(msg, format_, flush=False):
     """
     Prints the "msg" to stdout using the specified text format
     (TextFormat class). Prints just standard text if no formats are given.
     """
     if format_:
         # Print format codes., message and end code.
-        print("".join(format_) + msg + _ColorCode.ENDC)
+        _print("".join(format_) + msg + _ColorCode.ENDC, flush)
     else:
-        print(msg)
+        _print(msg, flush)
 
 
-def log(flags, msg, type_=TextType.STD):
+def _print(msg, flush=False):
+    """ Prints a message, or buffers it if the thread buffers its output.
+    """
+    messages = getattr(_LOG_BUFFER, "messages", None)
+    if messages is not None:
+        messages.append(msg)
+    else:
+        _write_output([msg], flush)
+
+
+def _write_output(messages, flush=False):
+    """ Writes messages to stdout once a block of lines is buffered, or at
+        once with flush.
+    """
+    with _OUTPUT_LOCK:
+        _OUTPUT.extend(messages)
+        if _OUTPUT and (flush or len(_OUTPUT) >= _OUTPUT_BLOCK_LINES):
+            stdout.write("\n".join(_OUTPUT) + "\n")
+            _OUTPUT.clear()
+            if flush:
+                stdout.flush()
+
+
+@register
+def flush_log():
+    """ Writes all buffered console output, done at exit as well. """
+    _write_output([], True)
+
+
+def _is_logged(flags, type_):
+    """ Checks if messages of a text type are printed. """
+    # Always print error messages and similar.
+    return (type_[1] >= 2) or flags[Flag.VERBOSE] \
+        or (not flags[Flag.QUIET] and type_[1] == 1)
+
+
+def log(flags, msg, type_=TextType.STD, *args):
     """
     Prints log message depending on verbose flag and priority.
     Default priority is 0 which only prints if verbose, 1 always prints.
+    The message is formatted with args, if any, only when printed.
     """
-    # Always print error messages and similar.
-    if (type_[1] >= 2) or flags[Flag.VERBOSE] \
-            or (not flags[Flag.QUIET] and type_[1] == 1):
-        if flags[Flag.COLOR]:
-            _print_format(msg, type_[0])
-        else:
-            print(msg)
+    if not _is_logged(flags, type_):
+        return
+    if args:
+        msg = msg.format(*args)
+    if flags[Flag.COLOR]:
+        _print_format(msg, type_[0], type_[1] >= 1)
+    else:
+        _print(msg, type_[1] >= 1)
 
 
 def log_err(flags, msg):
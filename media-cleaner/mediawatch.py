@@ -0,0 +1,188 @@
+"""
+mediawatch module:
+Contains functions for watching media libraries for changes using inotify.
+"""
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from errno import ENOENT
+from os import read, close, walk, fsencode, fsdecode, strerror, path
+from select import select
+from struct import calcsize, unpack_from
+
+# Inotify flags and event masks, see inotify(7).
+_IN_CLOEXEC = 0o2000000
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+
+# Events watched on every library directory.
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_ONLYDIR
+
+# Events that make a title need cleaning, a file is written or moved in.
+_CHANGE_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO
+
+# The inotify_event struct header: wd, mask, cookie, len.
+_EVENT_FORMAT = "iIII"
+_EVENT_SIZE = calcsize(_EVENT_FORMAT)
+
+# Seconds without events before changed titles are cleaned.
+SETTLE_TIME = 30
+
+
+class _Inotify(object):
+    """ An inotify instance watching directory trees. """
+
+    def __init__(self):
+        try:
+            self._libc = CDLL(find_library("c"), use_errno=True)
+            self._fd = self._libc.inotify_init1(_IN_CLOEXEC)
+        except (OSError, AttributeError):
+            raise RuntimeError("Watch mode requires inotify (Linux)")
+        if self._fd < 0:
+            raise RuntimeError("Could not start inotify: {}".
+                               format(strerror(get_errno())))
+        # Watched directory paths by watch descriptor.
+        self._paths = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        close(self._fd)
+
+    def add_tree(self, top):
+        """ Watches a directory and all directories below it. """
+        for dir_path, _, _ in walk(top):
+            wd = self._libc.inotify_add_watch(self._fd, fsencode(dir_path),
+                                              _WATCH_MASK)
+            if wd < 0 and get_errno() == ENOENT:
+                # Removed before it could be watched.
+                continue
+            elif wd < 0:
+                raise RuntimeError(
+                    "Could not watch directory: {} ({}), see "
+                    "fs.inotify.max_user_watches".
+                    format(dir_path, strerror(get_errno())))
+            self._paths[wd] = dir_path
+
+    def read_events(self, timeout):
+        """ Waits for events, returns a list of (path, mask) tuples.
+            None as timeout waits until there is an event.
+            Directories that are created are watched as well.
+        """
+        if not select([self._fd], [], [], timeout)[0]:
+            return []
+
+        events = []
+        buffer_ = read(self._fd, 65536)
+        offset = 0
+        while offset < len(buffer_):
+            wd, mask, _, length = unpack_from(_EVENT_FORMAT, buffer_, offset)
+            name = buffer_[offset + _EVENT_SIZE:
+                           offset + _EVENT_SIZE + length].rstrip(b"\0")
+            offset += _EVENT_SIZE + length
+
+            if mask & _IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            elif mask & _IN_IGNORED or wd not in self._paths:
+                # The directory is gone or no longer watched.
+                self._paths.pop(wd, None)
+                continue
+
+            event_path = path.join(self._paths[wd], fsdecode(name))
+            if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                self.add_tree(event_path)
+            events.append((event_path, mask))
+        return events
+
+
+def _get_title(roots, event_path):
+    """ Returns the (root, title name) of a changed path, None if not in a
+        title.
+    """
+    for root in roots:
+        relative_path = path.relpath(event_path, root)
+        if not relative_path.startswith(path.pardir) and relative_path != ".":
+            return root, relative_path.split(path.sep, 1)[0]
+    return None
+
+
+def watch_libraries(roots, clean_titles, settle_time=SETTLE_TIME):
+    """ Watches library roots and cleans titles as they change.
+        Changes are collected until no events have arrived for settle_time
+        seconds, then clean_titles(root, title_names) is called for each
+        root, title_names is None if all titles should be cleaned.
+        clean_titles returns the paths changed by the cleaning, their events
+        are ignored, or None to retry the titles later.
+        Runs until interrupted.
+    """
+    roots = [path.abspath(root) for root in roots]
+    with _Inotify() as inotify:
+        for root in roots:
+            inotify.add_tree(root)
+
+        # Titles waiting to be cleaned by root, None for all titles.
+        pending = {}
+        while True:
+            events = inotify.read_events(settle_time if pending else None)
+            if events:
+                _add_pending(pending, roots, events)
+                continue
+
+            # Quiet, clean the changed titles.
+            cleaned = {}
+            for root in list(pending):
+                changed_paths = clean_titles(root, pending[root])
+                if changed_paths is not None:
+                    cleaned[root] = _get_cleaned_titles(
+                        roots, root, pending.pop(root), changed_paths)
+
+            # Ignore the changes made by the cleaning itself, the watches of
+            # created directories are still added when reading.
+            events = inotify.read_events(0)
+            while events:
+                _add_pending(pending, roots, events, cleaned)
+                events = inotify.read_events(0)
+
+
+def _get_cleaned_titles(roots, root, title_names, changed_paths):
+    """ Returns the names of the cleaned titles of a root and of the titles
+        the cleaning changed, None if all titles were cleaned.
+    """
+    if title_names is None:
+        return None
+    titles = set(title_names)
+    for changed_path in changed_paths:
+        title = _get_title(roots, changed_path)
+        if title is not None and title[0] == root:
+            titles.add(title[1])
+    return titles
+
+
+def _add_pending(pending, roots, events, ignored=None):
+    """ Adds the titles changed by the events to the pending titles.
+        Titles in ignored, by root as in pending, are left out.
+    """
+    ignored = ignored or {}
+    for event_path, mask in events:
+        if event_path is None:
+            # Events were lost, clean everything.
+            for root in roots:
+                pending[root] = None
+        elif mask & _CHANGE_MASK or mask & _IN_ISDIR and mask & _IN_CREATE:
+            title = _get_title(roots, event_path)
+            if title is None:
+                continue
+            root, title_name = title
+            if root in ignored and (ignored[root] is None or
+                                    title_name in ignored[root]):
+                continue
+            if root not in pending:
+                pending[root] = set()
+            if pending[root] is not None:
+                pending[root].add(title_name)
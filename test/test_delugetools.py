@@ -0,0 +1,234 @@
+"""
+test_delugetools module:
+Contains tests of the deluged RPC client and its rencode codec.
+"""
+import socket
+import ssl
+import sys
+import threading
+import unittest
+import zlib
+from os import path
+from struct import pack, unpack
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..",
+                             "media-cleaner"))
+
+import delugetools
+from delugetools import _rencode_dumps, _rencode_loads, \
+    get_torrent_snapshot, invalidate_torrent_snapshot
+
+# The self-signed certificate and key of the stub daemon.
+_CERT_PATH = path.join(path.dirname(path.abspath(__file__)), "deluged.pem")
+
+# Values and their encoding by the rencode package used by deluge.
+_ENCODED = [(0, b"\x00"),
+            (43, b"+"),
+            (44, b">,"),
+            (-1, b"F"),
+            (-32, b"e"),
+            (-33, b">\xdf"),
+            (-128, b">\x80"),
+            (128, b"?\x00\x80"),
+            (-32768, b"?\x80\x00"),
+            (32768, b"@\x00\x00\x80\x00"),
+            (-2 ** 31, b"@\x80\x00\x00\x00"),
+            (2 ** 31, b"A\x00\x00\x00\x00\x80\x00\x00\x00"),
+            (-2 ** 63, b"A\x80\x00\x00\x00\x00\x00\x00\x00"),
+            (2 ** 63, b"=9223372036854775808\x7f"),
+            (-2 ** 64, b"=-18446744073709551616\x7f"),
+            (1.5, b",?\xf8\x00\x00\x00\x00\x00\x00"),
+            ("", b"\x80"),
+            ("abc", b"\x83abc"),
+            ("x" * 64, b"64:" + b"x" * 64),
+            ("åäö", b"\x86\xc3\xa5\xc3\xa4\xc3\xb6"),
+            (b"\xff\x00", b"\x82\xff\x00"),
+            (None, b"E"),
+            (True, b"C"),
+            (False, b"D"),
+            ((), b"\xc0"),
+            ((1, "a", (None,)), b"\xc3\x01\x81a\xc1E"),
+            ({}, b"f"),
+            ({"a": 1, "b": (True,)}, b"h\x81a\x01\x81b\xc1C")]
+
+# Deluge message types.
+_RPC_RESPONSE = 1
+_RPC_ERROR = 2
+_RPC_EVENT = 3
+
+
+class RencodeTest(unittest.TestCase):
+    """ Tests the rencode codec against the deluge encoding. """
+
+    def test_encode(self):
+        """ Values are encoded like deluge encodes them. """
+        for value, encoded in _ENCODED:
+            self.assertEqual(_rencode_dumps(value), encoded, value)
+
+    def test_decode(self):
+        """ The deluge encoding is decoded to the values. """
+        for value, encoded in _ENCODED:
+            self.assertEqual(_rencode_loads(encoded), value, encoded)
+
+    def test_decode_float32(self):
+        """ Floats encoded in 32 bits by deluge are decoded. """
+        self.assertEqual(_rencode_loads(b"B?\xc0\x00\x00"), 1.5)
+
+    def test_round_trip(self):
+        """ Values of every type and size are decoded as encoded. """
+        values = [value for bits in (8, 16, 32, 64)
+                  for value in (2 ** (bits - 1) - 1, -2 ** (bits - 1))]
+        values += [2 ** 100, -2 ** 100, 0.1, -1e300, "x" * 63, "y" * 1000,
+                   b"\xff" * 70, tuple(range(64)), tuple(range(100)),
+                   {key: key for key in range(25)},
+                   {str(key): (key, None) for key in range(100)},
+                   {"files": ({"path": "a/b.mkv", "size": 2 ** 40},),
+                    "nested": {"list": (True, False, None, -5, 2.5)}}]
+        for value in values:
+            self.assertEqual(_rencode_loads(_rencode_dumps(value)), value)
+
+    def test_lists_decoded_as_tuples(self):
+        """ Lists are decoded as tuples like deluge decodes them. """
+        self.assertEqual(_rencode_loads(_rencode_dumps([1, [2]])), (1, (2,)))
+
+    def test_trailing_data(self):
+        """ Data after the value is rejected. """
+        with self.assertRaises(ValueError):
+            _rencode_loads(b"\x00\x00")
+
+
+class _StubDaemon(threading.Thread):
+    """ A deluged answering one client over TLS with the torrents, logins
+        with another password are refused.
+    """
+
+    def __init__(self, torrents, password):
+        super().__init__(daemon=True)
+        self.torrents = torrents
+        self.password = password
+        # The (method, args, kwargs) of the received requests.
+        self.requests = []
+        self._context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self._context.load_cert_chain(_CERT_PATH)
+        self._server = socket.create_server(("127.0.0.1", 0))
+        self.port = self._server.getsockname()[1]
+
+    def run(self):
+        connection, _ = self._server.accept()
+        with self._context.wrap_socket(connection,
+                                       server_side=True) as connection:
+            while True:
+                header = _receive_exactly(connection, 5)
+                if header is None:
+                    return
+                version, length = unpack("!BI", header)
+                (request_id, method, args, kwargs), = _rencode_loads(
+                    zlib.decompress(_receive_exactly(connection, length)))
+                self.requests.append((method, args, kwargs))
+                # Events may come before the response.
+                self._send(connection, (_RPC_EVENT, "TorrentAddedEvent",
+                                        ("id",)))
+                if method == "daemon.login" and args[1] != self.password:
+                    self._send(connection, (_RPC_ERROR, request_id,
+                                            "BadLoginError",
+                                            ("Password does not match",),
+                                            ""))
+                elif method == "daemon.login":
+                    self._send(connection, (_RPC_RESPONSE, request_id, 10))
+                else:
+                    self._send(connection, (_RPC_RESPONSE, request_id,
+                                            self.torrents))
+
+    def _send(self, connection, message):
+        """ Sends a rencoded and compressed message. """
+        body = zlib.compress(_rencode_dumps(message))
+        connection.sendall(pack("!BI", 1, len(body)) + body)
+
+    def close(self):
+        """ Stops accepting clients. """
+        self._server.close()
+
+
+def _receive_exactly(connection, size):
+    """ Receives size bytes, None if the connection is closed. """
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class TorrentSnapshotTest(unittest.TestCase):
+    """ Tests the torrent state read from a stub daemon. """
+
+    def setUp(self):
+        self._temp_dir = TemporaryDirectory()
+        self.auth_path = path.join(self._temp_dir.name, "auth")
+        with open(self.auth_path, 'w') as auth_file:
+            auth_file.write("user:other:5\nlocalclient:secret:10\n")
+        self.torrents = {
+            "a1": {"state": "Downloading", "is_finished": False,
+                   "save_path": "/downloads", "name": "Movie.2015.1080p",
+                   "files": [{"path": "Movie.2015.1080p/movie.mkv"}]},
+            "b2": {"state": "Seeding", "is_finished": True,
+                   "save_path": "/downloads", "name": "Show.S01E01",
+                   "files": [{"path": "Show.S01E01.mkv"}]},
+            "c3": {"state": "Paused", "is_finished": True,
+                   "save_path": "/downloads", "name": "Old.2001",
+                   "files": []}}
+
+    def tearDown(self):
+        for client in delugetools._clients.values():
+            client.close()
+        delugetools._clients.clear()
+        self._temp_dir.cleanup()
+
+    def _start_daemon(self, password="secret"):
+        """ Starts a stub daemon, returns it. """
+        daemon = _StubDaemon(self.torrents, password)
+        daemon.start()
+        self.addCleanup(daemon.close)
+        self.addCleanup(invalidate_torrent_snapshot, "127.0.0.1",
+                        daemon.port)
+        return daemon
+
+    def test_snapshot(self):
+        """ The torrent state is read over the RPC protocol. """
+        daemon = self._start_daemon()
+        snapshot = get_torrent_snapshot("127.0.0.1", daemon.port,
+                                        self.auth_path, 0)
+
+        self.assertEqual(daemon.requests[0],
+                         ("daemon.login", ("localclient", "secret"),
+                          {"client_version": "2.0.0"}))
+        self.assertEqual(daemon.requests[1][0], "core.get_torrents_status")
+        self.assertTrue(snapshot.has_active)
+        self.assertEqual(set(snapshot.torrents), set(self.torrents))
+        self.assertEqual(snapshot.active_paths,
+                         {"/downloads/Movie.2015.1080p",
+                          "/downloads/Show.S01E01",
+                          "/downloads/Show.S01E01.mkv"})
+        self.assertEqual(snapshot.incomplete_paths,
+                         {"/downloads/Movie.2015.1080p"})
+
+    def test_connection_kept(self):
+        """ The connection is kept and reused by the next check. """
+        daemon = self._start_daemon()
+        get_torrent_snapshot("127.0.0.1", daemon.port, self.auth_path, 0)
+        get_torrent_snapshot("127.0.0.1", daemon.port, self.auth_path, 0)
+        self.assertEqual([request[0] for request in daemon.requests],
+                         ["daemon.login", "core.get_torrents_status",
+                          "core.get_torrents_status"])
+
+    def test_login_refused(self):
+        """ An error response of the daemon raises a RuntimeError. """
+        daemon = self._start_daemon("other")
+        with self.assertRaises(RuntimeError):
+            get_torrent_snapshot("127.0.0.1", daemon.port, self.auth_path, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+test_mediaconfig module:
+Contains tests of the config file loading.
+"""
+import sys
+import unittest
+from os import path
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..",
+                             "media-cleaner"))
+
+from mediaconfig import load_config
+
+
+class LoadConfigTest(unittest.TestCase):
+    """ Tests the settings read from the config file. """
+
+    def setUp(self):
+        self._temp_dir = TemporaryDirectory()
+        self.config_path = path.join(self._temp_dir.name, "config.yaml")
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def _load(self, text):
+        """ Loads a config file holding text. """
+        with open(self.config_path, 'w') as config_file:
+            config_file.write(text)
+        return load_config(self.config_path)
+
+    def test_settings(self):
+        """ The settings are read into the config. """
+        config = self._load("path: {movie: /movies}\n"
+                            "size: {sort-increment: 5, min-video: 1}\n"
+                            "jobs: 4\nextract-jobs: 2\nsnapshot-ttl: 0\n")
+        self.assertEqual(config.paths, {"movie": "/movies"})
+        self.assertEqual(config.classifier.size_sort_increment, 5)
+        self.assertEqual(config.classifier.min_video_size, 1)
+        self.assertEqual((config.jobs, config.extract_jobs,
+                          config.snapshot_ttl), (4, 2, 0))
+
+    def test_defaults(self):
+        """ Missing settings keep their defaults. """
+        config = self._load("")
+        self.assertEqual(config.paths, {})
+        self.assertEqual((config.jobs, config.extract_jobs), (1, None))
+
+    def test_wrong_type_rejected(self):
+        """ A value of the wrong type is a config error. """
+        for text in ("jobs: two\n", "jobs: true\n", "size: {min-video: x}\n"):
+            with self.assertRaises(RuntimeError, msg=text):
+                self._load(text)
+
+    def test_out_of_range_rejected(self):
+        """ Non-positive sizes and jobs and a negative ttl are config
+            errors.
+        """
+        for text in ("size: {sort-increment: 0}\n",
+                     "size: {min-video: -1}\n",
+                     "size: {min-main-video: 0}\n",
+                     "jobs: 0\n", "extract-jobs: 0\n", "snapshot-ttl: -1\n"):
+            with self.assertRaises(RuntimeError, msg=text):
+                self._load(text)
+
+
+if __name__ == "__main__":
+    unittest.main()
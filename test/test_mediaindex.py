@@ -0,0 +1,100 @@
+"""
+test_mediaindex module:
+Contains tests of the title index.
+"""
+import sqlite3
+import sys
+import unittest
+from os import makedirs, path, rmdir, utime
+from unittest import mock
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..",
+                             "media-cleaner"))
+
+import mediaindex
+from mediaindex import TitleIndex
+
+
+class TitleIndexTest(unittest.TestCase):
+    """ Tests the change detection of indexed titles. """
+
+    def setUp(self):
+        self._temp_dir = TemporaryDirectory()
+        self.root = self._temp_dir.name
+        self.title = path.join(self.root, "Show")
+        self.season = path.join(self.title, "Season 1")
+        makedirs(self.season)
+        self.index = TitleIndex(path.join(self.root, "index.db"))
+        self.index.update(self.title)
+
+    def tearDown(self):
+        self.index.close()
+        self._temp_dir.cleanup()
+
+    def _touch(self, file_path, dir_path):
+        """ Creates a file and moves the mtime of its directory ahead. """
+        open(file_path, 'w').close()
+        utime(dir_path, (0, 2 ** 31))
+
+    def test_unchanged(self):
+        """ An untouched title is unchanged. """
+        self.assertTrue(self.index.is_unchanged(self.title))
+
+    def test_nested_file_added(self):
+        """ A file added in a nested directory changes the title. """
+        self._touch(path.join(self.season, "Show.S01E02.mkv"), self.season)
+        self.assertFalse(self.index.is_unchanged(self.title))
+
+    def test_deep_file_added(self):
+        """ A file added below a nested directory changes the title. """
+        episode = path.join(self.season, "Show S01E01")
+        makedirs(episode)
+        self.index.update(self.title)
+        self._touch(path.join(episode, "RARBG.txt"), episode)
+        self.assertFalse(self.index.is_unchanged(self.title))
+
+    def test_nested_dir_removed(self):
+        """ A nested directory removed changes the title. """
+        rmdir(self.season)
+        utime(self.title, (0, 2 ** 31))
+        self.assertFalse(self.index.is_unchanged(self.title))
+
+    def test_directories_not_read(self):
+        """ Checking an indexed title only stats its directories. """
+        with mock.patch.object(mediaindex, "scandir") as scandir:
+            self.assertTrue(self.index.is_unchanged(self.title))
+        scandir.assert_not_called()
+
+    def test_reopened(self):
+        """ The directory mtimes are kept in the database. """
+        self.index.close()
+        self.index = TitleIndex(path.join(self.root, "index.db"))
+        self.assertTrue(self.index.is_unchanged(self.title))
+        self._touch(path.join(self.season, "Show.S01E02.mkv"), self.season)
+        self.assertFalse(self.index.is_unchanged(self.title))
+
+    def test_index_without_dirs(self):
+        """ Titles of an index without directory mtimes are cleaned again. """
+        self.index.close()
+        conn = sqlite3.connect(path.join(self.root, "index.db"))
+        conn.execute("DROP TABLE dirs")
+        conn.commit()
+        conn.close()
+        self.index = TitleIndex(path.join(self.root, "index.db"))
+        self.assertFalse(self.index.is_unchanged(self.title))
+
+    def test_rescan(self):
+        """ All titles are changed when rescanning. """
+        self.index.rescan = True
+        self.assertFalse(self.index.is_unchanged(self.title))
+
+    def test_removed(self):
+        """ A title that no longer exists is removed by update. """
+        missing = path.join(self.root, "Missing")
+        self.index.update(missing)
+        self.assertFalse(self.index.is_unchanged(missing))
+
+
+if __name__ == "__main__":
+    unittest.main()
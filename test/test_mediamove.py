@@ -0,0 +1,103 @@
+"""
+test_mediamove module:
+Contains tests of the file moves across filesystems.
+"""
+import sys
+import unittest
+from os import path, setxattr, utime
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..",
+                             "media-cleaner"))
+
+import mediamove
+from mediamove import PARTIAL_SUFFIX, _move_file
+from mediatools import FileKind, MediaClassifier
+
+
+def _write(file_path, data):
+    """ Writes data to a file. """
+    with open(file_path, 'wb') as file_:
+        file_.write(data)
+
+
+def _read(file_path):
+    """ Returns the data of a file. """
+    with open(file_path, 'rb') as file_:
+        return file_.read()
+
+
+class MoveFileTest(unittest.TestCase):
+    """ Tests the copying moves of files and their resuming. """
+
+    def setUp(self):
+        self._temp_dir = TemporaryDirectory()
+        self.source = path.join(self._temp_dir.name, "source.mkv")
+        self.target = path.join(self._temp_dir.name, "target.mkv")
+        self.partial = self.target + PARTIAL_SUFFIX
+        _write(self.source, b"new content")
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def _interrupt(self, data):
+        """ Leaves a partial copy of the source holding data, as left by an
+            interrupted move.
+        """
+        copy_range = mediamove._copy_range
+
+        def interrupted(source_fd, target_fd, offset, size):
+            copy_range(source_fd, target_fd, offset, len(data))
+            raise KeyboardInterrupt()
+
+        with mock.patch.object(mediamove, "_copy_range", interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                _move_file(self.source, self.target, False)
+        self.assertEqual(_read(self.partial), data)
+
+    def test_move(self):
+        """ The source is copied to the target and removed. """
+        _move_file(self.source, self.target, False)
+        self.assertEqual(_read(self.target), b"new content")
+        self.assertFalse(path.exists(self.source))
+        self.assertFalse(path.exists(self.partial))
+
+    def test_resumed(self):
+        """ A partial copy of the same source is resumed. """
+        try:
+            self._interrupt(b"new ")
+        except AssertionError:
+            self.skipTest("No extended attributes on the temp filesystem")
+        with mock.patch.object(mediamove, "_copy_range",
+                               wraps=mediamove._copy_range) as copy_range:
+            _move_file(self.source, self.target, False)
+        self.assertEqual(copy_range.call_args[0][2], 4)
+        self.assertEqual(_read(self.target), b"new content")
+
+    def test_stale_partial(self):
+        """ A partial copy of another source of the same size is replaced.
+        """
+        _write(self.partial, b"old content")
+        _move_file(self.source, self.target, False)
+        self.assertEqual(_read(self.target), b"new content")
+
+    def test_changed_source(self):
+        """ A partial copy of a source changed since is replaced. """
+        _write(self.partial, b"old ")
+        try:
+            setxattr(self.partial, mediamove._SOURCE_XATTR, b"other")
+        except OSError:
+            self.skipTest("No extended attributes on the temp filesystem")
+        utime(self.source, (0, 0))
+        _move_file(self.source, self.target, False)
+        self.assertEqual(_read(self.target), b"new content")
+
+    def test_partial_cleaned(self):
+        """ Leftover partial copies are removed by the cleaning. """
+        self.assertIs(MediaClassifier().classify(
+            "movie.mkv" + PARTIAL_SUFFIX, 100), FileKind.OTHER)
+
+
+if __name__ == "__main__":
+    unittest.main()
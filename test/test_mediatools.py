@@ -0,0 +1,185 @@
+"""
+test_mediatools module:
+Contains tests of the library cleaning.
+"""
+import sys
+import unittest
+import zlib
+from os import makedirs, path, walk
+from struct import pack
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..",
+                             "media-cleaner"))
+
+import rarfile
+
+from mediaargs import Flag
+from mediatools import MediaClassifier, _extract_rar_archive, clean_movie, \
+    clean_tv
+
+# The size of the generated main video files, sparse on disk.
+_MAIN_SIZE = 400000000
+
+
+def _make_file(file_path, size=_MAIN_SIZE):
+    """ Creates a sparse file and its parent directories. """
+    makedirs(path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as file_:
+        file_.truncate(size)
+
+
+def _make_rar_block(type_, flags, body=b"", data=b""):
+    """ Returns a RAR 4 block with its header CRC and data. """
+    header = pack("<BHH", type_, flags, 7 + len(body)) + body
+    return pack("<H", zlib.crc32(header) & 0xffff) + header + data
+
+
+def _make_rar(file_path, members):
+    """ Creates a stored RAR 4 archive of (name, data) members. """
+    makedirs(path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as file_:
+        file_.write(b"Rar!\x1a\x07\x00")
+        file_.write(_make_rar_block(0x73, 0, bytes(6)))
+        for name, data in members:
+            name = name.encode("utf-8")
+            file_.write(_make_rar_block(
+                0x74, 0x8000,
+                pack("<IIBIIBBHI", len(data), len(data), 3, zlib.crc32(data),
+                     (40 << 25) | (1 << 21) | (1 << 16), 20, 0x30, len(name),
+                     0o100644) + name, data))
+        file_.write(_make_rar_block(0x7b, 0x4000))
+
+
+class BusyTitleTest(unittest.TestCase):
+    """ Tests that titles of active torrents are never changed. """
+
+    def setUp(self):
+        self._temp_dir = TemporaryDirectory()
+        self.root = self._temp_dir.name
+        self.flags = {flag: False for flag in Flag}
+        self.flags[Flag.QUIET] = True
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def _get_files(self):
+        """ Returns the paths of all files below the root. """
+        return sorted(path.relpath(path.join(dir_path, file_), self.root)
+                      for dir_path, _, files in walk(self.root)
+                      for file_ in files)
+
+    def test_movie_not_merged_into_busy_title(self):
+        """ A release cleaned to the name of a busy movie is left alone. """
+        busy = path.join(self.root, "Movie (2015)")
+        _make_file(path.join(busy, "Movie.2015.1080p.mkv"))
+        _make_file(path.join(self.root, "Movie.2015.1080p.BluRay",
+                             "Movie.2015.1080p.BluRay.x264.mkv"))
+        files = self._get_files()
+
+        clean_movie(self.flags, self.root, busy_paths={busy})
+        self.assertEqual(self._get_files(), files)
+
+    def test_tv_not_merged_into_busy_title(self):
+        """ A release cleaned to the name of a busy series is left alone. """
+        busy = path.join(self.root, "Show")
+        _make_file(path.join(busy, "Show.S01E01.720p.mkv"))
+        _make_file(path.join(self.root, "show",
+                             "Show.S01E02.720p.HDTV.x264.mkv"))
+        files = self._get_files()
+
+        clean_tv(self.flags, self.root,
+                 busy_paths={path.join(busy, "Show.S01E01.720p.mkv")})
+        self.assertEqual(self._get_files(), files)
+
+    def test_other_titles_cleaned(self):
+        """ Titles that aren't cleaned into a busy title are cleaned. """
+        busy = path.join(self.root, "Movie (2015)")
+        _make_file(path.join(busy, "Movie.2015.1080p.mkv"))
+        _make_file(path.join(self.root, "Other.2016.720p",
+                             "Other.2016.720p.mkv"))
+
+        clean_movie(self.flags, self.root, busy_paths={busy})
+        self.assertEqual(self._get_files(),
+                         [path.join("Movie (2015)", "Movie.2015.1080p.mkv"),
+                          path.join("Other (2016)", "Other.2016.720P.mkv")])
+
+
+class ClassifierTest(unittest.TestCase):
+    """ Tests that files are cleaned as configured by the classifier. """
+
+    def setUp(self):
+        self._temp_dir = TemporaryDirectory()
+        self.root = self._temp_dir.name
+        self.flags = {flag: False for flag in Flag}
+        self.flags[Flag.QUIET] = True
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_configured_subtitle_suffix(self):
+        """ A file with a configured subtitle suffix is cleaned as one. """
+        title_dir = path.join(self.root, "Movie.2015.1080p.BluRay")
+        _make_file(path.join(title_dir, "Movie.2015.1080p.BluRay.x264.mkv"))
+        _make_file(path.join(title_dir, "Movie.2015.1080p.BluRay.x264.ass"),
+                   100)
+
+        clean_movie(self.flags, self.root,
+                    classifier=MediaClassifier(subtitle_suffixes=["ass"]))
+        self.assertTrue(path.isfile(path.join(
+            self.root, "Movie (2015)", "Movie.2015.1080P.BLURAY.X264.ass")))
+
+
+class ExtractTest(unittest.TestCase):
+    """ Tests where archive members are extracted to. """
+
+    def setUp(self):
+        self._temp_dir = TemporaryDirectory()
+        self.root = path.join(self._temp_dir.name, "library")
+        self.title = path.join(self.root, "Some Movie")
+        self.archive = path.join(self.title, "some.movie.rar")
+        self.flags = {flag: False for flag in Flag}
+        self.flags[Flag.QUIET] = True
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_escaping_member_rejected(self):
+        """ A member outside the archive directory fails the archive. """
+        _make_rar(self.archive, [("../../escaped.rar", b"data")])
+        with self.assertRaises(rarfile.BadRarFile):
+            _extract_rar_archive(self.archive, self.title)
+        self.assertFalse(path.exists(
+            path.join(self._temp_dir.name, "escaped.rar")))
+
+    def test_escaping_archive_kept(self):
+        """ The volumes of an archive that failed aren't removed. """
+        _make_rar(self.archive, [("../../escaped.rar", b"data")])
+        clean_movie(self.flags, self.root)
+        self.assertFalse(path.exists(
+            path.join(self._temp_dir.name, "escaped.rar")))
+        # The kept volume is renamed by the cleaning.
+        self.assertTrue(path.isfile(path.join(self.title, "Some.Movie.rar")))
+
+    def test_existing_file_kept(self):
+        """ A member never overwrites an existing file. """
+        existing = path.join(self.title, "Some.Movie.en.srt")
+        _make_file(existing, 0)
+        _make_rar(self.archive, [("Some.Movie.en.srt", b"subtitle")])
+        _extract_rar_archive(self.archive, self.title)
+        with open(existing, 'rb') as file_:
+            self.assertEqual(file_.read(), b"")
+        with open(path.join(self.title, "Some.Movie.en (2).srt"),
+                  'rb') as file_:
+            self.assertEqual(file_.read(), b"subtitle")
+
+    def test_nested_member(self):
+        """ A member in a directory is extracted below the directory. """
+        _make_rar(self.archive, [("Subs/./Some.Movie.en.srt", b"subtitle")])
+        _extract_rar_archive(self.archive, self.title)
+        self.assertTrue(path.isfile(
+            path.join(self.title, "Subs", "Some.Movie.en.srt")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""
+test_mediawatch module:
+Contains tests of the library change tracking.
+"""
+import sys
+import unittest
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..",
+                             "media-cleaner"))
+
+from mediawatch import _IN_ISDIR, _IN_MOVED_TO, _add_pending, \
+    _get_cleaned_titles
+
+_ROOT = "/library/movie"
+
+
+class PendingTitlesTest(unittest.TestCase):
+    """ Tests which changed titles are queued for cleaning. """
+
+    def test_cleaning_renames_ignored(self):
+        """ A title renamed by the cleaning isn't cleaned again. """
+        cleaned = {_ROOT: _get_cleaned_titles(
+            [_ROOT], _ROOT, {"Movie.2015.1080p"},
+            [path.join(_ROOT, "Movie.2015.1080p"),
+             path.join(_ROOT, "Movie (2015)")])}
+        pending = {}
+        _add_pending(pending, [_ROOT],
+                     [(path.join(_ROOT, "Movie (2015)"),
+                       _IN_MOVED_TO | _IN_ISDIR)], cleaned)
+        self.assertEqual(pending, {})
+
+    def test_other_titles_pending(self):
+        """ Titles the cleaning didn't change are still queued. """
+        cleaned = {_ROOT: _get_cleaned_titles(
+            [_ROOT], _ROOT, {"Movie.2015.1080p"},
+            [path.join(_ROOT, "Movie (2015)")])}
+        pending = {}
+        _add_pending(pending, [_ROOT],
+                     [(path.join(_ROOT, "Other.2016"), _IN_MOVED_TO)],
+                     cleaned)
+        self.assertEqual(pending, {_ROOT: {"Other.2016"}})
+
+    def test_all_titles_cleaned(self):
+        """ After cleaning all titles every change is ignored. """
+        self.assertIsNone(_get_cleaned_titles([_ROOT], _ROOT, None, []))
+
+
+if __name__ == "__main__":
+    unittest.main()